@@ -2,30 +2,39 @@ import time
 import asyncio
 import logging
 import struct
+from typing import TYPE_CHECKING
 
-import can
-from can import BusABC, Message
-from uds.client import Client
-import aioisotp
+from uds.client import Client, open_client
+from uds.bus import open_bus, wait_bus_ready
 from udsoncan.configs import default_client_config
 from udsoncan import AsciiCodec, DidCodec
 
+if TYPE_CHECKING:
+    from can import BusABC
+
 # create logger
 logger = logging.getLogger(__file__)
 logger.setLevel(logging.DEBUG)
 
-# create console handler and set level to debug
-sh = logging.StreamHandler()
-sh.setLevel(logging.DEBUG)
 
-# create formatter
-fmt = logging.Formatter('"%(pathname)s", line %(lineno)s --- %(message)s')
+def setup_logging():
+    # handlers are only created by the entry point, not on import
+    if logger.handlers:
+        return
+
+    # create console handler and set level to debug
+    sh = logging.StreamHandler()
+    sh.setLevel(logging.DEBUG)
+
+    # create formatter
+    fmt = logging.Formatter('"%(pathname)s", line %(lineno)s --- %(message)s')
+
+    # add formatter to sh
+    sh.setFormatter(fmt)
 
-# add formatter to sh
-sh.setFormatter(fmt)
+    # add sh to logger
+    logger.addHandler(sh)
 
-# add sh to logger
-logger.addHandler(sh)
 
 # Tester TX ID
 TX_ID = 0x72b
@@ -34,6 +43,22 @@ RX_ID = 0x73b
 # Tester FN ID
 FN_ID = 0x7df
 
+# Tester TX_DL, 8 for classic CAN, up to 64 for CAN FD
+TX_DL = 8
+IS_FD = TX_DL > 8
+DATA_BITRATE = 2000000
+
+
+def configure(tx_id=None, rx_id=None, fn_id=None):
+    # e.g. with an entry of the address map written by uds.discovery
+    global TX_ID, RX_ID, FN_ID
+    if tx_id is not None:
+        TX_ID = tx_id
+    if rx_id is not None:
+        RX_ID = rx_id
+    if fn_id is not None:
+        FN_ID = fn_id
+
 
 SEEDMASK = 0x80000000
 UNLOCKKEY = 0x00000000
@@ -137,42 +162,48 @@ async def Test_0x11(client: Client):
 
     response = await client.ecu_reset(1)
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
-    await asyncio.sleep(0.5)
+    elapsed = await client.wait_until_ready(power_down_time=response.service_data.powerdown_time)
+    logger.debug(f'ready after {elapsed:.3f}s')
 
     response = await client.change_session(2)
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
 
     response = await client.ecu_reset(1)
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
-    await asyncio.sleep(0.5)
+    elapsed = await client.wait_until_ready(power_down_time=response.service_data.powerdown_time)
+    logger.debug(f'ready after {elapsed:.3f}s')
 
     response = await client.change_session(3)
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
 
     response = await client.ecu_reset(1)
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
-    await asyncio.sleep(0.5)
+    elapsed = await client.wait_until_ready(power_down_time=response.service_data.powerdown_time)
+    logger.debug(f'ready after {elapsed:.3f}s')
 
     response = await client.change_session(1)
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
 
     response = await client.ecu_reset(3)
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
-    await asyncio.sleep(0.5)
+    elapsed = await client.wait_until_ready(power_down_time=response.service_data.powerdown_time)
+    logger.debug(f'ready after {elapsed:.3f}s')
 
     response = await client.change_session(2)
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
 
     response = await client.ecu_reset(3)
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
-    await asyncio.sleep(0.5)
+    elapsed = await client.wait_until_ready(power_down_time=response.service_data.powerdown_time)
+    logger.debug(f'ready after {elapsed:.3f}s')
 
     response = await client.change_session(3)
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
 
     response = await client.ecu_reset(3)
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
-    await asyncio.sleep(0.5)
+    elapsed = await client.wait_until_ready(power_down_time=response.service_data.powerdown_time)
+    logger.debug(f'ready after {elapsed:.3f}s')
 
 
 async def Test_0x14(client: Client):
@@ -182,19 +213,16 @@ async def Test_0x14(client: Client):
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
     response = await client.clear_dtc()
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
-    await asyncio.sleep(0.5)
 
     response = await client.change_session(2)
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
     response = await client.clear_dtc()
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
-    await asyncio.sleep(0.5)
 
     response = await client.change_session(3)
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
     response = await client.clear_dtc()
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
-    await asyncio.sleep(0.5)
 
 
 async def Test_0x19(client: Client):
@@ -446,8 +474,31 @@ async def Test_0x31(client: Client):
     logger.debug([f'0x{i:02x}' for i in response.original_payload])
 
 
-async def diag_test(bus: BusABC):
-
+# run in this order, over physical and then over functional addressing
+PHYSICAL_TESTS = [
+    Test_0x10,
+    Test_0x11,
+    Test_0x14,
+    Test_0x19,
+    Test_0x22,
+    Test_0x2e,
+    Test_0x27,
+    Test_0x28,
+    Test_0x3e,
+    Test_0x85,
+    Test_0x31,
+]
+
+FUNCTIONAL_TESTS = [
+    Test_0x10,
+    Test_0x14,
+    Test_0x28,
+    Test_0x3e,
+    Test_0x85,
+]
+
+
+def make_config():
     config = dict(default_client_config)
     config['data_identifiers'] = {
         0xF180: AsciiCodec(32),
@@ -457,37 +508,31 @@ async def diag_test(bus: BusABC):
         0xF191: AsciiCodec(10),
         0xF199: BCDCodec(4),
     }
+    return config
 
-    network = aioisotp.ISOTPNetwork(bus=bus, tx_padding=0x00)
-    with network.open():
 
-        reader, writer = await network.open_connection(RX_ID, TX_ID)
-        client = Client(reader, writer, config)
+async def diag_test(bus: 'BusABC'):
+    from uds.isotp import ISOTPNetwork
 
-        await Test_0x10(client)
-        await Test_0x11(client)
-        await Test_0x14(client)
-        await Test_0x19(client)
-        await Test_0x22(client)
-        await Test_0x2e(client)
-        await Test_0x27(client)
-        await Test_0x28(client)
-        await Test_0x3e(client)
-        await Test_0x85(client)
-        await Test_0x31(client)
+    config = make_config()
+
+    network = ISOTPNetwork(bus=bus, tx_padding=0x00, tx_dl=TX_DL,
+                           is_fd=IS_FD, bitrate_switch=IS_FD)
+    with network.open():
 
-        reader, writer = await network.open_connection(RX_ID, FN_ID)
-        client = Client(reader, writer, config)
+        async with open_client(network, RX_ID, TX_ID, config) as client:
+            for test in PHYSICAL_TESTS:
+                await test(client)
 
-        await Test_0x10(client)
-        await Test_0x14(client)
-        await Test_0x28(client)
-        await Test_0x3e(client)
-        await Test_0x85(client)
+        async with open_client(network, RX_ID, FN_ID, config) as client:
+            for test in FUNCTIONAL_TESTS:
+                await test(client)
 
 
 if __name__ == '__main__':
 
+    setup_logging()
+
     bus_config = {
         'interface': 'vector',
         # 'interface': 'canalystii',
@@ -498,16 +543,20 @@ if __name__ == '__main__':
         ]
     }
 
-    bus = can.interface.Bus(**bus_config)
+    if IS_FD:
+        bus_config['fd'] = True
+        bus_config['data_bitrate'] = DATA_BITRATE
+
+    bus = open_bus(**bus_config)
 
     # send something to start
-    bus.send(Message(arbitration_id=0))
-    bus.recv(0.5)
+    wait_bus_ready(bus)
     #######################################################
 
-    t1 = time.time()
-    asyncio.run(diag_test(bus))
-    t2 = time.time()
-    logger.debug(f'finished in {t2 - t1:.2f}s')
-
-    # bus.shutdown()
+    try:
+        t1 = time.time()
+        asyncio.run(diag_test(bus))
+        t2 = time.time()
+        logger.debug(f'finished in {t2 - t1:.2f}s')
+    finally:
+        bus.shutdown()
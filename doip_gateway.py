@@ -0,0 +1,162 @@
+import sys
+import struct
+import asyncio
+import logging
+
+from uds import doip
+from uds.doip import PayloadType, encode_message
+
+
+logger = logging.getLogger(__file__)
+
+# Local stand-in for a DoIP gateway, e.g. to run diag_test over DoIP
+# without a vehicle
+HOST = '127.0.0.1'
+VIN = b'WDIAGTEST00000001'
+LOGICAL_ADDRESS = 0x1000
+EID = bytes(6)
+GID = bytes(6)
+
+# ECU logical address behind the gateway
+ECU_ADDRESS = 0x0001
+
+DIDS = {
+    0xF180: b'BOOT'.ljust(32),
+    0xF187: b'PART0000001'.ljust(13),
+    0xF188: b'SWNR0000001'.ljust(13),
+    0xF18A: b'SUP',
+    0xF191: b'HWNR000001',
+    0xF199: bytes([0x20, 0x20, 0x01, 0x01]),
+}
+
+
+def negative_response(sid, nrc) -> bytes:
+    return bytes([0x7F, sid, nrc])
+
+
+def simple_ecu(request: bytes) -> bytes:
+    # just enough of a UDS server for TesterPresent, session control,
+    # ECU reset and reading the DIDs of diag_test
+    sid = request[0]
+    if sid == 0x3E and len(request) == 2:
+        return None if request[1] & 0x80 else bytes([0x7E, request[1]])
+    if sid == 0x10 and len(request) == 2:
+        return bytes([0x50, request[1], 0x00, 0x32, 0x01, 0xF4])
+    if sid == 0x11 and len(request) == 2:
+        return bytes([0x51, request[1]])
+    if sid == 0x22 and len(request) >= 3 and len(request) % 2 == 1:
+        response = bytearray([0x62])
+        for i in range(1, len(request), 2):
+            did = request[i] << 8 | request[i + 1]
+            if did not in DIDS:
+                return negative_response(sid, 0x31)
+            response += request[i:i + 2] + DIDS[did]
+        return bytes(response)
+    return negative_response(sid, 0x11)
+
+
+class GatewayProtocol(asyncio.Protocol):
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.tester_address = None
+        self._transport = None
+        self._buffer = bytearray()
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def data_received(self, data):
+        self._buffer += data
+        while len(self._buffer) >= doip.HEADER.size:
+            payload_type, length = doip.decode_header(self._buffer)
+            end = doip.HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            payload = bytes(self._buffer[doip.HEADER.size:end])
+            del self._buffer[:end]
+            self._message_received(payload_type, payload)
+
+    def _send(self, payload_type, payload=b''):
+        self._transport.write(encode_message(payload_type, payload))
+
+    def _message_received(self, payload_type, payload):
+        if payload_type == PayloadType.RoutingActivationRequest:
+            self.tester_address, activation_type = struct.unpack_from('>HB', payload)
+            code = doip.RoutingActivationCode.Success if activation_type in (0x00, 0x01) \
+                else doip.RoutingActivationCode.UnsupportedActivationType
+            self._send(PayloadType.RoutingActivationResponse,
+                       struct.pack('>HHBI', self.tester_address, self.gateway.logical_address, code, 0))
+
+        elif payload_type == PayloadType.DiagnosticMessage:
+            source_address, target_address = struct.unpack_from('>HH', payload)
+            if self.tester_address is None or source_address != self.tester_address:
+                # invalid source address
+                self._send(PayloadType.DiagnosticMessageNack,
+                           struct.pack('>HHB', target_address, source_address, 0x02))
+                return
+            handler = self.gateway.ecus.get(target_address)
+            if handler is None:
+                # unknown target address
+                self._send(PayloadType.DiagnosticMessageNack,
+                           struct.pack('>HHB', target_address, source_address, 0x03))
+                return
+            self._send(PayloadType.DiagnosticMessageAck,
+                       struct.pack('>HHB', target_address, source_address, 0x00))
+            response = handler(payload[4:])
+            if response is not None:
+                self._send(PayloadType.DiagnosticMessage,
+                           struct.pack('>HH', target_address, source_address) + response)
+
+        elif payload_type == PayloadType.AliveCheckResponse:
+            pass
+
+        else:
+            # unknown payload type
+            self._send(PayloadType.GenericNack, bytes([0x01]))
+
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        payload_type, _ = doip.decode_header(data)
+        if payload_type == PayloadType.VehicleIdentificationRequest:
+            self._transport.sendto(self.gateway.announcement(), addr)
+
+
+class Gateway(object):
+
+    def __init__(self, ecus=None, vin=VIN, logical_address=LOGICAL_ADDRESS):
+        # ecus maps logical addresses to a function from request to response
+        self.ecus = ecus if ecus is not None else {ECU_ADDRESS: simple_ecu}
+        self.vin = vin
+        self.logical_address = logical_address
+
+    def announcement(self) -> bytes:
+        return encode_message(PayloadType.VehicleAnnouncement,
+                              self.vin + struct.pack('>H', self.logical_address) + EID + GID + bytes([0x00]))
+
+    async def serve(self, host=HOST, port=doip.TCP_DATA_PORT, udp_port=doip.UDP_DISCOVERY_PORT):
+        loop = asyncio.get_event_loop()
+        server = await loop.create_server(lambda: GatewayProtocol(self), host, port)
+        udp, _ = await loop.create_datagram_endpoint(lambda: DiscoveryProtocol(self), local_addr=(host, udp_port))
+        logger.info('DoIP gateway on %s:%d', host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            udp.close()
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO)
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else doip.TCP_DATA_PORT
+    asyncio.run(Gateway().serve(port=port, udp_port=port))
@@ -0,0 +1,388 @@
+import time
+import asyncio
+import itertools
+
+from can import BusABC
+
+from uds import isotp
+from uds.bus import open_bus, wait_bus_ready
+import isotp_test
+from isotp_test import logger, send_can_msg, recv_can_msg
+
+
+# Addressing modes to generate cases for, the ECU must support all of them
+ADDRESSING_MODES = [isotp.AddressingMode.Normal]
+# Sessions to run the cases in
+SESSIONS = [1, 3]
+# N_TA of the ECU and the tester for extended addressing
+TARGET_ADDRESS = 0x01
+SOURCE_ADDRESS = 0xF1
+# N_AE for mixed addressing
+ADDRESS_EXTENSION = 0x00
+
+# Single frame requests with a segmented response of different lengths,
+# {request: length of the response of the ECU}
+RESPONSE_REQUESTS = {
+    (0x19, 0x0A): 43,
+    (0x22, 0xF1, 0x80): 35,
+    (0x22, 0xF1, 0x87, 0xF1, 0x88): 31,
+}
+# seconds per unit of Message.timestamp
+TIMESTAMP_UNIT = 1.0
+
+FAULTS = (None, 'drop', 'duplicate', 'delay')
+FC_FAULTS = (None, 'no_fc', 'delay_fc', 'overflow', 'wait')
+INTERRUPTS = ('sf', 'ff', 'fc', 'unknown')
+
+
+def make_address(mode) -> isotp.Address:
+    return isotp.Address(isotp_test.RX_ID, isotp_test.TX_ID, mode,
+                         target_address=TARGET_ADDRESS, source_address=SOURCE_ADDRESS,
+                         address_extension=ADDRESS_EXTENSION)
+
+
+def frame_size(address: isotp.Address) -> int:
+    return isotp_test.TX_DL - len(address.tx_prefix)
+
+
+def send_frame(bus: BusABC, address: isotp.Address, frame: bytes, padded=True):
+    data = address.tx_prefix + frame
+    if padded:
+        data = isotp.pad(data, max(8, isotp.frame_length(len(data))))
+    send_can_msg(bus, address.tx_id, data)
+
+
+async def recv_frame(bus: BusABC, address: isotp.Address, data_only=True):
+    msg = await recv_can_msg(bus, address.rx_id, False)
+    if msg is None:
+        return None
+    prefix = address.rx_prefix
+    assert msg.data[:len(prefix)] == prefix
+    if data_only:
+        return msg.data[len(prefix):]
+    msg.data = msg.data[len(prefix):]
+    return msg
+
+
+class Case(object):
+
+    def __init__(self, scenario, params):
+        self.scenario = scenario
+        self.params = params
+        self.name = '%s[%s]' % (scenario.name, ','.join(
+            '%s=%s' % (k, v) for k, v in sorted(params.items())))
+
+    @property
+    def session(self):
+        return self.params.get('session', 1)
+
+    @property
+    def mode(self):
+        return self.params.get('mode', isotp.AddressingMode.Normal)
+
+    @property
+    def settle(self) -> float:
+        return self.scenario.settle(self.params)
+
+    async def run(self, bus: BusABC):
+        params = dict(self.params)
+        params['address'] = make_address(params.pop('mode'))
+        await self.scenario.template(bus, **params)
+
+
+class Scenario(object):
+
+    def __init__(self, name, template, grid, where=None, settle=None):
+        self.name = name
+        self.template = template
+        self.grid = grid
+        self.where = where
+        self.settle = settle if settle is not None else (lambda params: 0)
+
+    def expand(self):
+        grid = dict(self.grid)
+        grid.setdefault('mode', ADDRESSING_MODES)
+        grid.setdefault('session', SESSIONS)
+        keys = sorted(grid)
+        for values in itertools.product(*(grid[k] for k in keys)):
+            params = dict(zip(keys, values))
+            if self.where is None or self.where(params):
+                yield Case(self, params)
+
+
+async def segmented_request(bus: BusABC, address, session, length, fault, position):
+    size = frame_size(address)
+    payload = bytes([0x22]) + bytes(length - 1)
+    index = isotp.first_frame_capacity(length, isotp_test.TX_DL, len(address.tx_prefix))
+    # Tester sends a request that is longer than one frame
+    send_frame(bus, address, isotp.encode_first_frame(length, payload[:index]))
+
+    sn = 1
+    cf = 0
+    while index < length:
+        # after the ECU Flow control
+        response = await recv_frame(bus, address)
+        assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
+        block_size = response[1]
+        stmin = isotp.stmin_to_seconds(response[2])
+        count = 0
+        while index < length and (block_size == 0 or count < block_size):
+            frame = isotp.encode_consecutive_frame(
+                sn, payload[index:index + size - 1])
+            if cf == position and fault == 'delay':
+                await asyncio.sleep((isotp_test.N_Cr + 100) / 1000)
+            if cf != position or fault != 'drop':
+                send_frame(bus, address, frame)
+            if cf == position and fault == 'duplicate':
+                await asyncio.sleep(stmin)
+                send_frame(bus, address, frame)
+            index += size - 1
+            # a duplicated last CF arrives after the reception completed and is ignored
+            if cf == position and fault is not None and (fault != 'duplicate' or index < length):
+                # No response is expected
+                response = await recv_frame(bus, address)
+                assert response is None
+                return
+            await asyncio.sleep(stmin)
+            sn = (sn + 1) & 0xF
+            cf += 1
+            count += 1
+
+    # ECU should send a diagnostic response for the request
+    response = await recv_frame(bus, address)
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.SingleFrame
+    assert response[1] == 0x7f and response[2] == 0x22
+
+
+async def segmented_response(bus: BusABC, address, session, request, block_size, stmin, fault, position):
+    # Tester sends a request with a response that is longer than one frame
+    send_frame(bus, address, isotp.encode_single_frame(bytes(request)))
+    response = await recv_frame(bus, address)
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
+    count = isotp.consecutive_frame_count(isotp.first_frame_length(response),
+                                          len(response) + len(address.rx_prefix), len(address.rx_prefix))
+
+    sn = 1
+    block = 0
+    while count > 0:
+        if block == position and fault is not None:
+            if fault == 'delay_fc':
+                await asyncio.sleep((isotp_test.N_Bs + 100) / 1000)
+                send_frame(bus, address, isotp.encode_flow_control(
+                    isotp.FlowStatus.ContinueToSend, block_size, stmin))
+            elif fault == 'overflow':
+                send_frame(bus, address, isotp.encode_flow_control(
+                    isotp.FlowStatus.Overflow, block_size, stmin))
+            elif fault == 'wait':
+                send_frame(bus, address, isotp.encode_flow_control(
+                    isotp.FlowStatus.Wait, block_size, stmin))
+            # ECU must not send Consecutive frames
+            response = await recv_frame(bus, address)
+            assert response is None
+            return
+
+        send_frame(bus, address, isotp.encode_flow_control(
+            isotp.FlowStatus.ContinueToSend, block_size, stmin))
+        timestamps = []
+        for _ in range(block_size or count):
+            msg = await recv_frame(bus, address, False)
+            assert msg is not None and msg.data[0] == isotp.encode_consecutive_frame(sn)[0]
+            timestamps.append(msg.timestamp)
+            sn = (sn + 1) & 0xF
+            count -= 1
+            if count == 0:
+                break
+        # the time between the Consecutive Frames is not below STMin
+        for t1, t2 in zip(timestamps[:-1], timestamps[1:]):
+            assert (t2 - t1) * TIMESTAMP_UNIT * 1000 > isotp.stmin_to_seconds(stmin) * 1000 - 0.5
+        block += 1
+
+    # BS count of CF is received above, so recve nothing
+    response = await recv_frame(bus, address)
+    assert response is None
+
+
+async def interrupted_request(bus: BusABC, address, session, interrupt):
+    length = isotp.first_frame_capacity(0, isotp_test.TX_DL, len(address.tx_prefix)) + 3
+    payload = bytes([0x22]) + bytes(length - 1)
+    index = length - 3
+    # Tester sends a request that is longer than one frame
+    send_frame(bus, address, isotp.encode_first_frame(length, payload[:index]))
+    response = await recv_frame(bus, address)
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
+
+    if interrupt == 'sf':
+        # Tester sends a segmented request interrupted by a Single frame
+        send_frame(bus, address, isotp.encode_single_frame(bytes([0x10, session])))
+        # The ECU must send a response for the second request.
+        response = await recv_frame(bus, address)
+        assert response is not None and response[1] == 0x50 and response[2] == session
+        return
+
+    if interrupt == 'ff':
+        # Tester sends a First frame of another segmented request.
+        send_frame(bus, address, isotp.encode_first_frame(length, bytes([0x23]) + payload[1:index]))
+        response = await recv_frame(bus, address)
+        assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
+        sid = 0x23
+    else:
+        if interrupt == 'fc':
+            send_frame(bus, address, isotp.encode_flow_control(
+                isotp.FlowStatus.ContinueToSend, 0, 0x14))
+        else:
+            send_frame(bus, address, bytes([0x40]))
+        sid = 0x22
+
+    # After that the Tester sends the remaining consecutive frames
+    send_frame(bus, address, isotp.encode_consecutive_frame(1, payload[index:]))
+    response = await recv_frame(bus, address)
+    assert response is not None and response[1] == 0x7f and response[2] == sid
+
+
+async def single_frame(bus: BusABC, address, session, sf_dl, can_dl):
+    # Tester sends a TesterPresent Single frame with the given SF_DL and CAN-DLC
+    data = address.tx_prefix + bytes([sf_dl, 0x3E, 0x00]) + bytes(8)
+    send_can_msg(bus, address.tx_id, data[:can_dl])
+    response = await recv_frame(bus, address)
+    # only completely padded frames are accepted, see 7.32
+    valid = 0 < sf_dl <= 7 - len(address.tx_prefix) and can_dl == 8
+    if valid:
+        assert response is not None and response[1] in (0x7E, 0x7F)
+    else:
+        # ECU must not send a response
+        assert response is None
+
+
+def _request_lengths():
+    size = isotp_test.TX_DL - 1
+    first = isotp.single_frame_capacity(isotp_test.TX_DL) + 1
+    return range(first, first + size * 16)
+
+
+def _response_blocks(params) -> int:
+    # number of Flow controls the tester sends for the response
+    prefix = len(make_address(params['mode']).rx_prefix)
+    count = isotp.consecutive_frame_count(RESPONSE_REQUESTS[params['request']], isotp_test.TX_DL, prefix)
+    if params['block_size'] == 0:
+        return 1
+    return (count + params['block_size'] - 1) // params['block_size']
+
+
+def make_scenarios():
+    # built on use, so that TX_DL and N_Cr / N_Bs set on isotp_test before
+    # the call apply, the IDs of isotp_test.configure are read by each case
+    return [
+        Scenario('segmented_request', segmented_request, {
+            'length': _request_lengths(),
+            'fault': FAULTS,
+            'position': range(16),
+        }, where=lambda p: (p['fault'] is not None or p['position'] == 0) and
+            p['position'] < isotp.consecutive_frame_count(p['length'], isotp_test.TX_DL),
+            settle=lambda p: isotp_test.N_Cr / 1000 if p['fault'] == 'drop' else 0),
+        Scenario('segmented_response', segmented_response, {
+            'request': list(RESPONSE_REQUESTS),
+            'block_size': [0, 1, 2, 3, 8],
+            'stmin': [0, 1, 10, 20, 0x7F, 0xF1, 0xF5],
+            'fault': FC_FAULTS,
+            'position': range(3),
+        }, where=lambda p: (p['fault'] is not None or p['position'] == 0) and
+            p['position'] < _response_blocks(p),
+            settle=lambda p: isotp_test.N_Bs / 1000 if p['fault'] == 'wait' else 0),
+        Scenario('interrupted_request', interrupted_request, {
+            'interrupt': INTERRUPTS,
+        }),
+        Scenario('single_frame', single_frame, {
+            'sf_dl': range(0, 9),
+            'can_dl': range(1, 9),
+        }),
+    ]
+
+
+def generate(scenarios=None):
+    for scenario in scenarios if scenarios is not None else make_scenarios():
+        yield from scenario.expand()
+
+
+def plan(cases):
+    # Group the cases by addressing mode and session so that the session
+    # is only changed once per group, cases that leave the ECU busy go last
+    return sorted(cases, key=lambda case: (case.mode, case.session, case.settle > 0))
+
+
+async def change_session(bus: BusABC, address, session):
+    send_frame(bus, address, isotp.encode_single_frame(bytes([0x10, session])))
+    response = await recv_frame(bus, address)
+    assert response is not None and response[1] == 0x50 and response[2] == session
+
+
+async def run_case(bus: BusABC, case: Case):
+    # one case on its own, from the ECU idle in the default session
+    if case.session != 1:
+        await change_session(bus, make_address(case.mode), case.session)
+    await case.run(bus)
+    if case.settle:
+        await asyncio.sleep(case.settle)
+
+
+async def run_cases(bus: BusABC, cases):
+    passed = 0
+    failed = []
+    state = None
+    for case in plan(cases):
+        address = make_address(case.mode)
+        # leave the ECU idle, a failed case may have left it mid-transfer
+        isotp_test.ecu_state.prefix_len = len(address.tx_prefix)
+        await isotp_test.reset_state(bus, isotp_test.ecu_state.session)
+
+        if state != (case.mode, case.session):
+            await change_session(bus, address, case.session)
+            state = (case.mode, case.session)
+        elif case.session != 1:
+            # keep the non-default session alive, suppressed TesterPresent
+            send_frame(bus, address, isotp.encode_single_frame(bytes([0x3E, 0x80])))
+
+        try:
+            await case.run(bus)
+        except AssertionError as e:
+            logger.error(f'{case.name} failed {e}')
+            failed.append(case)
+        else:
+            passed += 1
+
+        if case.settle:
+            await asyncio.sleep(case.settle)
+
+    logger.debug(f'{passed} passed, {len(failed)} failed')
+    return passed, failed
+
+
+if __name__ == '__main__':
+
+    isotp_test.setup_logging()
+
+    bus_config = {
+        'interface': 'vector',
+        # 'interface': 'canalystii',
+        'channel': 0,
+        'bitrate': 500000,
+        'can_filters': [
+            {'can_id': isotp_test.RX_ID, 'can_mask': 0xffffffff}
+        ]
+    }
+
+    if isotp_test.IS_FD:
+        bus_config['fd'] = True
+        bus_config['data_bitrate'] = isotp_test.DATA_BITRATE
+
+    bus = open_bus(**bus_config)
+
+    # send something to start
+    wait_bus_ready(bus)
+    #######################################################
+
+    t1 = time.time()
+    asyncio.run(run_cases(bus, list(generate())))
+    t2 = time.time()
+    print(f'finished in {t2 - t1:.2f}s')
+
+    bus.shutdown()
@@ -0,0 +1,292 @@
+import os
+import time
+import random
+
+from can import BusABC, CanError
+
+from uds import isotp
+from uds.bus import open_bus, wait_bus_ready
+import isotp_test
+from isotp_test import logger, send_can_msg
+
+
+# UDS requests the mutations start from
+SEEDS = [
+    (0x10, 0x01),
+    (0x10, 0x03),
+    (0x11, 0x01),
+    (0x14, 0xFF, 0xFF, 0xFF),
+    (0x19, 0x02, 0x09),
+    (0x19, 0x0A),
+    (0x22, 0xF1, 0x80),
+    (0x22, 0xF1, 0x87, 0xF1, 0x88),
+    (0x27, 0x03),
+    (0x28, 0x03, 0x01),
+    (0x31, 0x01, 0x18, 0x30),
+    (0x3E, 0x00),
+    (0x85, 0x02),
+]
+
+# Services that reset the ECU, stop its communication or change its memory
+# would be reported as crashes, they are not sent unless explicitly allowed
+EXCLUDED_SIDS = {0x11, 0x28, 0x2E, 0x2F, 0x31, 0x34, 0x35, 0x36, 0x37, 0x3D, 0x85}
+
+# TesterPresent liveness probe and its expected response
+PROBE = bytes([0x02, 0x3E, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+PROBE_RESPONSE = bytes([0x02, 0x7E, 0x00])
+# P2 server max in seconds
+P2 = 0.05
+# time a crashed ECU gets to come back before the fuzzer gives up
+RECOVERY_TIME = 5.0
+
+
+class Mutator(object):
+
+    def __init__(self, seed=None, corpus=None, excluded_sids=EXCLUDED_SIDS):
+        self.random = random.Random(seed)
+        self.excluded_sids = excluded_sids
+        self.corpus = [bytes(i) for i in (corpus or SEEDS) if i and i[0] not in excluded_sids]
+        # what an excluded SID is replaced with
+        self.sids = sorted({i[0] for i in self.corpus})
+        self.strategies = [
+            (self.pci, 2),
+            (self.length, 2),
+            (self.sequence, 1),
+            (self.dlc, 1),
+            (self.uds, 4),
+        ]
+
+    def _pad(self, frame: bytes) -> bytes:
+        return isotp.pad(frame[:8], 8, self.random.choice((0x00, 0x55, 0xAA, 0xCC, 0xFF)))
+
+    def _payload(self, size) -> bytes:
+        return bytes(self.random.getrandbits(8) for _ in range(size))
+
+    def pci(self) -> bytes:
+        # unknown N_PCItype or random bits behind a valid one
+        first = self.random.randrange(0x40, 0x100) if self.random.random() < 0.5 \
+            else self.random.randrange(0x00, 0x40)
+        return self._pad(bytes([first]) + self._payload(7))
+
+    def length(self) -> bytes:
+        choice = self.random.randrange(4)
+        if choice == 0:
+            # SF_DL that does not match the data
+            sf_dl = self.random.choice((0, 8, 9, 15, self.random.randrange(1, 8)))
+            return self._pad(bytes([sf_dl]) + self._payload(7))
+        if choice == 1:
+            # FF_DL that fits in a Single frame or is larger than any buffer
+            ff_dl = self.random.choice((0, 1, 7, 0xFFF, self.random.randrange(0, 0x1000)))
+            return self._pad(isotp.encode_first_frame(ff_dl & 0xFFF) + self._payload(6))
+        if choice == 2:
+            # escape sequence First frame with a small or huge length
+            ff_dl = self.random.choice((0, 7, 0xFFF, 0xFFFFFFFF, self.random.getrandbits(32)))
+            return self._pad(bytes([0x10, 0x00]) + ff_dl.to_bytes(4, 'big') + self._payload(2))
+        # Flow control with reserved flow status, block size or STmin
+        return self._pad(isotp.encode_flow_control(self.random.randrange(16),
+                                                   self.random.getrandbits(8), self.random.getrandbits(8)))
+
+    def sequence(self) -> bytes:
+        return self._pad(isotp.encode_consecutive_frame(self.random.randrange(16), self._payload(7)))
+
+    def dlc(self) -> bytes:
+        # any frame truncated to a random CAN-DLC
+        frame = self.frame()
+        return frame[:self.random.randrange(0, 9)]
+
+    def uds(self) -> bytes:
+        payload = bytearray(self.random.choice(self.corpus))
+        for _ in range(self.random.randrange(1, 4)):
+            choice = self.random.randrange(5)
+            if choice == 0 and payload:
+                index = self.random.randrange(len(payload))
+                payload[index] ^= 1 << self.random.randrange(8)
+            elif choice == 1 and payload:
+                payload[self.random.randrange(len(payload))] = self.random.getrandbits(8)
+            elif choice == 2 and len(payload) < 7:
+                payload.insert(self.random.randrange(len(payload) + 1), self.random.getrandbits(8))
+            elif choice == 3 and len(payload) > 1:
+                del payload[self.random.randrange(len(payload))]
+            elif choice == 4 and len(payload) > 1:
+                payload[1] = self.random.getrandbits(8)
+        if not payload:
+            payload[:1] = self.random.choice(self.corpus)[:1]
+        return self._pad(isotp.encode_single_frame(bytes(payload[:7])))
+
+    def allowed(self, frame: bytes) -> bytes:
+        # Every strategy can make a frame that an ECU takes for a Single
+        # frame, its SID is replaced when excluded. The SID follows the
+        # SF_DL, or the escape sequence 0x00 SF_DL.
+        if not frame or isotp.pci_type(frame) != isotp.PCIType.SingleFrame:
+            return frame
+        index = 2 if frame[0] == 0x00 else 1
+        if index < len(frame) and frame[index] in self.excluded_sids:
+            frame = bytearray(frame)
+            frame[index] = self.random.choice(self.sids)
+        return bytes(frame)
+
+    def frame(self) -> bytes:
+        strategies, weights = zip(*self.strategies)
+        return self.allowed(self.random.choices(strategies, weights)[0]())
+
+    def batch(self, size):
+        return [self.frame() for _ in range(size)]
+
+
+def drain(bus: BusABC):
+    while bus.recv(0) is not None:
+        pass
+
+
+def send_frames(bus: BusABC, frames):
+    for frame in frames:
+        while True:
+            try:
+                send_can_msg(bus, isotp_test.TX_ID, frame)
+                break
+            except CanError:
+                # transmit queue is full, the bus is running at its limit
+                time.sleep(0.001)
+
+
+def probe(bus: BusABC, retries=3) -> bool:
+    for _ in range(retries):
+        drain(bus)
+        send_can_msg(bus, isotp_test.TX_ID, PROBE)
+        deadline = time.perf_counter() + P2
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            msg = bus.recv(remaining)
+            if msg is not None and msg.arbitration_id == isotp_test.RX_ID and \
+                    bytes(msg.data[:3]) == PROBE_RESPONSE:
+                return True
+    return False
+
+
+def wait_alive(bus: BusABC, timeout=RECOVERY_TIME) -> bool:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if probe(bus, 1):
+            return True
+    return False
+
+
+def reproduces(bus: BusABC, frames) -> bool:
+    if not wait_alive(bus):
+        raise RuntimeError('ECU did not recover')
+    send_frames(bus, frames)
+    return not probe(bus)
+
+
+def minimize(bus: BusABC, frames):
+    if not reproduces(bus, frames):
+        logger.error('crash is not reproducible')
+        return frames
+    # ddmin over the frames of the crashing batch
+    n = 2
+    while len(frames) >= 2:
+        size = max(1, len(frames) // n)
+        chunks = [frames[i:i + size] for i in range(0, len(frames), size)]
+        for chunk in chunks:
+            if reproduces(bus, chunk):
+                frames, n = chunk, 2
+                break
+        else:
+            for i in range(len(chunks)):
+                complement = [f for j, c in enumerate(chunks) if j != i for f in c]
+                if reproduces(bus, complement):
+                    frames, n = complement, max(n - 1, 2)
+                    break
+            else:
+                if n >= len(frames):
+                    break
+                n = min(n * 2, len(frames))
+    return frames
+
+
+def load_corpus(path):
+    corpus = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            with open(os.path.join(path, name)) as f:
+                corpus.extend(bytes.fromhex(line) for line in f.read().split())
+    return corpus
+
+
+def save_frames(path, name, frames):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, name), 'w') as f:
+        f.write('\n'.join(bytes(frame).hex() for frame in frames) + '\n')
+
+
+def fuzz(bus: BusABC, duration=60, batch_size=100, corpus_path='fuzz_corpus', seed=None):
+    seeds_path = os.path.join(corpus_path, 'seeds')
+    if not os.path.isdir(seeds_path):
+        save_frames(seeds_path, 'default.txt', [
+            isotp.pad(isotp.encode_single_frame(bytes(i))) for i in SEEDS])
+    # the frames of earlier crashes are mutated again, near what broke the ECU
+    crashes_path = os.path.join(corpus_path, 'crashes')
+    corpus = load_corpus(seeds_path) + load_corpus(crashes_path)
+    mutator = Mutator(seed, [frame[1:1 + isotp.single_frame_length(frame)] for frame in corpus
+                             if frame and isotp.pci_type(frame) == isotp.PCIType.SingleFrame and
+                             0 < isotp.single_frame_length(frame) < len(frame)] or None)
+    crashes = []
+    frames_sent = 0
+    t1 = time.perf_counter()
+    last_report = t1
+
+    if not wait_alive(bus):
+        raise RuntimeError('ECU does not answer the liveness probe')
+
+    while time.perf_counter() - t1 < duration:
+        batch = mutator.batch(batch_size)
+        send_frames(bus, batch)
+        frames_sent += len(batch)
+
+        if not probe(bus):
+            logger.error(f'ECU stopped answering after a batch of {len(batch)} frames')
+            name = f'{int(time.time())}-{len(crashes)}.txt'
+            save_frames(crashes_path, 'batch-' + name, batch)
+            frames = minimize(bus, batch)
+            name = 'crash-' + name
+            save_frames(crashes_path, name, frames)
+            logger.error(f'minimized to {len(frames)} frames, saved as {name}')
+            crashes.append(frames)
+            if not wait_alive(bus):
+                raise RuntimeError('ECU did not recover')
+
+        now = time.perf_counter()
+        if now - last_report > 5:
+            logger.debug(f'{frames_sent} frames, {frames_sent / (now - t1):.0f} frames/s, {len(crashes)} crashes')
+            last_report = now
+
+    t2 = time.perf_counter()
+    logger.debug(f'{frames_sent} frames in {t2 - t1:.2f}s, {frames_sent / (t2 - t1):.0f} frames/s, {len(crashes)} crashes')
+    return crashes
+
+
+if __name__ == '__main__':
+
+    isotp_test.setup_logging()
+
+    bus_config = {
+        'interface': 'vector',
+        # 'interface': 'canalystii',
+        'channel': 0,
+        'bitrate': 500000,
+        'can_filters': [
+            {'can_id': isotp_test.RX_ID, 'can_mask': 0xffffffff}
+        ]
+    }
+
+    bus = open_bus(**bus_config)
+
+    # send something to start
+    wait_bus_ready(bus)
+    #######################################################
+
+    fuzz(bus)
+
+    bus.shutdown()
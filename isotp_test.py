@@ -2,26 +2,34 @@ import time
 import asyncio
 import logging
 
-import can
 from can import BusABC, Message
+from uds import isotp
+from uds.bus import open_bus, wait_bus_ready
 
 
 # create logger
 logger = logging.getLogger(__file__)
 logger.setLevel(logging.DEBUG)
 
-# create console handler and set level to debug
-sh = logging.StreamHandler()
-sh.setLevel(logging.DEBUG)
 
-# create formatter
-fmt = logging.Formatter('"%(pathname)s", line %(lineno)s --- %(message)s')
+def setup_logging():
+    # handlers are only created by the entry point, not on import
+    if logger.handlers:
+        return
 
-# add formatter to sh
-sh.setFormatter(fmt)
+    # create console handler and set level to debug
+    sh = logging.StreamHandler()
+    sh.setLevel(logging.DEBUG)
+
+    # create formatter
+    fmt = logging.Formatter('"%(pathname)s", line %(lineno)s --- %(message)s')
+
+    # add formatter to sh
+    sh.setFormatter(fmt)
+
+    # add sh to logger
+    logger.addHandler(sh)
 
-# add sh to logger
-logger.addHandler(sh)
 
 # Tester TX ID
 TX_ID = 0x72b
@@ -39,18 +47,141 @@ FN_ID = 0x7df
 
 N_Bs = 75  # 75ms
 N_Cr = 150  # 150ms
+# P2* server max, how long a pending (NRC 0x78) response may take
+P2_STAR = 5.0
+# added to the ECU timeouts when waiting for an open transfer to end
+RESET_MARGIN = 0.02
+
+# Tester TX_DL, 8 for classic CAN, up to 64 for CAN FD
+TX_DL = 8
+IS_FD = TX_DL > 8
+DATA_BITRATE = 2000000
+
+# First frame data lengths of segmented requests needing one and two Consecutive frames
+FF_DL_1CF = isotp.first_frame_capacity(0, TX_DL) + 3
+FF_DL_2CF = isotp.first_frame_capacity(0, TX_DL) + TX_DL - 1 + 2
+
+
+def configure(tx_id=None, rx_id=None, fn_id=None):
+    # e.g. with an entry of the address map written by uds.discovery
+    global TX_ID, RX_ID, FN_ID
+    if tx_id is not None:
+        TX_ID = tx_id
+    if rx_id is not None:
+        RX_ID = rx_id
+    if fn_id is not None:
+        FN_ID = fn_id
+
+
+def now() -> float:
+    # the event loop's clock, simulated time when running on uds.sim, and
+    # the same monotonic clock without a running loop, e.g. in isotp_fuzz
+    try:
+        return asyncio.get_running_loop().time()
+    except RuntimeError:
+        return time.monotonic()
+
+
+def sf(*data) -> bytes:
+    frame = isotp.encode_single_frame(bytes(data), escape=len(data) > 7)
+    return isotp.pad(frame, max(8, isotp.frame_length(len(frame))))
+
+
+def ff(length, *data) -> bytes:
+    return isotp.pad(isotp.encode_first_frame(length, bytes(data)), TX_DL)
+
+
+def cf(sequence_number, *data) -> bytes:
+    return isotp.pad(isotp.encode_consecutive_frame(sequence_number, bytes(data)), TX_DL)
+
+
+def fc(flow_status, block_size=0, stmin=0x14) -> bytes:
+    return isotp.pad(isotp.encode_flow_control(flow_status, block_size, stmin))
+
+
+def cf_count(first_frame: bytes) -> int:
+    # the ECU's TX_DL is given by the length of its First frame
+    return isotp.consecutive_frame_count(isotp.first_frame_length(first_frame), len(first_frame))
+
+
+class EcuState(object):
+    # What the ECU is busy with, as far as the frames seen by the tester tell
+
+    def __init__(self):
+        self.prefix_len = 0
+        self.session = 1
+        # bytes of a segmented request the ECU still waits for
+        self.rx_remaining = 0
+        # bytes of a segmented response the ECU still has to send
+        self.tx_remaining = 0
+        # a response pending (NRC 0x78) is not final
+        self.pending = False
+        self.last_activity = 0
+        self.reset_costs = []
+
+    @property
+    def busy(self) -> bool:
+        return self.rx_remaining > 0 or self.tx_remaining > 0 or self.pending
+
+    def _segment(self, frame: bytes):
+        pci = isotp.pci_type(frame)
+        if pci == isotp.PCIType.FirstFrame and len(frame) >= 2:
+            header = 2 if frame[0] & 0x0F or frame[1] else 6
+            return pci, isotp.first_frame_length(frame) - len(frame[header:])
+        return pci, len(frame) - 1
+
+    def sent(self, data: bytes):
+        frame = bytes(data[self.prefix_len:])
+        if not frame:
+            return
+        self.last_activity = now()
+        pci, size = self._segment(frame)
+        if pci == isotp.PCIType.FirstFrame:
+            self.rx_remaining = size
+        elif pci == isotp.PCIType.ConsecutiveFrame and self.rx_remaining > 0:
+            self.rx_remaining -= size
+        elif pci == isotp.PCIType.SingleFrame:
+            # a new request replaces one that is still being received
+            self.rx_remaining = 0
+        elif pci == isotp.PCIType.FlowControl and frame[0] & 0x0F == isotp.FlowStatus.Overflow:
+            self.tx_remaining = 0
+
+    def received(self, data: bytes):
+        frame = bytes(data[self.prefix_len:])
+        if not frame:
+            return
+        self.last_activity = now()
+        pci, size = self._segment(frame)
+        if pci == isotp.PCIType.FirstFrame:
+            self.tx_remaining = size
+        elif pci == isotp.PCIType.ConsecutiveFrame and self.tx_remaining > 0:
+            self.tx_remaining -= size
+        elif pci == isotp.PCIType.SingleFrame and len(frame) >= 3:
+            self.tx_remaining = 0
+            self.pending = frame[1] == 0x7F and len(frame) >= 4 and frame[3] == 0x78
+            if frame[1] == 0x50:
+                self.session = frame[2] & 0x7F
+            elif frame[1] == 0x51:
+                self.session = 1
+
+
+ecu_state = EcuState()
 
 
 def send_can_msg(bus: BusABC, arb_id: int, data: bytes):
     msg = Message(arbitration_id=arb_id, dlc=len(data),
-                  is_extended_id=False, data=bytes(data))
+                  is_extended_id=arb_id > 0x7FF, is_fd=IS_FD, bitrate_switch=IS_FD, data=bytes(data))
     bus.send(msg)
+    if arb_id in (TX_ID, FN_ID):
+        ecu_state.sent(msg.data)
 
 
 async def recv_can_msg(bus: BusABC, arb_id, data_only=True) -> bytes:
     await asyncio.sleep(0.01)
     for _ in range(20):
         msg: Message = bus.recv(timeout=0.01)
+        if msg is not None and msg.arbitration_id == RX_ID:
+            ecu_state.received(msg.data)
         if msg is not None and msg.arbitration_id == arb_id:
             if data_only:
                 return msg.data
@@ -58,17 +189,58 @@ async def recv_can_msg(bus: BusABC, arb_id, data_only=True) -> bytes:
                 return msg
 
 
+async def reset_state(bus: BusABC, session=1) -> float:
+    # Bring the ECU back to idle and to the given session, only waiting for
+    # what is actually open. Returns the time it took.
+    t1 = now()
+
+    # an open transfer ends with its last frame or with the ECU's N_Cr / N_Bs
+    # timeout after the last activity, every frame received restarts it
+    while ecu_state.busy:
+        if ecu_state.pending:
+            timeout = P2_STAR
+        else:
+            # the ECU waits N_Cr for our next CF or N_Bs for our FC
+            timeout = (N_Cr if ecu_state.rx_remaining > 0 else N_Bs) / 1000
+        remaining = ecu_state.last_activity + timeout + RESET_MARGIN - now()
+        if remaining <= 0:
+            ecu_state.rx_remaining = ecu_state.tx_remaining = 0
+            ecu_state.pending = False
+            break
+        msg = bus.recv(timeout=remaining)
+        if msg is not None and msg.arbitration_id == RX_ID:
+            ecu_state.received(msg.data)
+        await asyncio.sleep(0)
+
+    # late responses of the previous case
+    while True:
+        msg = bus.recv(timeout=0)
+        if msg is None:
+            break
+        if msg.arbitration_id == RX_ID:
+            ecu_state.received(msg.data)
+
+    if ecu_state.session != session:
+        send_can_msg(bus, TX_ID, sf(0x10, session))
+        response = await recv_can_msg(bus, RX_ID)
+        assert response is not None and response[1] == 0x50 and response[2] == session
+
+    t2 = now()
+    ecu_state.reset_costs.append(t2 - t1)
+    return t2 - t1
+
+
 async def tp_test_7_1(bus: BusABC):
     # 7.1
     # Tester sends a request that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x10, 0x0f, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_2CF, 0x22))
     # after the ECU Flow control
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
     logger.debug([f'0x{i:02x}' for i in response])
-    send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, cf(1))
     # Abort the transmission
-    ## send_can_msg(bus, TX_ID, [0x22, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    ## send_can_msg(bus, TX_ID, cf(2))
     # No response is expected
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
@@ -77,14 +249,14 @@ async def tp_test_7_1(bus: BusABC):
 async def tp_test_7_2(bus: BusABC):
     # 7.2
     # Tester sends a request that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x10, 0x0f, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_2CF, 0x22))
     # after the ECU Flow control
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
     logger.debug([f'0x{i:02x}' for i in response])
     # Do not send any consecutive frames (CF)
-    ## send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
-    ## send_can_msg(bus, TX_ID, [0x22, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    ## send_can_msg(bus, TX_ID, cf(1))
+    ## send_can_msg(bus, TX_ID, cf(2))
     # No response is expected
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
@@ -93,14 +265,14 @@ async def tp_test_7_2(bus: BusABC):
 async def tp_test_7_3(bus: BusABC):
     # 7.3
     # Tester sends a request that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x10, 0x0f, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_2CF, 0x22))
     # after the ECU Flow control
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
     logger.debug([f'0x{i:02x}' for i in response])
     # Drop the first consecutive frame (CF)
-    ## send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
-    send_can_msg(bus, TX_ID, [0x22, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    ## send_can_msg(bus, TX_ID, cf(1))
+    send_can_msg(bus, TX_ID, cf(2))
     # No response is expected
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
@@ -109,15 +281,15 @@ async def tp_test_7_3(bus: BusABC):
 async def tp_test_7_4(bus: BusABC):
     # 7.4
     # Tester sends a request that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x10, 0x0f, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_2CF, 0x22))
     # after the ECU Flow control
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
     logger.debug([f'0x{i:02x}' for i in response])
     # Send the first consecutive frame (CF) twice
-    send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
-    send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
-    send_can_msg(bus, TX_ID, [0x22, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, cf(1))
+    send_can_msg(bus, TX_ID, cf(1))
+    send_can_msg(bus, TX_ID, cf(2))
     # No response is expected
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
@@ -126,14 +298,14 @@ async def tp_test_7_4(bus: BusABC):
 async def tp_test_7_5(bus: BusABC):
     # 7.5
     # Tester sends a request that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x10, 0x09, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_1CF, 0x22))
     # after the ECU Flow control
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
     logger.debug([f'0x{i:02x}' for i in response])
     # Delay the first consecutive frame by Timeout Cr + 100ms
     await asyncio.sleep((N_Cr + 100) / 1000)
-    send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, cf(1))
     # No response is expected
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
@@ -142,13 +314,13 @@ async def tp_test_7_5(bus: BusABC):
 async def tp_test_7_6(bus: BusABC):
     # 7.6
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     # After the First frame is received
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
     # The Tester does not send a Flow Control
-    ## send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    ## send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     # ECU must not send a response
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
@@ -157,14 +329,14 @@ async def tp_test_7_6(bus: BusABC):
 async def tp_test_7_7(bus: BusABC):
     # 7.7
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     # After the First frame is received
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
     # The Tester delays a Flow Control
     await asyncio.sleep((N_Bs + 100) / 1000)
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     # The ECU has to cancel the response
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
@@ -173,37 +345,35 @@ async def tp_test_7_7(bus: BusABC):
 async def tp_test_7_8(bus: BusABC):
     # 7.8
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     # After the First frame is received
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
-    data_len = (response[0] & 0xf) << 8 | response[1]
-    data_len -= 6  # first frame contains 6 bytes data
+    count = cf_count(response)
     # Tester sends two Flow Controls (FC)
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     # The ECU should send a response
-    count = (data_len + 7 - 1) // 7
     for i in range(count):
         response = await recv_can_msg(bus, RX_ID)
-        assert response is not None and response[0] == 0x20 + (1 + i) % 0x10
+        assert response is not None and response[0] == cf(1 + i)[0]
         logger.debug([f'0x{i:02x}' for i in response])
 
 
 async def tp_test_7_9(bus: BusABC):
     # 7.9
     # Tester sends a request that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x10, 0x09, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
-    t1 = time.time()
+    send_can_msg(bus, TX_ID, ff(FF_DL_1CF, 0x22))
+    t1 = now()
     # after the ECU Flow control
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
-    t2 = time.time()
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
+    t2 = now()
     # check if the Flow control frame from ECU is received within Timeout Bs.
     assert (t2 - t1) * 1000 < N_Bs
     logger.debug([f'0x{i:02x}' for i in response])
-    send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, cf(1))
     response = await recv_can_msg(bus, RX_ID)
     assert response is not None and response[1] == 0x7f and response[2] == 0x22
     logger.debug([f'0x{i:02x}' for i in response])
@@ -212,22 +382,20 @@ async def tp_test_7_9(bus: BusABC):
 async def tp_test_7_10(bus: BusABC):
     # 7.10
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     # After the First frame is received
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
-    data_len = (response[0] & 0xf) << 8 | response[1]
-    data_len -= 6  # first frame contains 6 bytes data
+    count = cf_count(response)
     # Tester verifies that every Consecutive frame is received within TimeoutCr.
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
-    count = (data_len + 7 - 1) // 7
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     for i in range(count):
-        t1 = time.time()
+        t1 = now()
         response = await recv_can_msg(bus, RX_ID)
-        t2 = time.time()
+        t2 = now()
         assert (t2 - t1) * 1000 < N_Cr
-        assert response is not None and response[0] == 0x20 + (1 + i) % 0x10
+        assert response is not None and response[0] == cf(1 + i)[0]
         logger.debug([f'0x{i:02x}' for i in response])
 
 
@@ -236,24 +404,20 @@ async def tp_test_7_11(bus: BusABC):
     STMin_values = [1, 10, 20, 30, 40, 50, 60]
     for STmin in STMin_values:
         # Tester sends a request with a response that is longer than one frame
-        send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00,
-                                  0x00, 0x00, 0x00, 0x00])
+        send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
         # After the First frame is received
         response = await recv_can_msg(bus, RX_ID)
-        assert response is not None and response[0] & 0xf0 == 0x10
+        assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
         logger.debug([f'0x{i:02x}' for i in response])
-        data_len = (response[0] & 0xf) << 8 | response[1]
-        data_len -= 6  # first frame contains 6 bytes data
+        count = cf_count(response)
         # Tester verifies that the time between the Consecutive Frames is not below STMin time. This is tested for STMin values
         timestamps = []
-        send_can_msg(bus, TX_ID, [0x30, 0x00, STmin,
-                                  0x00, 0x00, 0x00, 0x00, 0x00])
-        count = (data_len + 7 - 1) // 7
+        send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend, 0, STmin))
         for i in range(count):
             response = await recv_can_msg(bus, RX_ID, False)
             timestamps.append(response.timestamp)
             assert response is not None and \
-                response.data[0] == 0x20 + (1 + i) % 0x10
+                response.data[0] == cf(1 + i)[0]
             logger.debug([f'0x{i:02x}' for i in response.data])
 
         ts1 = timestamps[:-1]
@@ -267,9 +431,9 @@ async def tp_test_7_11(bus: BusABC):
 async def tp_test_7_12(bus: BusABC):
     # 7.12
     # Tester sends a segmented request to check for a valid STMin time in the ECU Flow control
-    send_can_msg(bus, TX_ID, [0x10, 0x09, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_1CF, 0x22))
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
     logger.debug([f'0x{i:02x}' for i in response])
     STMin = response[2]
     # The STMin time value must be within 0x00-0x7F or 0xF1-0xF9.
@@ -279,54 +443,51 @@ async def tp_test_7_12(bus: BusABC):
 async def tp_test_7_13(bus: BusABC):
     # 7.13
     # Tester sends a request with a Single frame response.
-    send_can_msg(bus, TX_ID, [0x02, 0x10, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x10, 0x01))
     # After response is received
     response = await recv_can_msg(bus, RX_ID)
     assert response is not None and response[1] == 0x50 and response[2] == 0x01
     logger.debug([f'0x{i:02x}' for i in response])
-    data_len = (response[0] & 0xf)
+    data_len = isotp.single_frame_length(response)
     # check that the datalength of the Single frame is within valid range.
-    assert data_len < 8
+    assert data_len <= isotp.single_frame_capacity(len(response))
 
 
 async def tp_test_7_14(bus: BusABC):
     # 7.14
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     # After the First frame is received
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
-    data_len = (response[0] & 0xf) << 8 | response[1]
+    data_len = isotp.first_frame_length(response)
     # check that the datalength of the First frame is within valid range.
-    assert data_len >= 8
-    data_len -= 6  # first frame contains 6 bytes data
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
-    count = (data_len + 7 - 1) // 7
+    assert data_len > isotp.single_frame_capacity(len(response))
+    count = cf_count(response)
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     for i in range(count):
         response = await recv_can_msg(bus, RX_ID)
-        assert response is not None and response[0] == 0x20 + (1 + i) % 0x10
+        assert response is not None and response[0] == cf(1 + i)[0]
         logger.debug([f'0x{i:02x}' for i in response])
 
 
 async def tp_test_7_15(bus: BusABC):
     # 7.15
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
-    data_len = (response[0] & 0xf) << 8 | response[1]
-    data_len -= 6  # first frame contains 6 bytes data
+    count = cf_count(response)
     # After the Flow control
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     # the Tester sends a second diagnostic request.
-    send_can_msg(bus, TX_ID, [0x02, 0x10, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x10, 0x01))
     # ECU must send a diagnostic response for the first request
-    count = (data_len + 7 - 1) // 7
     for i in range(count):
         response = await recv_can_msg(bus, RX_ID)
-        assert response is not None and response[0] == 0x20 + (1 + i) % 0x10
+        assert response is not None and response[0] == cf(1 + i)[0]
         logger.debug([f'0x{i:02x}' for i in response])
     # and must ignore the second request.
     response = await recv_can_msg(bus, RX_ID)
@@ -336,21 +497,19 @@ async def tp_test_7_15(bus: BusABC):
 async def tp_test_7_16(bus: BusABC):
     # 7.16
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
-    data_len = (response[0] & 0xf) << 8 | response[1]
-    data_len -= 6  # first frame contains 6 bytes data
+    count = cf_count(response)
     # After sending a Flow Control
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     # the Tester sends the First frame of a another incomplete request
-    send_can_msg(bus, TX_ID, [0x10, 0x09, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_1CF, 0x22))
     # ECU must send a diagnostic response for the first request
-    count = (data_len + 7 - 1) // 7
     for i in range(count):
         response = await recv_can_msg(bus, RX_ID)
-        assert response is not None and response[0] == 0x20 + (1 + i) % 0x10
+        assert response is not None and response[0] == cf(1 + i)[0]
         logger.debug([f'0x{i:02x}' for i in response])
     # ECU must not send a response for the First frame
     response = await recv_can_msg(bus, RX_ID)
@@ -360,20 +519,18 @@ async def tp_test_7_16(bus: BusABC):
 async def tp_test_7_17(bus: BusABC):
     # 7.17
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
-    data_len = (response[0] & 0xf) << 8 | response[1]
-    data_len -= 6  # first frame contains 6 bytes data
+    count = cf_count(response)
     # After the Flow control
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     # the Tester sends a Consecutive frame.
-    send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
-    count = (data_len + 7 - 1) // 7
+    send_can_msg(bus, TX_ID, cf(1))
     for i in range(count):
         response = await recv_can_msg(bus, RX_ID)
-        assert response is not None and response[0] == 0x20 + (1 + i) % 0x10
+        assert response is not None and response[0] == cf(1 + i)[0]
         logger.debug([f'0x{i:02x}' for i in response])
     # ECU must not send a response for the Consecutive frame
     response = await recv_can_msg(bus, RX_ID)
@@ -383,24 +540,23 @@ async def tp_test_7_17(bus: BusABC):
 async def tp_test_7_18(bus: BusABC):
     # 7.18
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
-    data_len = (response[0] & 0xf) << 8 | response[1]
-    data_len -= 6  # first frame contains 6 bytes data
+    count = cf_count(response)
     # After sending the Flow control
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     # the Tester receives the first Consecutive frame
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] == 0x21
+    assert response is not None and response[0] == cf(1)[0]
     # and sends another Flow control with status overflow (OVFLW)
-    send_can_msg(bus, TX_ID, [0x32, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.Overflow))
     # ECU must send a diagnostic response for the first request
-    count = (data_len + 7 - 1) // 7 - 1
+    count -= 1
     for i in range(count):
         response = await recv_can_msg(bus, RX_ID)
-        assert response is not None and response[0] == 0x20 + (2 + i) % 0x10
+        assert response is not None and response[0] == cf(2 + i)[0]
         logger.debug([f'0x{i:02x}' for i in response])
     # ECU must not send a response for the Flow control.
     response = await recv_can_msg(bus, RX_ID)
@@ -410,24 +566,23 @@ async def tp_test_7_18(bus: BusABC):
 async def tp_test_7_19(bus: BusABC):
     # 7.19
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
-    data_len = (response[0] & 0xf) << 8 | response[1]
-    data_len -= 6  # first frame contains 6 bytes data
+    count = cf_count(response)
     # After sending the Flow control
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     # the Tester receives the first Consecutive frame
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] == 0x21
+    assert response is not None and response[0] == cf(1)[0]
     # and sends an unknown frame
     send_can_msg(bus, TX_ID, [0x40, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
     # ECU must send a diagnostic response for the first request
-    count = (data_len + 7 - 1) // 7 - 1
+    count -= 1
     for i in range(count):
         response = await recv_can_msg(bus, RX_ID)
-        assert response is not None and response[0] == 0x20 + (2 + i) % 0x10
+        assert response is not None and response[0] == cf(2 + i)[0]
         logger.debug([f'0x{i:02x}' for i in response])
     # ECU must not send a response for the unknown frame
     response = await recv_can_msg(bus, RX_ID)
@@ -437,13 +592,13 @@ async def tp_test_7_19(bus: BusABC):
 async def tp_test_7_20(bus: BusABC):
     # 7.20
     # Tester sends a request that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x10, 0x09, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_1CF, 0x22))
     # after the ECU Flow control
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
     logger.debug([f'0x{i:02x}' for i in response])
     # Tester sends a segmented request interrupted by a Single frame
-    send_can_msg(bus, TX_ID, [0x02, 0x10, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x10, 0x01))
     # The ECU must send a response for the second request.
     response = await recv_can_msg(bus, RX_ID)
     assert response is not None and response[1] == 0x50 and response[2] == 0x01
@@ -453,17 +608,17 @@ async def tp_test_7_20(bus: BusABC):
 async def tp_test_7_21(bus: BusABC):
     # 7.21
     # Tester sends a request that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x10, 0x09, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_1CF, 0x22))
     # after the ECU Flow control
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
     logger.debug([f'0x{i:02x}' for i in response])
     # Tester sends a First frame of a segmented request.
-    send_can_msg(bus, TX_ID, [0x10, 0x09, 0x23, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_1CF, 0x23))
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
     logger.debug([f'0x{i:02x}' for i in response])
-    send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, cf(1))
     # The ECU must send a response for the second request.
     response = await recv_can_msg(bus, RX_ID)
     assert response is not None and response[1] == 0x7f and response[2] == 0x23
@@ -473,15 +628,15 @@ async def tp_test_7_21(bus: BusABC):
 async def tp_test_7_22(bus: BusABC):
     # 7.22
     # Tester sends a request that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x10, 0x09, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_1CF, 0x22))
     # after the ECU Flow control
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
     logger.debug([f'0x{i:02x}' for i in response])
     # Tester sends a segmented request interrupted by a Flow control
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     # After that the Tester sends the remaining consecutive frames
-    send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, cf(1))
     # ECU should send a diagnostic response for the request
     response = await recv_can_msg(bus, RX_ID)
     assert response is not None and response[1] == 0x7f and response[2] == 0x22
@@ -491,15 +646,15 @@ async def tp_test_7_22(bus: BusABC):
 async def tp_test_7_23(bus: BusABC):
     # 7.23
     # Tester sends a request that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x10, 0x09, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_1CF, 0x22))
     # after the ECU Flow control
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
     logger.debug([f'0x{i:02x}' for i in response])
     # Tester sends a segmented request interrupted by a unknown frame
     send_can_msg(bus, TX_ID, [0x40, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
     # After that the Tester sends the remaining consecutive frames
-    send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, cf(1))
     # ECU should send a diagnostic response for the request
     response = await recv_can_msg(bus, RX_ID)
     assert response is not None and response[1] == 0x7f and response[2] == 0x22
@@ -509,12 +664,12 @@ async def tp_test_7_23(bus: BusABC):
 async def tp_test_7_24(bus: BusABC):
     # 7.24
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
     # Tester sends a Flow control with status overflow
-    send_can_msg(bus, TX_ID, [0x32, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.Overflow))
     # ECU must not send Consecutive frame(s).
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
@@ -523,19 +678,17 @@ async def tp_test_7_24(bus: BusABC):
 async def tp_test_7_25(bus: BusABC):
     # 7.25
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
-    data_len = (response[0] & 0xf) << 8 | response[1]
-    data_len -= 6  # first frame contains 6 bytes data
     # Tester sends a Flow control with a special Blocksize
     BS = 0x01  # BS can be modified larger if the response is long enough
-    send_can_msg(bus, TX_ID, [0x30, BS, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend, BS))
     # ECU must send the number of Consecutive frames that matches the blocksize.
     for i in range(BS):
         response = await recv_can_msg(bus, RX_ID)
-        assert response is not None and response[0] == 0x20 + (1 + i) % 0x10
+        assert response is not None and response[0] == cf(1 + i)[0]
         logger.debug([f'0x{i:02x}' for i in response])
     # BS count of CF is received above, so recve nothing
     response = await recv_can_msg(bus, RX_ID)
@@ -545,19 +698,17 @@ async def tp_test_7_25(bus: BusABC):
 async def tp_test_7_26(bus: BusABC):
     # 7.26
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
-    data_len = (response[0] & 0xf) << 8 | response[1]
-    data_len -= 6  # first frame contains 6 bytes data
+    count = cf_count(response)
     # Tester sends a Flow control with Blocksize 0
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     # ECU must send the complete response.
-    count = (data_len + 7 - 1) // 7
     for i in range(count):
         response = await recv_can_msg(bus, RX_ID)
-        assert response is not None and response[0] == 0x20 + (1 + i) % 0x10
+        assert response is not None and response[0] == cf(1 + i)[0]
         logger.debug([f'0x{i:02x}' for i in response])
 
 
@@ -565,14 +716,12 @@ async def tp_test_7_27(bus: BusABC):
     # 7.27
     for sts in range(3, 16):
         # Tester sends a request with a response that is longer than one frame
-        send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A,
-                                  0x00, 0x00, 0x00, 0x00, 0x00])
+        send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
         response = await recv_can_msg(bus, RX_ID)
-        assert response is not None and response[0] & 0xf0 == 0x10
+        assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
         logger.debug([f'0x{i:02x}' for i in response])
         # Tester sends a Flow control with an invalid Status value (3-15)
-        send_can_msg(bus, TX_ID, [0x30 + sts, 0x00,
-                                  0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+        send_can_msg(bus, TX_ID, fc(sts))
         # ECU must not send a response.
         response = await recv_can_msg(bus, RX_ID)
         assert response is None
@@ -581,20 +730,20 @@ async def tp_test_7_27(bus: BusABC):
 async def tp_test_7_28(bus: BusABC):
     # 7.28
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
     # Tester sends a Flow control with Status value wait (WT)
-    send_can_msg(bus, TX_ID, [0x31, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.Wait))
     # ECU must not send Consecutive frames
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
     await asyncio.sleep((N_Bs + 100) / 1000)  # make N_Bs timeout
     # After the N_Bs Timeout the Tester sends another Flow control with status continue to send (CTS).
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     # Then the tester sends a new request.
-    send_can_msg(bus, TX_ID, [0x02, 0x10, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x10, 0x01))
     # ECU must send a response for the last request.
     response = await recv_can_msg(bus, RX_ID)
     assert response is not None and response[1] == 0x50 and response[2] == 0x01
@@ -604,9 +753,9 @@ async def tp_test_7_28(bus: BusABC):
 async def tp_test_7_29(bus: BusABC):
     # 7.29
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
     # Tester sends a Flow control with a too short CAN-DLC
     send_can_msg(bus, TX_ID, [0x30, 0x00])
@@ -614,7 +763,7 @@ async def tp_test_7_29(bus: BusABC):
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
     # After that the tester sends a new request
-    send_can_msg(bus, TX_ID, [0x02, 0x10, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x10, 0x01))
     # ECU must send a response for the last request
     response = await recv_can_msg(bus, RX_ID)
     assert response is not None and response[1] == 0x50 and response[2] == 0x01
@@ -624,13 +773,13 @@ async def tp_test_7_29(bus: BusABC):
 async def tp_test_7_30(bus: BusABC):
     # 7.30
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x02, 0x19, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, sf(0x19, 0x0A))
     # After the First frame is received
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x10
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FirstFrame
     logger.debug([f'0x{i:02x}' for i in response])
     # the Tester sends a functional adressed Flow control
-    send_can_msg(bus, FN_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, FN_ID, fc(isotp.FlowStatus.ContinueToSend))
     # ECU must abort sending of the response.
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
@@ -670,10 +819,10 @@ async def tp_test_7_33(bus: BusABC):
 async def tp_test_7_34(bus: BusABC):
     # 7.34
     # Tester sends a request with a response that is longer than one frame
-    send_can_msg(bus, TX_ID, [0x10, 0x09, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_1CF, 0x22))
     # after the ECU Flow control
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
     logger.debug([f'0x{i:02x}' for i in response])
     # Tester sends a Consecutive frame with a CAN-DLC shorter or equal to transport protocol data length field
     send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00])
@@ -694,7 +843,7 @@ async def tp_test_7_35(bus: BusABC):
 async def tp_test_7_36(bus: BusABC):
     # 7.36
     # Tester sends a functional adressed First frame
-    send_can_msg(bus, FN_ID, [0x10, 0x09, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, FN_ID, ff(FF_DL_1CF, 0x22))
     # ECU must not send a response.
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
@@ -704,14 +853,14 @@ async def tp_test_7_37(bus: BusABC):
     # same as 7.2???
     # 7.37
     # Tester sends a incomplete diagnostic request with a First frame
-    send_can_msg(bus, TX_ID, [0x10, 0x0f, 0x22, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, ff(FF_DL_2CF, 0x22))
     # after the ECU Flow control
     response = await recv_can_msg(bus, RX_ID)
-    assert response is not None and response[0] & 0xf0 == 0x30
+    assert response is not None and isotp.pci_type(response) == isotp.PCIType.FlowControl
     logger.debug([f'0x{i:02x}' for i in response])
     # without Consecutive frames.
-    ## send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
-    ## send_can_msg(bus, TX_ID, [0x22, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    ## send_can_msg(bus, TX_ID, cf(1))
+    ## send_can_msg(bus, TX_ID, cf(2))
     # ECU must not send a diagnostic response.
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
@@ -720,7 +869,7 @@ async def tp_test_7_37(bus: BusABC):
 async def tp_test_7_38(bus: BusABC):
     # 7.38
     # Tester sends a single Consecutive frame
-    send_can_msg(bus, TX_ID, [0x21, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, cf(1))
     # ECU must not send a response.
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
@@ -729,62 +878,70 @@ async def tp_test_7_38(bus: BusABC):
 async def tp_test_7_39(bus: BusABC):
     # 7.39
     # Tester sends a single Flow Control
-    send_can_msg(bus, TX_ID, [0x30, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00, 0x00])
+    send_can_msg(bus, TX_ID, fc(isotp.FlowStatus.ContinueToSend))
     # ECU must not send a response.
     response = await recv_can_msg(bus, RX_ID)
     assert response is None
 
 
+TESTS = [
+    tp_test_7_1,
+    tp_test_7_2,
+    tp_test_7_3,
+    tp_test_7_4,
+    tp_test_7_5,
+    tp_test_7_6,
+    tp_test_7_7,
+    tp_test_7_8,
+    tp_test_7_9,
+    tp_test_7_10,
+    tp_test_7_11,
+    tp_test_7_12,
+    tp_test_7_13,
+    tp_test_7_14,
+    tp_test_7_15,
+    tp_test_7_16,
+    tp_test_7_17,
+    tp_test_7_18,
+    tp_test_7_19,
+    tp_test_7_20,
+    tp_test_7_21,
+    tp_test_7_22,
+    tp_test_7_23,
+    tp_test_7_24,
+    tp_test_7_25,
+    tp_test_7_26,
+    tp_test_7_27,
+    tp_test_7_28,
+    tp_test_7_29,
+    tp_test_7_30,
+    tp_test_7_31,
+    tp_test_7_32,
+    tp_test_7_33,
+    tp_test_7_34,
+    tp_test_7_35,
+    tp_test_7_36,
+    tp_test_7_37,
+    tp_test_7_38,
+    tp_test_7_39,
+]
+
+
 async def tp_test(bus: BusABC):
 
-    tests = [
-        tp_test_7_1,
-        tp_test_7_2,
-        tp_test_7_3,
-        tp_test_7_4,
-        tp_test_7_5,
-        tp_test_7_6,
-        tp_test_7_7,
-        tp_test_7_8,
-        tp_test_7_9,
-        tp_test_7_10,
-        tp_test_7_11,
-        tp_test_7_12,
-        tp_test_7_13,
-        tp_test_7_14,
-        tp_test_7_15,
-        tp_test_7_16,
-        tp_test_7_17,
-        tp_test_7_18,
-        tp_test_7_19,
-        tp_test_7_20,
-        tp_test_7_21,
-        tp_test_7_22,
-        tp_test_7_23,
-        tp_test_7_24,
-        tp_test_7_25,
-        tp_test_7_26,
-        tp_test_7_27,
-        tp_test_7_28,
-        tp_test_7_29,
-        tp_test_7_30,
-        tp_test_7_31,
-        tp_test_7_32,
-        tp_test_7_33,
-        tp_test_7_34,
-        tp_test_7_35,
-        tp_test_7_36,
-        tp_test_7_37,
-        tp_test_7_38,
-        tp_test_7_39,
-    ]
-
-    for test in tests:
+    for test in TESTS:
+        cost = await reset_state(bus)
+        logger.debug(f'{test.__name__} reset in {cost * 1000:.1f}ms')
         await test(bus)
 
+    costs = ecu_state.reset_costs
+    logger.debug(f'{len(costs)} resets, {sum(costs):.2f}s in total, {max(costs) * 1000:.1f}ms max')
+
 
 if __name__ == '__main__':
 
+    setup_logging()
+
     bus_config = {
         'interface': 'vector',
         # 'interface': 'canalystii',
@@ -795,11 +952,14 @@ if __name__ == '__main__':
         ]
     }
 
-    bus = can.interface.Bus(**bus_config)
+    if IS_FD:
+        bus_config['fd'] = True
+        bus_config['data_bitrate'] = DATA_BITRATE
+
+    bus = open_bus(**bus_config)
 
     # send something to start
-    bus.send(Message(arbitration_id=0))
-    bus.recv(0.5)
+    wait_bus_ready(bus)
     #######################################################
 
     t1 = time.time()
@@ -0,0 +1,284 @@
+import sys
+import time
+import asyncio
+import fnmatch
+import functools
+import contextlib
+import argparse
+import multiprocessing
+
+from uds.bus import open_bus, wait_bus_ready
+import isotp_test
+import isotp_cases
+import diag_test
+from isotp_test import logger
+
+
+# extra tags, test name patterns per tag
+TAGS = {
+    'reset': ['diag.*.0x11'],
+    'security': ['diag.*.0x27'],
+    'write': ['diag.*.0x2e', 'diag.*.0x31'],
+    'dtc': ['diag.*.0x14', 'diag.*.0x19', 'diag.*.0x85'],
+}
+# tags of tests only run when selected by tag or name, e.g. -t cases
+OPT_IN_TAGS = {'cases'}
+
+
+class TestCase(object):
+
+    def __init__(self, name, func, kind, tags):
+        # kind is 'bus' for tests driving the bus directly, 'physical' or
+        # 'functional' for tests taking a Client
+        self.name = name
+        self.func = func
+        self.kind = kind
+        self.tags = set(tags)
+
+    def __repr__(self):
+        return 'TestCase(%r)' % self.name
+
+
+def collect():
+    tests = []
+    for func in isotp_test.TESTS:
+        name = 'isotp.' + func.__name__[len('tp_test_'):]
+        tests.append(TestCase(name, func, 'bus', ['isotp']))
+    for kind, funcs in (('physical', diag_test.PHYSICAL_TESTS),
+                        ('functional', diag_test.FUNCTIONAL_TESTS)):
+        for func in funcs:
+            name = 'diag.%s.%s' % (kind, func.__name__[len('Test_'):])
+            tests.append(TestCase(name, func, kind, ['diag', kind]))
+    # the generated ISO-TP cases, several thousand of them
+    for case in isotp_cases.generate():
+        tests.append(TestCase('cases.' + case.name, functools.partial(isotp_cases.run_case, case=case),
+                              'bus', ['cases', case.scenario.name]))
+    for tag, patterns in TAGS.items():
+        for test in tests:
+            if any(fnmatch.fnmatchcase(test.name, pattern) for pattern in patterns):
+                test.tags.add(tag)
+    return tests
+
+
+def select(tests, patterns=(), tags=(), exclude_tags=()):
+    # a test is selected when it matches any pattern and carries any tag
+    selected = []
+    for test in tests:
+        if test.tags & OPT_IN_TAGS and not (patterns or test.tags & set(tags)):
+            continue
+        if patterns and not any(fnmatch.fnmatchcase(test.name, pattern) or pattern in test.name
+                                for pattern in patterns):
+            continue
+        if tags and not test.tags & set(tags):
+            continue
+        if test.tags & set(exclude_tags):
+            continue
+        selected.append(test)
+    return selected
+
+
+def shard(tests, count):
+    # round robin keeps the run order inside each shard
+    return [tests[i::count] for i in range(count)]
+
+
+async def run_tests(bus, tests, fail_fast=False):
+    from uds.client import Client
+    from uds.isotp import ISOTPNetwork
+
+    loop = asyncio.get_event_loop()
+    results = []
+    config = diag_test.make_config()
+    network = None
+    clients = {}
+
+    with contextlib.ExitStack() as stack:
+        for test in tests:
+            if test.kind == 'bus':
+                # the raw tests must not share received frames with the network
+                if network is not None:
+                    stack.close()
+                    network = None
+                    clients.clear()
+                # leave the ECU idle, waiting only for what the last test left open
+                cost = await isotp_test.reset_state(bus)
+                logger.debug(f'reset before {test.name} in {cost * 1000:.1f}ms')
+                args = (bus,)
+            else:
+                if network is None:
+                    network = ISOTPNetwork(bus=bus, tx_padding=0x00, tx_dl=diag_test.TX_DL,
+                                           is_fd=diag_test.IS_FD, bitrate_switch=diag_test.IS_FD)
+                    stack.enter_context(network.open())
+                if test.kind not in clients:
+                    tx_id = diag_test.TX_ID if test.kind == 'physical' else diag_test.FN_ID
+                    reader, writer = await network.open_connection(diag_test.RX_ID, tx_id)
+                    clients[test.kind] = Client(reader, writer, config)
+                args = (clients[test.kind],)
+
+            # the loop's clock, simulated time with --interface sim
+            t1 = loop.time()
+            try:
+                await test.func(*args)
+                error = None
+            except Exception as e:
+                error = '%s: %s' % (type(e).__name__, e)
+            t2 = loop.time()
+
+            results.append((test.name, error, t2 - t1))
+            if error is None:
+                logger.debug(f'PASS {test.name} ({t2 - t1:.2f}s)')
+            else:
+                logger.error(f'FAIL {test.name} ({t2 - t1:.2f}s) {error}')
+                if fail_fast:
+                    break
+
+    return results
+
+
+def run_shard(bus_config, address, names, repeat=1, fail_fast=False):
+    isotp_test.setup_logging()
+    tx_id, rx_id, fn_id = address
+    # both modules keep the addresses as module globals
+    isotp_test.configure(tx_id, rx_id, fn_id)
+    diag_test.configure(tx_id, rx_id, fn_id)
+
+    by_name = {test.name: test for test in collect()}
+    tests = [by_name[name] for name in names] * repeat
+
+    bus_config = dict(bus_config)
+    bus_config['can_filters'] = [{'can_id': isotp_test.RX_ID, 'can_mask': 0xffffffff}]
+    if bus_config['interface'] == 'sim':
+        # an in-process ECU on a virtual channel, timeouts take no wall time
+        from uds import sim
+        bus = sim.open_sim_bus(tx_id, rx_id, fn_id, bitrate=bus_config['bitrate'],
+                               data_bitrate=bus_config.get('data_bitrate', diag_test.DATA_BITRATE),
+                               can_filters=bus_config['can_filters'], key_function=diag_test.seed_to_key)
+        run = functools.partial(sim.run, clock=bus.clock)
+    else:
+        bus = open_bus(**bus_config)
+        run = asyncio.run
+    try:
+        wait_bus_ready(bus)
+        return run(run_tests(bus, tests, fail_fast))
+    finally:
+        bus.shutdown()
+
+
+def _run_shard(kwargs):
+    return run_shard(**kwargs)
+
+
+def parse_id(value):
+    return int(value, 16)
+
+
+def parse_channel(value):
+    # vector and kvaser number their channels, socketcan names them
+    return int(value) if value.isdigit() else value
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the ISO-TP and UDS conformance tests.')
+    parser.add_argument('patterns', nargs='*',
+                        help='test names, glob patterns or substrings, e.g. isotp.7_1* or 0x22')
+    parser.add_argument('-t', '--tag', action='append', default=[],
+                        help='run tests with this tag only, may be repeated')
+    parser.add_argument('-e', '--exclude-tag', action='append', default=[],
+                        help='skip tests with this tag, may be repeated')
+    parser.add_argument('-n', '--repeat', type=int, default=1,
+                        help='run the selection this many times')
+    parser.add_argument('-x', '--fail-fast', action='store_true',
+                        help='stop a shard at its first failure')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='list the selected tests and exit')
+
+    bus = parser.add_argument_group('bus')
+    bus.add_argument('--interface', default='vector',
+                     help="python-can interface, or 'sim' for the simulated ECU of uds.sim")
+    bus.add_argument('--channel', type=parse_channel, action='append',
+                     help='may be repeated, one shard per channel')
+    bus.add_argument('--bitrate', type=int, default=500000)
+    bus.add_argument('--data-bitrate', type=int, default=diag_test.DATA_BITRATE)
+
+    ecu = parser.add_argument_group('ECU')
+    ecu.add_argument('--tx-id', type=parse_id, default=isotp_test.TX_ID)
+    ecu.add_argument('--rx-id', type=parse_id, default=isotp_test.RX_ID)
+    ecu.add_argument('--fn-id', type=parse_id, default=isotp_test.FN_ID)
+    ecu.add_argument('--address-map',
+                     help='address map written by uds.discovery, one shard per ECU')
+    ecu.add_argument('--ecu', action='append',
+                     help='ECU name in the address map, may be repeated')
+    return parser.parse_args(argv)
+
+
+def make_shards(args):
+    if args.address_map:
+        from uds.discovery import load_address_map
+        address_map = load_address_map(args.address_map)
+        names = args.ecu or list(address_map)
+        addresses = [(address_map[name]['tx_id'], address_map[name]['rx_id'], args.fn_id)
+                     for name in names]
+    else:
+        addresses = [(args.tx_id, args.rx_id, args.fn_id)]
+
+    channels = args.channel or [0]
+    # several ECUs on one channel, one ECU on several channels or one per channel
+    count = max(len(addresses), len(channels))
+    shards = []
+    for i in range(count):
+        bus_config = {
+            'interface': args.interface,
+            'channel': channels[i % len(channels)],
+            'bitrate': args.bitrate,
+        }
+        if diag_test.IS_FD:
+            bus_config['fd'] = True
+            bus_config['data_bitrate'] = args.data_bitrate
+        shards.append((bus_config, addresses[i % len(addresses)]))
+    return shards
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    tests = select(collect(), args.patterns, args.tag, args.exclude_tag)
+
+    if args.list:
+        for test in tests:
+            print(f'{test.name:<28} {" ".join(sorted(test.tags))}')
+        return 0
+    if not tests:
+        print('no tests selected')
+        return 1
+
+    shards = make_shards(args)
+    jobs = [{
+        'bus_config': bus_config,
+        'address': address,
+        'names': [test.name for test in names],
+        'repeat': args.repeat,
+        'fail_fast': args.fail_fast,
+    } for (bus_config, address), names in zip(shards, shard(tests, len(shards))) if names]
+
+    t1 = time.time()
+    if len(jobs) == 1:
+        results = [run_shard(**jobs[0])]
+    else:
+        # one process per shard, the test modules keep their addresses in globals
+        with multiprocessing.Pool(len(jobs)) as pool:
+            results = pool.map(_run_shard, jobs)
+    t2 = time.time()
+
+    failed = [(name, error) for result in results for name, error, _ in result if error]
+    total = sum(len(result) for result in results)
+    for name, error in failed:
+        print(f'FAIL {name}: {error}')
+    summary = f'{total - len(failed)} passed, {len(failed)} failed in {t2 - t1:.2f}s'
+    if args.interface == 'sim':
+        simulated = sum(duration for result in results for _, _, duration in result)
+        summary += f' ({simulated:.2f}s simulated)'
+    print(summary)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
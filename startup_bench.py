@@ -0,0 +1,49 @@
+import sys
+import time
+import statistics
+import subprocess
+
+from uds.bus import open_bus, wait_bus_ready
+
+
+# modules a one-shot job starts from
+MODULES = ['diag_test', 'isotp_test', 'isotp_cases', 'isotp_fuzz', 'tester_daemon']
+# python-can interface that needs no hardware
+BUS_CONFIG = {
+    'interface': 'virtual',
+    'channel': 0,
+    'bitrate': 500000,
+}
+
+
+def time_import(module, repeat=10):
+    # a fresh interpreter for every run so nothing is cached in sys.modules
+    samples = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        subprocess.run([sys.executable, '-c', f'import {module}'], check=True)
+        t2 = time.perf_counter()
+        samples.append(t2 - t1)
+    return statistics.median(samples)
+
+
+def time_bus(bus_config=BUS_CONFIG, repeat=10):
+    samples = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        bus = open_bus(**bus_config)
+        wait_bus_ready(bus)
+        t2 = time.perf_counter()
+        bus.shutdown()
+        samples.append(t2 - t1)
+    return statistics.median(samples)
+
+
+if __name__ == '__main__':
+
+    baseline = time_import('sys')
+    print(f'{"interpreter":<16}{baseline * 1000:8.1f} ms')
+    for module in MODULES:
+        elapsed = time_import(module)
+        print(f'{module:<16}{elapsed * 1000:8.1f} ms  (+{(elapsed - baseline) * 1000:.1f} ms)')
+    print(f'{"bus ready":<16}{time_bus() * 1000:8.1f} ms')
@@ -0,0 +1,326 @@
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import asyncio
+import tempfile
+
+from udsoncan import MemoryLocation
+
+from uds.pool import ClientPool
+from uds.metrics import Metrics
+from uds.discovery import load_address_map, address_pairs
+import diag_test
+from diag_test import logger
+
+
+# local endpoint, a Unix socket where available and localhost TCP otherwise,
+# the same for the daemon and its clients whatever their working directory
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), 'uds-tester.sock')
+HOST = '127.0.0.1'
+PORT = 6801
+# longest JSON line of a job or reply, flash data and memory reads are hex
+LINE_LIMIT = 64 * 1024 * 1024
+
+
+class RWLock(object):
+    # many ECU jobs at a time or one suite with the bus to itself, new jobs
+    # wait while a suite is waiting, so that a stream of them cannot starve it
+
+    def __init__(self):
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire_read(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._writer and not self._writers_waiting)
+            self._readers += 1
+
+    async def release_read(self):
+        async with self._cond:
+            self._readers -= 1
+            self._cond.notify_all()
+
+    async def acquire_write(self):
+        async with self._cond:
+            self._writers_waiting += 1
+            try:
+                await self._cond.wait_for(lambda: not self._writer and self._readers == 0)
+            finally:
+                self._writers_waiting -= 1
+                # readers held back by a cancelled writer may go on
+                self._cond.notify_all()
+            self._writer = True
+
+    async def release_write(self):
+        async with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+async def unlock(client, level=3):
+    response = await client.request_seed(level)
+    seed = struct.unpack('>I', response.service_data.seed)[0]
+    key = diag_test.seed_to_key(seed)
+    await client.send_key(level + 1, struct.pack('>I', key))
+
+
+async def job_read_dids(client, dids):
+    response = await client.read_data_by_identifier(dids)
+    return {'%04X' % did: str(value) for did, value in response.service_data.values.items()}
+
+
+async def job_read_dtcs(client, status_mask=0x09):
+    response = await client.get_dtc_by_status_mask(status_mask)
+    return [{'id': '%06X' % dtc.id, 'status': dtc.status.get_byte_as_int()}
+            for dtc in response.service_data.dtcs]
+
+
+async def job_read_dtc_details(client, status_mask=0x0D):
+    from uds.dtcdetail import DtcDetailReader
+    details = []
+    async for detail in DtcDetailReader(client, status_mask=status_mask).details():
+        details.append({'id': '%06X' % detail.dtc, 'status': detail.status,
+                        'snapshots': {'%02X' % record: {'%04X' % did: str(value) for did, value in values.items()}
+                                      for record, values in detail.snapshots.items()},
+                        'extended_data': {'%02X' % record: str(value) for record, value in detail.extended_data.items()},
+                        'errors': ['%s: %r' % error for error in detail.errors]})
+    return details
+
+
+async def job_scan_dids(client, ranges=((0x0000, 0x10000), ), batch_size=32):
+    from uds.didscan import scan_dids
+    records = await scan_dids(client, [range(start, stop) for start, stop in ranges], batch_size=batch_size)
+    return {'%04X' % did: record.data.hex() if record.supported else {'nrc': record.nrc}
+            for did, record in sorted(records.items())}
+
+
+async def job_sweep_services(client, sessions=(1, 3, 2)):
+    from uds.servicescan import ServiceSweep, support_matrix, format_table
+    results = await ServiceSweep(client, sessions=tuple(sessions)).sweep()
+    return format_table(support_matrix(results))
+
+
+async def job_read_memory(client, address, size, chunk_size=None):
+    data = await client.read_memory(address, size, chunk_size=chunk_size)
+    return data.hex()
+
+
+async def job_write_memory(client, address, data, chunk_size=None, session=3):
+    await client.change_session(session)
+    await client.write_memory(address, bytes.fromhex(data), chunk_size=chunk_size)
+    return {'bytes': len(data) // 2}
+
+
+async def job_run_routine(client, routine_id, data=None, session=3, timeout=60):
+    await client.change_session(session)
+    await unlock(client)
+    response = await client.run_routine(routine_id, bytes.fromhex(data) if data else None, timeout=timeout)
+    return response.service_data.routine_status_record.hex()
+
+
+async def job_write_dids(client, values, verify=True, session=3):
+    from uds.eol import write_dids
+    # {'F199': [32, 38, 16, 25], 'F187': 'PART0000002  '}, lists are raw bytes
+    values = {int(did, 16): bytes(value) if isinstance(value, list) else value
+              for did, value in values.items()}
+    await client.change_session(session)
+    results = await write_dids(client, values, unlock=unlock, verify=verify)
+    return {'%04X' % did: {'ok': write.ok, 'nrc': write.nrc,
+                           'error': None if write.error is None else repr(write.error)}
+            for did, write in results.items()}
+
+
+async def job_flash(client, address, data, address_format=32, memorysize_format=32):
+    data = bytes.fromhex(data)
+    await client.change_session(2)
+    await unlock(client)
+    memory_location = MemoryLocation(address, len(data), address_format, memorysize_format)
+    response = await client.request_download(memory_location)
+    # max_length includes the SID and the block sequence counter
+    block_size = response.service_data.max_length - 2
+    sequence_number = 1
+    for index in range(0, len(data), block_size):
+        await client.transfer_data(sequence_number, data[index:index + block_size])
+        sequence_number = (sequence_number + 1) & 0xFF
+    await client.request_transfer_exit()
+    return {'bytes': len(data)}
+
+
+ECU_JOBS = {
+    'read_dids': job_read_dids,
+    'read_dtcs': job_read_dtcs,
+    'read_dtc_details': job_read_dtc_details,
+    'scan_dids': job_scan_dids,
+    'sweep_services': job_sweep_services,
+    'read_memory': job_read_memory,
+    'write_memory': job_write_memory,
+    'run_routine': job_run_routine,
+    'write_dids': job_write_dids,
+    'flash': job_flash,
+}
+
+
+async def suite_diag(bus):
+    await diag_test.diag_test(bus)
+
+
+async def suite_isotp(bus):
+    import isotp_test
+    await isotp_test.tp_test(bus)
+
+
+SUITES = {
+    'diag': suite_diag,
+    'isotp': suite_isotp,
+}
+
+
+class TesterDaemon(object):
+
+    def __init__(self, pool: ClientPool, ecus: dict):
+        self.pool = pool
+        self.ecus = ecus
+        self._bus_lock = RWLock()
+        self._queues = {}
+        self._workers = []
+
+    async def _worker(self, ecu, queue: asyncio.Queue):
+        rx_id, tx_id = self.ecus[ecu]
+        while True:
+            job, params, future = await queue.get()
+            await self._bus_lock.acquire_read()
+            try:
+                async with self.pool.acquire(rx_id, tx_id, diag_test.make_config()) as client:
+                    result = await ECU_JOBS[job](client, **params)
+                future.set_result(result)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                await self._bus_lock.release_read()
+
+    async def run_suite(self, suite):
+        await self._bus_lock.acquire_write()
+        try:
+            async with self.pool.raw_bus() as bus:
+                t1 = time.time()
+                await SUITES[suite](bus)
+                t2 = time.time()
+        finally:
+            await self._bus_lock.release_write()
+        return {'elapsed': round(t2 - t1, 3)}
+
+    async def submit(self, request: dict):
+        job = request['job']
+        params = request.get('params', {})
+
+        if job == 'ping':
+            return {'ecus': list(self.ecus), 'queued': {
+                ecu: queue.qsize() for ecu, queue in self._queues.items()}}
+
+        if job == 'metrics':
+            if self.pool.metrics is None:
+                raise ValueError('The pool was created without metrics')
+            return self.pool.metrics.to_prometheus()
+
+        if job == 'run_suite':
+            return await self.run_suite(**params)
+
+        if job not in ECU_JOBS:
+            raise ValueError('Unknown job %r' % job)
+
+        ecu = request.get('ecu', next(iter(self.ecus)))
+        if ecu not in self.ecus:
+            raise ValueError('Unknown ECU %r' % ecu)
+
+        # jobs are queued per ECU so that one slow ECU does not block the others
+        if ecu not in self._queues:
+            self._queues[ecu] = asyncio.Queue()
+            self._workers.append(asyncio.ensure_future(
+                self._worker(ecu, self._queues[ecu])))
+
+        future = asyncio.get_event_loop().create_future()
+        self._queues[ecu].put_nowait((job, params, future))
+        return await future
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError as e:
+                    # longer than LINE_LIMIT, the rest of the line cannot be told apart
+                    logger.error('job dropped: %s', e)
+                    writer.write(json.dumps({'ok': False, 'error': repr(e)}).encode() + b'\n')
+                    await writer.drain()
+                    break
+                if not line:
+                    break
+                try:
+                    result = await self.submit(json.loads(line))
+                    reply = {'ok': True, 'result': result}
+                except Exception as e:
+                    logger.exception('job failed')
+                    reply = {'ok': False, 'error': repr(e)}
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        if hasattr(socket, 'AF_UNIX'):
+            if os.path.exists(SOCKET_PATH):
+                os.remove(SOCKET_PATH)
+            server = await asyncio.start_unix_server(self._handle, SOCKET_PATH, limit=LINE_LIMIT)
+        else:
+            server = await asyncio.start_server(self._handle, HOST, PORT, limit=LINE_LIMIT)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in self._workers:
+                worker.cancel()
+
+
+async def request(job: dict):
+    if hasattr(socket, 'AF_UNIX'):
+        reader, writer = await asyncio.open_unix_connection(SOCKET_PATH, limit=LINE_LIMIT)
+    else:
+        reader, writer = await asyncio.open_connection(HOST, PORT, limit=LINE_LIMIT)
+    writer.write(json.dumps(job).encode() + b'\n')
+    reply = json.loads(await reader.readline())
+    writer.close()
+    return reply
+
+
+async def main(address_map_path=None):
+    if address_map_path is None:
+        ecus = {'default': (diag_test.RX_ID, diag_test.TX_ID)}
+    else:
+        ecus = address_pairs(load_address_map(address_map_path))
+
+    bus_config = {
+        'interface': 'vector',
+        # 'interface': 'canalystii',
+        'channel': 0,
+        'bitrate': 500000,
+    }
+
+    async with ClientPool(bus_config, metrics=Metrics(), tx_padding=0x00) as pool:
+        await TesterDaemon(pool, ecus).serve()
+
+
+if __name__ == '__main__':
+
+    diag_test.setup_logging()
+
+    # python tester_daemon.py [address_map.json]     start the daemon
+    # python tester_daemon.py '{"job": "read_dids", "params": {"dids": [61824]}}'
+    if len(sys.argv) > 1 and sys.argv[1].startswith('{'):
+        print(json.dumps(asyncio.run(request(json.loads(sys.argv[1])))))
+    else:
+        asyncio.run(main(*sys.argv[1:2]))
@@ -0,0 +1,73 @@
+import os
+import sys
+import contextlib
+
+import pytest
+
+# the test modules import uds and the suites from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uds import sim  # noqa: E402
+from uds.isotp import ISOTPNetwork  # noqa: E402
+from uds.client import open_client  # noqa: E402
+import diag_test  # noqa: E402
+
+
+# (rx_id, tx_id) of the simulated ECUs from the tester's side
+ECUS = {'a': (0x73B, 0x72B), 'b': (0x73C, 0x72C)}
+FUNCTIONAL_ID = 0x7DF
+
+
+class Vehicle(object):
+    # simulated ECUs on one channel, a UdsServer each, and the tester's bus
+
+    def __init__(self, ecus=None, **server_kwargs):
+        self.ecus = ecus if ecus is not None else {'a': ECUS['a']}
+        self.clock = sim.SimClock()
+        network = sim.SimNetwork(self.clock)
+        self.servers = {}
+        for name, (rx_id, tx_id) in self.ecus.items():
+            server = sim.UdsServer(self.clock.time, key_function=diag_test.seed_to_key, **server_kwargs)
+            sim.SimECU(sim.VirtualBus(network), tx_id, rx_id, FUNCTIONAL_ID, server)
+            self.servers[name] = server
+        self.bus = sim.VirtualBus(network)
+
+    @property
+    def server(self) -> sim.UdsServer:
+        return next(iter(self.servers.values()))
+
+    def now(self) -> float:
+        return self.clock.time()
+
+    def run(self, main):
+        # the result of main(), in simulated time
+        return sim.run(main, self.clock)
+
+    def run_with_clients(self, func):
+        # func({name: Client}) with one physical client per ECU
+        async def main():
+            network = ISOTPNetwork(bus=self.bus, tx_padding=0x00)
+            with network.open():
+                async with contextlib.AsyncExitStack() as stack:
+                    clients = {}
+                    for name, (rx_id, tx_id) in self.ecus.items():
+                        clients[name] = await stack.enter_async_context(
+                            open_client(network, rx_id, tx_id, diag_test.make_config()))
+                    return await func(clients)
+        return self.run(main())
+
+
+@pytest.fixture
+def vehicle():
+    return Vehicle()
+
+
+@pytest.fixture
+def two_ecus():
+    return Vehicle(dict(ECUS))
+
+
+@pytest.fixture
+def make_vehicle():
+    # Vehicle(ecus, **server_kwargs) for ECUs with other settings
+    return Vehicle
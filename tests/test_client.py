@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+
+def reset_and_wait(vehicle, **kwargs):
+    async def main(clients):
+        client = clients['a']
+        await client.ecu_reset(1)
+        elapsed = await client.wait_until_ready(**kwargs)
+        return elapsed, vehicle.server.ready
+    return vehicle.run_with_clients(main)
+
+
+def test_ready_soon_after_the_restart(vehicle):
+    elapsed, ready = reset_and_wait(vehicle)
+    assert ready
+    # the simulated ECU restarts in 50 ms, the outage is seen after one probe timeout
+    assert 0.05 <= elapsed < 0.3
+
+
+def test_answers_before_the_power_down_are_not_ready(vehicle):
+    server = vehicle.server
+    ecu_reset = server._ecu_reset
+
+    def late_ecu_reset(request):
+        # goes down 100 ms after its response
+        response = ecu_reset(request)
+        server.ready_at = 0.0
+        vehicle.clock.call_later(0.1, setattr, server, 'ready_at', vehicle.now() + 0.1 + server.reset_time)
+        return response
+    server._handlers[0x11] = late_ecu_reset
+
+    elapsed, ready = reset_and_wait(vehicle)
+    assert ready
+    assert elapsed >= 0.1 + server.reset_time
+
+
+def test_missed_outage_ends_after_down_timeout(vehicle):
+    server = vehicle.server
+    server._handlers[0x11] = lambda request: bytes([0x51, request[1]])
+
+    elapsed, ready = reset_and_wait(vehicle, down_timeout=0.3)
+    assert ready
+    assert 0.3 <= elapsed < 0.4
+
+
+def test_silent_server_times_out(vehicle):
+    vehicle.server.reset_time = 100
+    with pytest.raises(asyncio.TimeoutError):
+        reset_and_wait(vehicle, timeout=1)
@@ -0,0 +1,55 @@
+import os
+import asyncio
+import contextlib
+
+import pytest
+
+from uds.pool import ClientPool
+import tester_daemon
+import diag_test
+
+
+@pytest.fixture
+def socket_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'uds-tester.sock')
+    monkeypatch.setattr(tester_daemon, 'SOCKET_PATH', path)
+    return path
+
+
+@contextlib.asynccontextmanager
+async def running_daemon(vehicle, socket_path):
+    async with ClientPool(bus=vehicle.bus, config=diag_test.make_config(), tx_padding=0x00) as pool:
+        server = asyncio.ensure_future(tester_daemon.TesterDaemon(pool, {'a': (0x73B, 0x72B)}).serve())
+        while not os.path.exists(socket_path):
+            await asyncio.sleep(0.01)
+        try:
+            yield
+        finally:
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+
+
+def test_jobs_above_64_kib(vehicle, socket_path):
+    data = os.urandom(40000)
+
+    async def main():
+        async with running_daemon(vehicle, socket_path):
+            written = await tester_daemon.request({'job': 'write_memory', 'params': {'address': 0x1000, 'data': data.hex()}})
+            read = await tester_daemon.request({'job': 'read_memory', 'params': {'address': 0x1000, 'size': len(data)}})
+            return written, read
+
+    written, read = vehicle.run(main())
+    assert written == {'ok': True, 'result': {'bytes': len(data)}}
+    assert read == {'ok': True, 'result': data.hex()}
+
+
+def test_line_above_the_limit_is_refused(vehicle, socket_path, monkeypatch):
+    monkeypatch.setattr(tester_daemon, 'LINE_LIMIT', 1024)
+
+    async def main():
+        async with running_daemon(vehicle, socket_path):
+            return await tester_daemon.request({'job': 'write_memory', 'params': {'address': 0, 'data': '00' * 1024}})
+
+    reply = vehicle.run(main())
+    assert reply['ok'] is False
+    assert vehicle.server.memory[:1024] == bytes(1024)
@@ -0,0 +1,67 @@
+from uds import sim
+from uds.didscan import DidScanner, scan_dids, didconfig, save_did_map, load_did_map
+
+
+DIDS = dict(sim.DIDS)
+DIDS[0x0100] = b'\x01'
+# bytes that look like another DID
+DIDS[0x0102] = b'\xf1\x80\x00'
+
+
+def test_scan_finds_every_did(make_vehicle):
+    vehicle = make_vehicle(dids=DIDS)
+
+    async def main(clients):
+        scanner = DidScanner(clients['a'], batch_size=64)
+        return scanner, await scanner.scan()
+
+    scanner, records = vehicle.run_with_clients(main)
+    assert {did: record.data for did, record in records.items()} == DIDS
+    # sparse batches cost one request each
+    assert scanner.requests < 0x10000 // 64 + 30 * len(DIDS)
+
+
+def test_batch_size_follows_the_ecu(make_vehicle):
+    # more than 16 DIDs per request are refused with NRC 0x13
+    vehicle = make_vehicle(dids=DIDS, max_dids=16)
+
+    async def main(clients):
+        scanner = DidScanner(clients['a'], batch_size=64)
+        return scanner, await scanner.scan()
+
+    scanner, records = vehicle.run_with_clients(main)
+    assert scanner.batch_size <= 16
+    assert {did: record.data for did, record in records.items()} == DIDS
+
+
+def test_ranges_and_did_map(make_vehicle, tmp_path):
+    vehicle = make_vehicle(dids=DIDS)
+
+    async def main(clients):
+        return await scan_dids(clients['a'], ranges=(range(0xF180, 0xF190), ))
+
+    records = vehicle.run_with_clients(main)
+    assert sorted(records) == [0xF180, 0xF187, 0xF188, 0xF18A]
+    assert {did: len(codec) for did, codec in didconfig(records).items()} == {
+        did: len(DIDS[did]) for did in records}
+
+    path = str(tmp_path / 'dids.json')
+    save_did_map(path, records)
+    assert {did: record.data for did, record in load_did_map(path).items()} == {
+        did: record.data for did, record in records.items()}
+
+
+def test_batch_size_follows_a_response_too_long(make_vehicle):
+    # more than 8 DIDs per request are refused with NRC 0x14
+    vehicle = make_vehicle(dids=DIDS)
+    read_data = vehicle.server._read_data
+    vehicle.server._handlers[0x22] = lambda request: (
+        sim.negative_response(0x22, 0x14) if len(request) > 1 + 2 * 8 else read_data(request))
+
+    async def main(clients):
+        scanner = DidScanner(clients['a'], batch_size=64)
+        return scanner, await scanner.scan((range(0xF000, 0xF200), ))
+
+    scanner, records = vehicle.run_with_clients(main)
+    assert scanner.batch_size <= 8
+    assert {did: record.data for did, record in records.items()} == sim.DIDS
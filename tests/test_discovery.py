@@ -0,0 +1,41 @@
+import json
+
+from uds.discovery import discover, save_address_map, load_address_map, address_pairs, FUNCTIONAL_IDS
+
+
+OBD_ECU = (0x7E8, 0x7E0)
+
+
+def test_bisection_finds_each_request_id(make_vehicle):
+    vehicle = make_vehicle({'a': (0x73B, 0x72B), 'b': (0x73C, 0x72C), 'obd': OBD_ECU})
+    responders = vehicle.run(discover(vehicle.bus))
+    assert sorted((r.rx_id, r.tx_id) for r in responders) == [(0x73B, 0x72B), (0x73C, 0x72C), OBD_ECU]
+    assert not any(r.is_extended_id for r in responders)
+
+
+def test_functional_id_is_not_probed(make_vehicle):
+    # every ECU answers on 0x7DF, probing it maps the OBD ECU there
+    assert 0x7DF in FUNCTIONAL_IDS
+    vehicle = make_vehicle({'obd': OBD_ECU})
+    responders = vehicle.run(discover(vehicle.bus, functional_ids=()))
+    assert [r.tx_id for r in responders] == [0x7DF]
+    responders = vehicle.run(discover(vehicle.bus))
+    assert [r.tx_id for r in responders] == [0x7E0]
+
+
+def test_bus_filters_are_restored(make_vehicle):
+    vehicle = make_vehicle()
+    filters = [{'can_id': 0x73B, 'can_mask': 0x7FF}]
+    vehicle.bus.set_filters(filters)
+    vehicle.run(discover(vehicle.bus, ids=range(0x720, 0x730)))
+    assert vehicle.bus.filters == filters
+
+
+def test_address_map_round_trip(make_vehicle, tmp_path):
+    vehicle = make_vehicle()
+    responders = vehicle.run(discover(vehicle.bus, ids=range(0x720, 0x730)))
+    path = tmp_path / 'ecus.json'
+    save_address_map(str(path), responders)
+    address_map = load_address_map(str(path))
+    assert address_map == json.loads(path.read_text())
+    assert address_pairs(address_map) == {'ecu_72b': (0x73B, 0x72B)}
@@ -0,0 +1,92 @@
+import struct
+import asyncio
+import contextlib
+
+import pytest
+
+from uds import doip
+from uds.client import Client
+import doip_gateway
+import diag_test
+
+
+@contextlib.asynccontextmanager
+async def running_gateway(protocol_factory=doip_gateway.GatewayProtocol):
+    gateway = doip_gateway.Gateway()
+    server = await asyncio.get_event_loop().create_server(
+        lambda: protocol_factory(gateway), doip_gateway.HOST, 0)
+    async with server:
+        yield server.sockets[0].getsockname()[1]
+
+
+@contextlib.asynccontextmanager
+async def open_client(target_address=doip_gateway.ECU_ADDRESS, **kwargs):
+    async with running_gateway() as port:
+        reader, writer = await doip.open_connection(doip_gateway.HOST, target_address, port, **kwargs)
+        async with Client(reader, writer, diag_test.make_config()) as client:
+            yield client
+
+
+def test_routing_activation():
+    async def main():
+        async with running_gateway() as port:
+            protocol = doip.DoIPProtocol(doip.DoIPStreamReader())
+            transport, _ = await asyncio.get_event_loop().create_connection(lambda: protocol, doip_gateway.HOST, port)
+            try:
+                return await protocol.activate_routing()
+            finally:
+                transport.close()
+
+    assert asyncio.run(main()) == doip_gateway.LOGICAL_ADDRESS
+
+
+def test_routing_activation_denied():
+    async def main():
+        async with open_client(activation_type=doip.ActivationType.CentralSecurity):
+            pass
+
+    with pytest.raises(doip.DoIPError):
+        asyncio.run(main())
+
+
+def test_routing_activation_for_another_tester():
+    class OtherTester(doip_gateway.GatewayProtocol):
+
+        def _send(self, payload_type, payload=b''):
+            if payload_type == doip.PayloadType.RoutingActivationResponse:
+                payload = struct.pack('>H', 0x0E01) + payload[2:]
+            super()._send(payload_type, payload)
+
+    async def main():
+        async with running_gateway(OtherTester) as port:
+            await doip.open_connection(doip_gateway.HOST, doip_gateway.ECU_ADDRESS, port)
+
+    with pytest.raises(doip.DoIPError, match='0x0e01'):
+        asyncio.run(main())
+
+
+def test_diagnostic_message_round_trip():
+    async def main():
+        async with open_client() as client:
+            await client.tester_present()
+            return await client.read_data_by_identifier_first(0xF187)
+
+    assert asyncio.run(main()) == 'PART0000001  '
+
+
+def test_nack_raises_and_the_connection_goes_on():
+    async def main():
+        async with running_gateway() as port:
+            reader, writer = await doip.open_connection(doip_gateway.HOST, 0x0002, port)
+            async with Client(reader, writer, diag_test.make_config()) as client:
+                loop = asyncio.get_event_loop()
+                start = loop.time()
+                with pytest.raises(doip.DoIPError, match='NACK 0x03'):
+                    await client.tester_present(timeout=1)
+                elapsed = loop.time() - start
+                # the next request gets its own NACK rather than waiting
+                with pytest.raises(doip.DoIPError, match='NACK 0x03'):
+                    await client.tester_present(timeout=1)
+                return elapsed
+
+    assert asyncio.run(main()) < 0.5
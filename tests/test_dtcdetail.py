@@ -0,0 +1,109 @@
+import pytest
+from udsoncan import DidCodec
+
+from uds import sim
+from uds.dtcdetail import DtcDetailReader, read_dtc_details, decode_extended_data
+
+
+class Odometer(DidCodec):
+
+    def encode(self, value):
+        return value.to_bytes(3, 'big')
+
+    def decode(self, data):
+        return int.from_bytes(data, 'big')
+
+    def __len__(self):
+        return 3
+
+
+class Byte(DidCodec):
+
+    def encode(self, value):
+        return bytes([value])
+
+    def decode(self, data):
+        return data[0]
+
+    def __len__(self):
+        return 1
+
+
+SNAPSHOT_CODECS = {0xDD00: Odometer(), 0xDD01: Byte()}
+EXTENDED_DATA_CODECS = {0x01: Byte(), 0x02: Byte()}
+# testFailed, pendingDTC or confirmedDTC
+REPORTED = [(dtc, status) for dtc, status in sim.DTCS if status & 0x0D]
+CONFIRMED = [dtc for dtc, status in REPORTED if status & 0x08]
+
+
+def read_details(vehicle, **kwargs):
+    async def main(clients):
+        reader = DtcDetailReader(clients['a'], snapshot_codecs=SNAPSHOT_CODECS,
+                                 extended_data_codecs=EXTENDED_DATA_CODECS, **kwargs)
+        return reader, [detail async for detail in reader.details()]
+    return vehicle.run_with_clients(main)
+
+
+def test_snapshots_and_extended_data(vehicle):
+    reader, details = read_details(vehicle)
+    assert [(detail.dtc, detail.status) for detail in details] == REPORTED
+    for detail in details:
+        assert detail.errors == []
+        if detail.dtc in CONFIRMED:
+            assert detail.snapshots == {0x01: {0xDD00: detail.dtc & 0xFFFFF, 0xDD01: 120 + detail.dtc % 30}}
+        else:
+            assert detail.snapshots == {}
+        assert detail.extended_data == {0x01: 1 + detail.dtc % 5, 0x02: detail.dtc % 40}
+    # status mask, snapshot identification, a snapshot read per confirmed
+    # DTC and an extended data read per DTC
+    assert reader.requests == 2 + len(CONFIRMED) + len(REPORTED)
+
+
+def test_identification_timeout_reads_every_snapshot(vehicle):
+    read_dtc = vehicle.server._read_dtc
+    vehicle.server._handlers[0x19] = lambda request: None if request[1] == 0x03 else read_dtc(request)
+
+    reader, details = read_details(vehicle)
+    assert [detail.dtc for detail in details] == [dtc for dtc, _ in REPORTED]
+    assert [detail.dtc for detail in details if detail.snapshots] == CONFIRMED
+    assert reader.requests == 2 + 2 * len(REPORTED)
+
+
+def test_missing_codec_is_recorded_per_dtc(vehicle):
+    async def main(clients):
+        return [detail async for detail in DtcDetailReader(clients['a']).details()]
+
+    details = vehicle.run_with_clients(main)
+    assert len(details) == len(REPORTED)
+    for detail in details:
+        assert bool(detail.errors) == (detail.dtc in CONFIRMED)
+        # records without a codec are kept as raw bytes
+        assert detail.extended_data == {0x01: bytes([1 + detail.dtc % 5, 0x02, detail.dtc % 40])}
+
+
+def test_several_ecus_and_early_stop(two_ecus):
+    async def main(clients):
+        details = [item async for item in read_dtc_details(
+            clients, snapshot_codecs=SNAPSHOT_CODECS, extended_data_codecs=EXTENDED_DATA_CODECS)]
+        details_stream = read_dtc_details(clients)
+        async for _ in details_stream:
+            break
+        await details_stream.aclose()
+        # no response of a stopped reader is left on the connections
+        for client in clients.values():
+            await client.tester_present()
+        return details
+
+    details = two_ecus.run_with_clients(main)
+    assert sorted(name for name, _ in details) == ['a'] * len(REPORTED) + ['b'] * len(REPORTED)
+    assert not any(isinstance(detail, Exception) for _, detail in details)
+
+
+def test_decode_extended_data():
+    assert decode_extended_data(bytes([0x01, 0x05, 0x02, 0x07]), EXTENDED_DATA_CODECS) == {0x01: 5, 0x02: 7}
+    # zero padding ends the records
+    assert decode_extended_data(bytes([0x01, 0x05, 0x00, 0x00]), EXTENDED_DATA_CODECS) == {0x01: 5}
+    assert decode_extended_data(bytes([0x01, 0x05, 0x03, 0x01, 0x02]), EXTENDED_DATA_CODECS) == {
+        0x01: 5, 0x03: bytes([0x01, 0x02])}
+    with pytest.raises(ValueError):
+        decode_extended_data(bytes([0x01]), EXTENDED_DATA_CODECS)
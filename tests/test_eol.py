@@ -0,0 +1,71 @@
+from uds.eol import DidWriter, DidWrite, write_dids, verify_groups
+import tester_daemon
+
+
+VALUES = {
+    0xF187: 'PART0000002  ',
+    0xF188: 'SWNR0000002  ',
+    0xF18A: 'ABC',
+    0xF191: 'HWNR000002',
+    0xF199: bytes([0x20, 0x26, 0x10, 0x19]),
+}
+
+
+def test_write_and_verify(vehicle):
+    async def main(clients):
+        client = clients['a']
+        await client.change_session(3)
+        writer = DidWriter(client, unlock=tester_daemon.unlock)
+        return writer, await writer.write(VALUES)
+
+    writer, results = vehicle.run_with_clients(main)
+    assert all(write.ok for write in results.values()), results
+    assert vehicle.server.dids[0xF187] == b'PART0000002  '
+    assert vehicle.server.dids[0xF199] == bytes([0x20, 0x26, 0x10, 0x19])
+    # seed, key, a write per DID and one verify read for the group
+    assert writer.requests == len(VALUES) + 1
+
+
+def test_bad_value_writes_nothing(vehicle):
+    async def main(clients):
+        client = clients['a']
+        await client.change_session(3)
+        return await write_dids(client, {0xF187: 'PART0000003  ', 0xF18A: 'TOOLONG'}, unlock=tester_daemon.unlock)
+
+    results = vehicle.run_with_clients(main)
+    assert results[0xF18A].error is not None
+    assert not results[0xF187].written
+    assert vehicle.server.dids[0xF187] == b'PART0000001  '
+
+
+def test_dropped_write_fails_verification(vehicle):
+    # the ECU confirms the write of 0xF191 but keeps the old value, and
+    # reads at most two DIDs at a time
+    vehicle.server.max_dids = 2
+    write_data = vehicle.server._write_data
+    vehicle.server._handlers[0x2E] = lambda request: (
+        bytes([0x6E]) + request[1:3] if request[1:3] == b'\xf1\x91' else write_data(request))
+
+    async def main(clients):
+        client = clients['a']
+        await client.change_session(3)
+        return await write_dids(client, VALUES, unlock=tester_daemon.unlock)
+
+    results = vehicle.run_with_clients(main)
+    assert results[0xF191].written and results[0xF191].verified is False
+    assert results[0xF191].read_back == b'HWNR000001'
+    assert all(results[did].ok for did in VALUES if did != 0xF191)
+
+
+def test_verify_groups_respect_size_and_response_length():
+    writes = []
+    for did in range(10):
+        write = DidWrite(did, None)
+        write.data = bytes(did % 2 * 1990 + 10)
+        writes.append(write)
+    groups = verify_groups(writes, group_size=4)
+    # 1 + 2 * (2 + 2000) + 2 * (2 + 10) bytes just fit into one response
+    assert [len(group) for group in groups] == [4, 4, 2]
+    assert all(1 + sum(2 + len(write.data) for write in group) <= 4095 for group in groups)
+    assert [write for group in groups for write in group] == writes
+    assert [len(group) for group in verify_groups(writes[:3], group_size=2)] == [2, 1]
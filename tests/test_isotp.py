@@ -0,0 +1,56 @@
+import asyncio
+
+from can import Message
+
+from uds import sim
+from uds import isotp
+from uds.isotp import ISOTPNetwork
+
+
+RX_ID, TX_ID = 0x708, 0x700
+
+
+def receive(vehicle, frames, tx_padding=0x00):
+    # what a connection receives from frames sent to it by a peer
+    peer = sim.VirtualBus(vehicle.bus.network)
+
+    async def main():
+        network = ISOTPNetwork(bus=vehicle.bus, tx_padding=tx_padding)
+        with network.open():
+            reader, writer = await network.open_connection(RX_ID, TX_ID)
+            for frame in frames:
+                peer.send(Message(arbitration_id=RX_ID, data=frame, is_extended_id=False))
+                await asyncio.sleep(0.001)
+            try:
+                return await asyncio.wait_for(reader.read(4095), 0.1)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                writer.close()
+    return vehicle.run(main())
+
+
+def test_segmented_payload(vehicle):
+    payload = bytes(range(20))
+    frames = [isotp.encode_first_frame(20, payload[:6]),
+              isotp.encode_consecutive_frame(1, payload[6:13]),
+              isotp.encode_consecutive_frame(2, payload[13:])]
+    # the last CF needs no padding
+    assert receive(vehicle, frames) == payload
+
+
+def test_short_consecutive_frame_aborts_reception(vehicle):
+    payload = bytes(range(20))
+    frames = [isotp.encode_first_frame(20, payload[:6]),
+              isotp.encode_consecutive_frame(1, payload[6:10]),
+              isotp.encode_consecutive_frame(2, payload[10:17]),
+              isotp.encode_consecutive_frame(3, payload[17:])]
+    assert receive(vehicle, frames) is None
+
+
+def test_short_last_consecutive_frame_aborts_reception(vehicle):
+    payload = bytes(range(20))
+    frames = [isotp.encode_first_frame(20, payload[:6]),
+              isotp.encode_consecutive_frame(1, payload[6:13]),
+              isotp.encode_consecutive_frame(2, payload[13:18])]
+    assert receive(vehicle, frames) is None
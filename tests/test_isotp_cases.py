@@ -0,0 +1,32 @@
+from uds import sim
+from uds import isotp
+import isotp_cases
+import isotp_test
+
+
+async def half_sent_request(bus, address, session):
+    # fails with the ECU waiting for the Consecutive frames of a request
+    isotp_cases.send_frame(bus, address, isotp.encode_first_frame(20, bytes([0x2E, 0xF1, 0x90, 0, 0, 0])))
+    raise AssertionError('broken case')
+
+
+def run_cases(monkeypatch, cases):
+    monkeypatch.setattr(isotp_test, 'ecu_state', isotp_test.EcuState())
+    clock = sim.SimClock()
+    bus = sim.open_sim_bus(isotp_test.TX_ID, isotp_test.RX_ID, isotp_test.FN_ID, clock)
+    return sim.run(isotp_cases.run_cases(bus, cases), clock)
+
+
+def test_generated_cases_pass_on_the_simulator(monkeypatch):
+    cases = [case for case in isotp_cases.generate()
+             if case.scenario.name in ('single_frame', 'interrupted_request')]
+    passed, failed = run_cases(monkeypatch, cases)
+    assert passed == len(cases) and failed == []
+
+
+def test_failed_case_does_not_break_the_next(monkeypatch):
+    broken = list(isotp_cases.Scenario('broken', half_sent_request, {}).expand())
+    cases = broken + [case for case in isotp_cases.generate() if case.scenario.name == 'single_frame']
+    passed, failed = run_cases(monkeypatch, cases)
+    assert failed == broken
+    assert passed == len(cases) - len(broken)
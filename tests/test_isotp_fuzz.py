@@ -0,0 +1,38 @@
+from uds import isotp
+import isotp_fuzz
+import isotp_test
+
+
+class NullBus(object):
+
+    def send(self, msg):
+        pass
+
+
+def test_no_excluded_service_in_any_frame():
+    mutator = isotp_fuzz.Mutator(seed=1)
+    for frame in mutator.batch(20000):
+        if frame and isotp.pci_type(frame) == isotp.PCIType.SingleFrame:
+            index = 2 if frame[0] == 0x00 else 1
+            assert index >= len(frame) or frame[index] not in isotp_fuzz.EXCLUDED_SIDS
+
+
+def test_excluded_sid_is_replaced():
+    mutator = isotp_fuzz.Mutator(seed=1)
+    frame = mutator.allowed(bytes([0x02, 0x11, 0x01, 0, 0, 0, 0, 0]))
+    assert frame[1] in mutator.sids and frame[2:] == bytes([0x01, 0, 0, 0, 0, 0])
+    # only Single frames carry a SID
+    first_frame = bytes([0x10, 0x11, 0x11, 0x01, 0, 0, 0, 0])
+    assert mutator.allowed(first_frame) == first_frame
+
+
+def test_crashes_are_loaded_back(tmp_path):
+    frames = [bytes([0x02, 0x22, 0xF1, 0x90, 0, 0, 0, 0])]
+    isotp_fuzz.save_frames(str(tmp_path / 'crashes'), 'crash-1.txt', frames)
+    assert isotp_fuzz.load_corpus(str(tmp_path / 'crashes')) == frames
+
+
+def test_ecu_state_outside_a_loop():
+    # the fuzzer sends without an event loop
+    isotp_test.send_can_msg(NullBus(), isotp_test.TX_ID, isotp_test.sf(0x3E, 0x00))
+    assert isotp_test.ecu_state.last_activity > 0
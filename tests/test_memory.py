@@ -0,0 +1,76 @@
+import os
+
+import pytest
+from udsoncan.exceptions import NegativeResponseException
+
+from uds import sim
+
+
+def test_round_trip_in_chunks(make_vehicle):
+    vehicle = make_vehicle()
+    data = os.urandom(20000)
+
+    async def main(clients):
+        client = clients['a']
+        await client.change_session(3)
+        await client.write_memory(0x1000, data)
+        return await client.read_memory(0x1000, len(data))
+
+    assert vehicle.run_with_clients(main) == data
+    assert vehicle.server.memory[0x1000:0x1000 + len(data)] == data
+
+
+def test_chunks_too_long_are_split(make_vehicle):
+    # chunks of 4094 bytes are refused, the halved size is kept
+    vehicle = make_vehicle(max_memory_length=1500)
+    data = os.urandom(10000)
+    lengths = []
+    read_memory = vehicle.server._read_memory
+
+    def recording_read_memory(request):
+        response = read_memory(request)
+        if response[0] != 0x7F:
+            lengths.append(len(response) - 1)
+        return response
+    vehicle.server._handlers[0x23] = recording_read_memory
+
+    async def main(clients):
+        client = clients['a']
+        await client.change_session(3)
+        await client.write_memory(0, data)
+        return await client.read_memory(0, len(data))
+
+    assert vehicle.run_with_clients(main) == data
+    assert max(lengths) <= 1500
+    assert sum(lengths) == len(data)
+
+
+def test_failed_chunks_are_retried(make_vehicle):
+    vehicle = make_vehicle()
+    vehicle.server.memory[:] = os.urandom(len(vehicle.server.memory))
+    read_memory = vehicle.server._read_memory
+    requests = []
+
+    def flaky_read_memory(request):
+        # every third request fails once with conditionsNotCorrect
+        requests.append(request)
+        if len(requests) % 3 == 0:
+            return sim.negative_response(0x23, 0x22)
+        return read_memory(request)
+    vehicle.server._handlers[0x23] = flaky_read_memory
+
+    async def main(clients):
+        return await clients['a'].read_memory(0, 20000, chunk_size=1000, retries=5)
+
+    assert vehicle.run_with_clients(main) == vehicle.server.memory[:20000]
+
+
+def test_persistent_failure_raises(make_vehicle):
+    vehicle = make_vehicle()
+    vehicle.server._handlers[0x23] = lambda request: sim.negative_response(0x23, 0x22)
+
+    async def main(clients):
+        with pytest.raises(NegativeResponseException):
+            await clients['a'].read_memory(0, 100, retries=1)
+
+    vehicle.run_with_clients(main)
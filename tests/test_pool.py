@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from uds.pool import ClientPool
+from uds.isotp import ISOTPNetwork
+from uds.client import open_client
+import diag_test
+
+
+RX_ID, TX_ID = 0x73B, 0x72B
+
+
+def open_pool(vehicle, **kwargs):
+    return ClientPool(bus=vehicle.bus, config=diag_test.make_config(), tx_padding=0x00, **kwargs)
+
+
+def test_connection_is_reused(vehicle):
+    async def main():
+        async with open_pool(vehicle) as pool:
+            async with pool.acquire(RX_ID, TX_ID) as first:
+                await first.tester_present()
+            async with pool.acquire(RX_ID, TX_ID) as second:
+                await second.tester_present()
+            assert first is second
+            assert len(pool._network._transports[RX_ID]) == 1
+
+    vehicle.run(main())
+
+
+def test_concurrent_acquires_connect_once(vehicle):
+    async def main():
+        async with open_pool(vehicle) as pool:
+            network = pool._open_network()
+            open_connection = network.open_connection
+
+            async def slow_open_connection(*args, **kwargs):
+                # a connect that yields, e.g. on a socket
+                await asyncio.sleep(0.01)
+                return await open_connection(*args, **kwargs)
+            network.open_connection = slow_open_connection
+
+            async def use():
+                async with pool.acquire(RX_ID, TX_ID) as client:
+                    await client.tester_present()
+                    return client
+            clients = await asyncio.gather(*(use() for _ in range(5)))
+            assert len(set(map(id, clients))) == 1
+            assert len(network._transports[RX_ID]) == 1
+
+    vehicle.run(main())
+
+
+def test_unhealthy_connection_is_replaced(vehicle):
+    async def main():
+        async with open_pool(vehicle, health_check_interval=1.0) as pool:
+            async with pool.acquire(RX_ID, TX_ID) as first:
+                await first.tester_present()
+            # the old connection stops answering
+            first._reader.feed_eof()
+            await asyncio.sleep(2)
+            async with pool.acquire(RX_ID, TX_ID) as second:
+                await second.tester_present()
+            assert second is not first
+            assert len(pool._network._transports[RX_ID]) == 1
+
+    vehicle.run(main())
+
+
+def test_silent_server_raises(vehicle):
+    async def main():
+        async with open_pool(vehicle, health_check_interval=1.0) as pool:
+            async with pool.acquire(RX_ID, TX_ID) as client:
+                await client.tester_present()
+            vehicle.server.ready_at = vehicle.now() + 100
+            await asyncio.sleep(2)
+            with pytest.raises(ConnectionError):
+                async with pool.acquire(RX_ID, TX_ID):
+                    pass
+
+    vehicle.run(main())
+
+
+def test_open_close_cycles_leave_no_transports(vehicle):
+    async def main():
+        network = ISOTPNetwork(bus=vehicle.bus, tx_padding=0x00)
+        with network.open():
+            for _ in range(200):
+                async with open_client(network, RX_ID, TX_ID, diag_test.make_config()) as client:
+                    await client.tester_present()
+            assert network._transports == {}
+
+    vehicle.run(main())
@@ -0,0 +1,59 @@
+import asyncio
+
+from uds.client import Client
+from uds.servicescan import ServiceSweep, sweep_ecus, support_matrix, format_table, classify, SUPPORTED, NO_RESPONSE
+import diag_test
+
+
+def test_sweep_matches_the_service_table(vehicle):
+    async def main(clients):
+        return await ServiceSweep(clients['a']).sweep()
+
+    matrix = support_matrix(vehicle.run_with_clients(main))
+    assert sorted(matrix) == [0x10, 0x11, 0x14, 0x19, 0x22, 0x23, 0x27, 0x28, 0x2E, 0x31, 0x3D, 0x3E, 0x85]
+    assert matrix[0x10]['subfunctions'] == [0x01, 0x02, 0x03]
+    assert sorted(matrix[0x27]['sessions']) == [2, 3]
+    assert matrix[0x2E]['sessions'] == [3]
+    assert matrix[0x85]['sessions'] == [3]
+    assert sorted(matrix[0x22]['sessions']) == [1, 2, 3]
+    # left in the default session after resets and session changes
+    assert vehicle.server.session == 1
+    assert '| 2E | WriteDataByIdentifier | / | / | / | / | √ |' in format_table(matrix)
+
+
+def test_ecus_are_swept_at_the_same_time(two_ecus):
+    async def main(clients):
+        loop = asyncio.get_event_loop()
+        t1 = loop.time()
+        await ServiceSweep(clients['a'], sessions=(1, )).sweep()
+        t2 = loop.time()
+        results = await sweep_ecus(clients, sessions=(1, ))
+        return t2 - t1, loop.time() - t2, results
+
+    one, both, results = two_ecus.run_with_clients(main)
+    assert support_matrix(results['a']) == support_matrix(results['b'])
+    assert both < 1.5 * one
+
+
+class PendingWriter(object):
+    # answers every request with NRC 0x78 and the positive response later
+
+    def __init__(self, reader: asyncio.StreamReader, delay):
+        self.reader = reader
+        self.delay = delay
+
+    def write(self, data):
+        self.reader.feed_data(bytes([0x7F, data[0], 0x78]))
+        asyncio.get_event_loop().call_later(self.delay, self.reader.feed_data, bytes([data[0] + 0x40]))
+
+
+def test_final_response_after_pending_is_awaited():
+    async def main():
+        reader = asyncio.StreamReader()
+        client = Client(reader, PendingWriter(reader, 0.3), diag_test.make_config())
+        sweep = ServiceSweep(client, timeout=0.1)
+        assert classify(await sweep._probe(bytes([0x31, 0x01])), 0x31)[0] == SUPPORTED
+        sweep = ServiceSweep(client, timeout=0.1, pending_timeout=0.1)
+        assert classify(await sweep._probe(bytes([0x31, 0x01])), 0x31)[0] == NO_RESPONSE
+
+    asyncio.run(main())
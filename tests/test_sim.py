@@ -0,0 +1,18 @@
+from uds import sim
+import tester_daemon
+
+
+def test_servers_do_not_share_their_data(two_ecus):
+    async def main(clients):
+        client = clients['a']
+        await client.change_session(3)
+        await tester_daemon.unlock(client)
+        await client.send_raw(bytes([0x2E, 0xF1, 0x87]) + b'PART0000002  ', timeout=1)
+        await client.clear_dtc()
+
+    two_ecus.run_with_clients(main)
+    a, b = two_ecus.servers['a'], two_ecus.servers['b']
+    assert a.dids[0xF187] == b'PART0000002  '
+    assert b.dids[0xF187] == sim.DIDS[0xF187] == b'PART0000001  '
+    assert all(status == 0 for _, status in a.dtcs)
+    assert b.dtcs == sim.DTCS and any(status for _, status in sim.DTCS)
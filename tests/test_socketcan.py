@@ -0,0 +1,106 @@
+import os
+import errno
+import socket
+import asyncio
+import importlib.util
+
+import pytest
+
+from uds import socketcan
+from uds.isotp import Address
+
+
+VCAN = 'vcan0'
+
+
+def vcan_available() -> bool:
+    if not hasattr(socket, 'AF_CAN') or not hasattr(socket, 'CAN_ISOTP'):
+        return False
+    if not os.path.exists('/sys/class/net/%s' % VCAN):
+        return False
+    if importlib.util.find_spec('isotp') is None:
+        # the can-isotp package configures the sockets
+        return False
+    try:
+        socket.socket(socket.AF_CAN, socket.SOCK_DGRAM, socket.CAN_ISOTP).close()
+    except OSError:
+        # no CAN_ISOTP module in the kernel
+        return False
+    return True
+
+
+needs_vcan = pytest.mark.skipif(not vcan_available(), reason='needs %s with CAN_ISOTP' % VCAN)
+
+
+class RefusingSocket(socket.socket):
+
+    def send(self, data, flags=0):
+        raise OSError(errno.ECOMM, os.strerror(errno.ECOMM))
+
+
+def open_refusing_connection():
+    # a transport on one end of a socket pair, the other end feeds it
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock = RefusingSocket(fileno=ours.detach())
+    sock.setblocking(False)
+    reader = socketcan.SocketCANStreamReader()
+    protocol = socketcan.SocketCANProtocol(reader)
+    transport = socketcan.SocketCANTransport(sock, Address(0x7E8, 0x7E0), protocol)
+    protocol.connection_made(transport)
+    return reader, transport, theirs
+
+
+def test_refused_pdu_fails_its_read_once():
+    async def main():
+        reader, transport, peer = open_refusing_connection()
+        try:
+            transport.write(bytes([0x3E, 0x00]))
+            with pytest.raises(OSError) as e:
+                await asyncio.wait_for(reader.read(4095), 1)
+            assert e.value.errno == errno.ECOMM
+            # the connection stays usable
+            peer.send(bytes([0x7E, 0x00]))
+            assert await asyncio.wait_for(reader.read(4095), 1) == bytes([0x7E, 0x00])
+            assert not transport.is_closing()
+        finally:
+            transport.close()
+            peer.close()
+
+    asyncio.run(main())
+
+
+def test_error_ends_waiting_read():
+    async def main():
+        reader, transport, peer = open_refusing_connection()
+        try:
+            read = asyncio.ensure_future(reader.read(4095))
+            await asyncio.sleep(0.01)
+            transport.get_protocol().error_received(OSError(errno.ECOMM, 'refused'))
+            with pytest.raises(OSError):
+                await asyncio.wait_for(read, 1)
+        finally:
+            transport.close()
+            peer.close()
+
+    asyncio.run(main())
+
+
+@needs_vcan
+def test_vcan_round_trip():
+    async def main():
+        tester_reader, tester_writer = await socketcan.open_connection(VCAN, 0x7E8, 0x7E0, tx_padding=0x00)
+        ecu_reader, ecu_writer = await socketcan.open_connection(VCAN, 0x7E0, 0x7E8, tx_padding=0x00)
+        try:
+            # segmented both ways, flow control by the kernel
+            request = bytes([0x2E, 0xF1, 0x90]) + bytes(range(64))
+            tester_writer.write(request)
+            assert await asyncio.wait_for(ecu_reader.read(4095), 1) == request
+
+            response = bytes([0x62, 0xF1, 0x90]) + bytes(range(200))
+            ecu_writer.write(response)
+            assert await asyncio.wait_for(tester_reader.read(4095), 1) == response
+        finally:
+            tester_writer.close()
+            ecu_writer.close()
+
+    asyncio.run(main())
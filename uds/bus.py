@@ -0,0 +1,30 @@
+import time
+
+
+def open_bus(**bus_config):
+    # python-can and the interface backend are only imported once a bus is needed
+    import can
+    return can.interface.Bus(**bus_config)
+
+
+def wait_bus_ready(bus, timeout=0.5, arbitration_id=0) -> float:
+    # some interfaces only start receiving after their first transmission,
+    # the bus is ready as soon as a frame has been accepted for sending
+    from can import Message, CanError
+
+    t1 = time.perf_counter()
+    while True:
+        try:
+            bus.send(Message(arbitration_id=arbitration_id))
+            break
+        except CanError:
+            if time.perf_counter() - t1 > timeout:
+                raise
+            time.sleep(0.005)
+
+    # discard whatever arrived while the interface was coming up
+    for _ in range(1000):
+        if bus.recv(0) is None:
+            break
+
+    return time.perf_counter() - t1
@@ -1,46 +1,181 @@
+import time
 import asyncio
+import functools
+import contextlib
+import collections
 
 from udsoncan import Response, Request, Dtc, MemoryLocation, services
 from udsoncan.exceptions import NegativeResponseException, UnexpectedResponseException, ConfigError
 from udsoncan.configs import default_client_config
 
+from uds.fastpath import is_pending
+
+
+# largest ISO-TP PDU with a 12 bit length, SID included
+MAX_PDU_LENGTH = 4095
+# a memory request too long for the server, split and sent again
+MEMORY_CHUNK_TOO_LONG = (0x13, 0x14)
+# first byte of a routineStatusRecord while the routine is still running,
+# the record is manufacturer specific, see Client.run_routine
+ROUTINE_IN_PROGRESS = 0x01
+# busyRepeatRequest, the results are polled again
+ROUTINE_BUSY = (0x21, )
+
+
+def routine_completed(response) -> bool:
+    record = response.service_data.routine_status_record
+    return not record or record[0] != ROUTINE_IN_PROGRESS
+
+
+def instrumented(method):
+    # times a service wrapper when the client has metrics, a plain call otherwise
+    name = method.__name__
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        if self._metrics is None:
+            return await method(self, *args, **kwargs)
+        t1 = time.perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            self._metrics.observe('uds_call_seconds', time.perf_counter() - t1, method=name)
+    return wrapper
+
 
 class Client(object):
 
-    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, config=default_client_config):
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, config=default_client_config, metrics=None):
         self._reader = reader
         self._writer = writer
         self._config = dict(config)
+        # uds.metrics.Metrics, nothing is measured when None
+        self._metrics = metrics
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    @property
+    def closed(self) -> bool:
+        return self._writer.is_closing()
+
+    def close(self):
+        # closing the transport unregisters it from the network, drops its
+        # buffers and ends the reads in flight with EOF
+        self._writer.close()
+
+    async def aclose(self):
+        self.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def _read(self, timeout) -> bytes:
+        payload = await asyncio.wait_for(self._reader.read(4095), timeout)
+        if not payload:
+            raise ConnectionResetError('Connection closed while waiting for a response')
+        return payload
 
     async def send_request(self, request: Request, suppress_positive_response=False, timeout=None):
         if timeout is None:
             timeout = self._config['request_timeout']
 
+        metrics = self._metrics
+        if metrics is not None:
+            service = request.service.get_name()
+            metrics.inc('uds_requests_total', service=service)
+            t1 = time.perf_counter()
+
         payload = request.get_payload(suppress_positive_response)
+
+        if metrics is not None:
+            t2 = time.perf_counter()
+            metrics.observe('uds_encode_seconds', t2 - t1, service=service)
+
         self._writer.write(payload)
 
+        if metrics is not None:
+            t3 = time.perf_counter()
+            metrics.observe('uds_write_seconds', t3 - t2, service=service)
+
         if suppress_positive_response is False:
-            payload = await asyncio.wait_for(self._reader.read(4095), timeout)
+            payload = await self._read(timeout)
+
+            if metrics is not None:
+                t4 = time.perf_counter()
+                metrics.observe('uds_first_response_seconds', t4 - t3, service=service)
+
             response = Response.from_payload(payload)
 
+            if metrics is not None:
+                metrics.observe('uds_decode_seconds', time.perf_counter() - t4, service=service)
+
             if not response.positive:
                 while response.code == Response.Code.RequestCorrectlyReceived_ResponsePending:
-                    payload = await asyncio.wait_for(self._reader.read(4095), timeout)
+                    if metrics is not None:
+                        metrics.inc('uds_response_pending_total', service=service)
+                    payload = await self._read(timeout)
                     response = Response.from_payload(payload)
                 else:
                     if not response.positive:
+                        if metrics is not None:
+                            metrics.inc('uds_negative_responses_total', service=service,
+                                        code='0x%02x' % response.code)
                         raise NegativeResponseException(response)
 
+            if metrics is not None:
+                metrics.observe('uds_response_seconds', time.perf_counter() - t3, service=service)
+
             return response
 
-    async def send_raw(self, data: bytes, timeout=None) -> bytes:
+    @instrumented
+    async def execute(self, decoder, full=False, timeout=None, **kwargs):
+        # send a request precompiled by uds.fastpath, the response is checked
+        # on the raw payload and only parsed by udsoncan when full is set
+        if timeout is None:
+            timeout = self._config['request_timeout']
+
+        self._writer.write(decoder.payload)
+
+        payload = await self._read(timeout)
+        while is_pending(payload):
+            if self._metrics is not None:
+                self._metrics.inc('uds_response_pending_total', service=decoder.request.service.get_name())
+            payload = await self._read(timeout)
+
+        if full:
+            return decoder.interpret(payload)
+        return decoder.decode(payload, **kwargs)
+
+    def _interpret(self, service_cls, response, *args, **kwargs):
+        if self._metrics is None:
+            return service_cls.interpret_response(response, *args, **kwargs)
+        t1 = time.perf_counter()
+        try:
+            return service_cls.interpret_response(response, *args, **kwargs)
+        finally:
+            self._metrics.observe('uds_interpret_seconds', time.perf_counter() - t1,
+                                  service=service_cls.get_name())
+
+    async def send_raw(self, data: bytes, timeout=None, skip_pending=False, pending_timeout=None) -> bytes:
         self._writer.write(data)
         if timeout is None:
             return None
         else:
-            payload = await asyncio.wait_for(self._reader.read(4095), timeout)
+            payload = await self._read(timeout)
+            # with skip_pending the final response after any NRC 0x78,
+            # each NRC 0x78 extends the wait to P2* server
+            if pending_timeout is None:
+                pending_timeout = self._config['p2_star_timeout']
+            while skip_pending and is_pending(payload):
+                payload = await self._read(pending_timeout)
             return payload
 
+    @instrumented
     async def change_session(self, newsession, suppress_positive_response=False, timeout=None):
         request = services.DiagnosticSessionControl.make_request(newsession)
 
@@ -49,7 +184,7 @@ class Client(object):
         if response is None:
             return
 
-        services.DiagnosticSessionControl.interpret_response(response)
+        self._interpret(services.DiagnosticSessionControl, response)
 
         if newsession != response.service_data.session_echo:
             raise UnexpectedResponseException(response, 'Response subfunction received from server (0x%02x) does not match the requested subfunction (0x%02x)' % (
@@ -57,6 +192,7 @@ class Client(object):
 
         return response
 
+    @instrumented
     async def request_seed(self, level):
         request = services.SecurityAccess.make_request(
             level, mode=services.SecurityAccess.Mode.RequestSeed)
@@ -66,8 +202,7 @@ class Client(object):
         if response is None:
             return
 
-        services.SecurityAccess.interpret_response(
-            response, mode=services.SecurityAccess.Mode.RequestSeed)
+        self._interpret(services.SecurityAccess, response, mode=services.SecurityAccess.Mode.RequestSeed)
 
         expected_level = services.SecurityAccess.normalize_level(
             mode=services.SecurityAccess.Mode.RequestSeed, level=level)
@@ -79,6 +214,7 @@ class Client(object):
 
         return response
 
+    @instrumented
     async def send_key(self, level, key):
         request = services.SecurityAccess.make_request(
             level, mode=services.SecurityAccess.Mode.SendKey, key=key)
@@ -88,8 +224,7 @@ class Client(object):
         if response is None:
             return
 
-        services.SecurityAccess.interpret_response(
-            response, mode=services.SecurityAccess.Mode.SendKey)
+        self._interpret(services.SecurityAccess, response, mode=services.SecurityAccess.Mode.SendKey)
 
         expected_level = services.SecurityAccess.normalize_level(
             mode=services.SecurityAccess.Mode.SendKey, level=level)
@@ -101,6 +236,7 @@ class Client(object):
 
         return response
 
+    @instrumented
     async def tester_present(self, suppress_positive_response=False, timeout=None):
         request = services.TesterPresent.make_request()
 
@@ -109,7 +245,7 @@ class Client(object):
         if response is None:
             return
 
-        services.TesterPresent.interpret_response(response)
+        self._interpret(services.TesterPresent, response)
 
         if request.subfunction != response.service_data.subfunction_echo:
             raise UnexpectedResponseException(response, 'Response subfunction received from server (0x%02x) does not match the requested subfunction (0x%02x)' % (
@@ -117,6 +253,53 @@ class Client(object):
 
         return response
 
+    async def discard_buffered(self):
+        # answers that came in after their request timed out, they would be
+        # taken for the answer to the next request, or joined onto it
+        while self._reader._buffer:
+            await self._reader.read(len(self._reader._buffer))
+
+    async def wait_until_ready(self, timeout=5, power_down_time=None, did=None, initial_delay=0.01, probe_timeout=0.2,
+                               min_interval=0.01, max_interval=0.5, down_timeout=1.0):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        deadline = start + timeout
+
+        # the ECU will not answer before it has powered down and up again
+        await asyncio.sleep(max(initial_delay, power_down_time or 0))
+
+        if did is None:
+            request = services.TesterPresent.make_request()
+        else:
+            request = services.ReadDataByIdentifier.make_request(
+                didlist=[did], didconfig=self._config['data_identifiers'])
+
+        # it goes down some time after its response to the reset, answers
+        # before a probe went unanswered or was refused still come from the
+        # old run. An outage shorter than the probe interval can be missed,
+        # an ECU that keeps answering for down_timeout is taken as restarted.
+        down = power_down_time is not None
+        # probe_timeout is well above P2 server, so that late answers are rare
+        interval = min_interval
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(
+                    'Server did not answer within %.2f sec' % timeout)
+            await self.discard_buffered()
+            try:
+                await self.send_request(request, timeout=min(probe_timeout, remaining))
+            except (asyncio.TimeoutError, NegativeResponseException):
+                # down, or the server is still initializing
+                down = True
+            else:
+                if down or loop.time() - start >= down_timeout:
+                    return loop.time() - start
+            await asyncio.sleep(min(interval, max(0, deadline - loop.time())))
+            if down:
+                interval = min(interval * 2, max_interval)
+
+    @instrumented
     async def read_data_by_identifier_first(self, didlist):
         didlist = services.ReadDataByIdentifier.validate_didlist_input(didlist)
         response = await self.read_data_by_identifier(didlist)
@@ -124,6 +307,7 @@ class Client(object):
         if len(values) > 0 and len(didlist) > 0:
             return values[didlist[0]]
 
+    @instrumented
     async def read_data_by_identifier(self, didlist):
         didlist = services.ReadDataByIdentifier.validate_didlist_input(didlist)
 
@@ -146,8 +330,7 @@ class Client(object):
         }
 
         try:
-            services.ReadDataByIdentifier.interpret_response(
-                response, **params)
+            self._interpret(services.ReadDataByIdentifier, response, **params)
         except ConfigError as e:
             if e.key in didlist:
                 raise
@@ -170,6 +353,7 @@ class Client(object):
 
         return response
 
+    @instrumented
     async def write_data_by_identifier(self, did, value):
         request = services.WriteDataByIdentifier.make_request(
             did, value, didconfig=self._config['data_identifiers'])
@@ -179,7 +363,7 @@ class Client(object):
         if response is None:
             return
 
-        services.WriteDataByIdentifier.interpret_response(response)
+        self._interpret(services.WriteDataByIdentifier, response)
 
         if response.service_data.did_echo != did:
             raise UnexpectedResponseException(response, 'Server returned a response for data identifier 0x%04x while client requested for did 0x%04x' % (
@@ -187,6 +371,7 @@ class Client(object):
 
         return response
 
+    @instrumented
     async def ecu_reset(self, reset_type, suppress_positive_response=False, timeout=None):
         request = services.ECUReset.make_request(reset_type)
 
@@ -195,7 +380,7 @@ class Client(object):
         if response is None:
             return
 
-        services.ECUReset.interpret_response(response)
+        self._interpret(services.ECUReset, response)
 
         if response.service_data.reset_type_echo != reset_type:
             raise UnexpectedResponseException(response, 'Response subfunction received from server (0x%02x) does not match the requested subfunction (0x%02x)' % (
@@ -203,6 +388,7 @@ class Client(object):
 
         return response
 
+    @instrumented
     async def clear_dtc(self, group=0xFFFFFF):
         request = services.ClearDiagnosticInformation.make_request(group)
 
@@ -211,18 +397,58 @@ class Client(object):
         if response is None:
             return
 
-        services.ClearDiagnosticInformation.interpret_response(response)
+        self._interpret(services.ClearDiagnosticInformation, response)
 
         return response
 
+    @instrumented
     async def start_routine(self, routine_id, data=None):
         response = await self.routine_control(routine_id, services.RoutineControl.ControlType.startRoutine, data)
         return response
 
+    @instrumented
     async def stop_routine(self, routine_id, data=None):
         response = await self.routine_control(routine_id, services.RoutineControl.ControlType.stopRoutine, data)
         return response
 
+    @instrumented
+    async def request_routine_results(self, routine_id, data=None):
+        response = await self.routine_control(routine_id, services.RoutineControl.ControlType.requestRoutineResults, data)
+        return response
+
+    @instrumented
+    async def run_routine(self, routine_id, data=None, is_complete=routine_completed, timeout=60, initial_interval=0.01, max_interval=None, backoff=1.5):
+        # start a routine and poll its results until is_complete(response),
+        # the interval grows by backoff from initial_interval up to P2* so a
+        # short routine is seen done early and a long one is not flooded.
+        # A routine still running on timeout is left to the caller to stop.
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        if max_interval is None:
+            max_interval = self._config['p2_star_timeout']
+
+        response = await self.start_routine(routine_id, data)
+        if is_complete(response):
+            return response
+
+        interval = initial_interval
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(
+                    'Routine 0x%04x did not complete within %.2f sec' % (routine_id, timeout))
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * backoff, max_interval)
+            try:
+                response = await self.request_routine_results(routine_id)
+            except NegativeResponseException as e:
+                if e.response.code not in ROUTINE_BUSY:
+                    raise
+                continue
+            if is_complete(response):
+                return response
+
+    @instrumented
     async def routine_control(self, routine_id, control_type, data=None):
         request = services.RoutineControl.make_request(
             routine_id, control_type, data=data)
@@ -232,7 +458,7 @@ class Client(object):
         if response is None:
             return
 
-        services.RoutineControl.interpret_response(response)
+        self._interpret(services.RoutineControl, response)
 
         if control_type != response.service_data.control_type_echo:
             raise UnexpectedResponseException(response, 'Control type of response (0x%02x) does not match request control type (0x%02x)' % (
@@ -244,6 +470,7 @@ class Client(object):
 
         return response
 
+    @instrumented
     async def communication_control(self, control_type, communication_type, suppress_positive_response=False, timeout=None):
         request = services.CommunicationControl.make_request(
             control_type, communication_type)
@@ -253,7 +480,7 @@ class Client(object):
         if response is None:
             return
 
-        services.CommunicationControl.interpret_response(response)
+        self._interpret(services.CommunicationControl, response)
 
         if control_type != response.service_data.control_type_echo:
             raise UnexpectedResponseException(response, 'Control type of response (0x%02x) does not match request control type (0x%02x)' % (
@@ -261,14 +488,17 @@ class Client(object):
 
         return response
 
+    @instrumented
     async def request_download(self, memory_location, dfi=None):
         response = await self.request_upload_download(services.RequestDownload, memory_location, dfi)
         return response
 
+    @instrumented
     async def request_upload(self, memory_location, dfi=None):
         response = await self.request_upload_download(services.RequestUpload, memory_location, dfi)
         return response
 
+    @instrumented
     async def request_upload_download(self, service_cls, memory_location, dfi=None):
         dfi = service_cls.normalize_data_format_identifier(dfi)
 
@@ -296,10 +526,11 @@ class Client(object):
         if response is None:
             return
 
-        service_cls.interpret_response(response)
+        self._interpret(service_cls, response)
 
         return response
 
+    @instrumented
     async def transfer_data(self, sequence_number, data=None):
         request = services.TransferData.make_request(sequence_number, data)
 
@@ -308,7 +539,7 @@ class Client(object):
         if response is None:
             return
 
-        services.TransferData.interpret_response(response)
+        self._interpret(services.TransferData, response)
 
         if sequence_number != response.service_data.sequence_number_echo:
             raise UnexpectedResponseException(response, 'Block sequence number of response (0x%02x) does not match request block sequence number (0x%02x)' % (
@@ -316,6 +547,7 @@ class Client(object):
 
         return response
 
+    @instrumented
     async def request_transfer_exit(self, data=None):
         request = services.RequestTransferExit.make_request(data)
 
@@ -324,10 +556,128 @@ class Client(object):
         if response is None:
             return
 
-        services.RequestTransferExit.interpret_response(response)
+        self._interpret(services.RequestTransferExit, response)
 
         return response
 
+    def _memory_location(self, address, size, address_format=None, memorysize_format=None) -> MemoryLocation:
+        memory_location = MemoryLocation(address, size, address_format, memorysize_format)
+        memory_location.set_format_if_none(
+            address_format=self._config.get('server_address_format'),
+            memorysize_format=self._config.get('server_memorysize_format'))
+        return memory_location
+
+    def _memory_formats(self, address, size, address_format=None, memorysize_format=None):
+        # one format for all chunks of a range, the one that fits the whole range
+        memory_location = self._memory_location(address + size, size, address_format, memorysize_format)
+        return memory_location.alfid.address_format, memory_location.alfid.memorysize_format
+
+    @instrumented
+    async def read_memory_by_address(self, memory_location, timeout=None):
+        if not isinstance(memory_location, MemoryLocation):
+            raise ValueError(
+                'memory_location must be an instance of MemoryLocation')
+
+        request = services.ReadMemoryByAddress.make_request(memory_location)
+
+        response = await self.send_request(request, False, timeout)
+
+        if response is None:
+            return
+
+        self._interpret(services.ReadMemoryByAddress, response)
+
+        if len(response.service_data.memory_block) != memory_location.memorysize:
+            raise UnexpectedResponseException(response, 'Server returned %d bytes of memory, %d were requested' % (
+                len(response.service_data.memory_block), memory_location.memorysize))
+
+        return response
+
+    @instrumented
+    async def write_memory_by_address(self, memory_location, data, timeout=None):
+        if not isinstance(memory_location, MemoryLocation):
+            raise ValueError(
+                'memory_location must be an instance of MemoryLocation')
+
+        request = services.WriteMemoryByAddress.make_request(memory_location, data)
+
+        response = await self.send_request(request, False, timeout)
+
+        if response is None:
+            return
+
+        self._interpret(services.WriteMemoryByAddress, response, memory_location)
+
+        return response
+
+    async def _transfer_chunks(self, address, size, chunk_size, retries, transfer):
+        # transfer(address, offset, length) for every chunk. Chunks refused as
+        # too long (NRC 0x13/0x14) are split and the smaller size is kept for
+        # the rest, other failures are retried once all chunks have been tried.
+        pending = collections.deque((offset, min(chunk_size, size - offset))
+                                    for offset in range(0, size, chunk_size))
+        for _ in range(retries + 1):
+            failed = []
+            while pending:
+                offset, length = pending.popleft()
+                if length > chunk_size:
+                    pending.extendleft(reversed([(offset + i, min(chunk_size, length - i))
+                                                 for i in range(0, length, chunk_size)]))
+                    continue
+                try:
+                    await transfer(address + offset, offset, length)
+                except NegativeResponseException as e:
+                    if e.response.code in MEMORY_CHUNK_TOO_LONG and length > 1:
+                        chunk_size = length // 2
+                        pending.appendleft((offset, length))
+                    else:
+                        failed.append(((offset, length), e))
+                except asyncio.TimeoutError as e:
+                    failed.append(((offset, length), e))
+            if not failed:
+                return
+            pending.extend(chunk for chunk, _ in failed)
+        raise failed[-1][1]
+
+    @instrumented
+    async def read_memory(self, address, size, chunk_size=None, retries=2, address_format=None, memorysize_format=None) -> bytearray:
+        # ReadMemoryByAddress of a range of any size, chunk_size defaults to
+        # what fits in one response
+        if chunk_size is None:
+            chunk_size = MAX_PDU_LENGTH - 1
+        memory = bytearray(size)
+        if size == 0:
+            return memory
+        view = memoryview(memory)
+        address_format, memorysize_format = self._memory_formats(address, size, address_format, memorysize_format)
+
+        async def transfer(chunk_address, offset, length):
+            memory_location = self._memory_location(chunk_address, length, address_format, memorysize_format)
+            response = await self.read_memory_by_address(memory_location)
+            view[offset:offset + length] = response.service_data.memory_block
+
+        await self._transfer_chunks(address, size, chunk_size, retries, transfer)
+        return memory
+
+    @instrumented
+    async def write_memory(self, address, data, chunk_size=None, retries=2, address_format=None, memorysize_format=None):
+        # WriteMemoryByAddress of a range of any size, chunk_size defaults to
+        # what fits in one request
+        view = memoryview(bytes(data))
+        if len(view) == 0:
+            return
+        address_format, memorysize_format = self._memory_formats(address, len(view), address_format, memorysize_format)
+        if chunk_size is None:
+            # SID, addressAndLengthFormatIdentifier, address and size
+            chunk_size = MAX_PDU_LENGTH - 2 - address_format // 8 - memorysize_format // 8
+
+        async def transfer(chunk_address, offset, length):
+            memory_location = self._memory_location(chunk_address, length, address_format, memorysize_format)
+            await self.write_memory_by_address(memory_location, bytes(view[offset:offset + length]))
+
+        await self._transfer_chunks(address, len(view), chunk_size, retries, transfer)
+
+    @instrumented
     async def control_dtc_setting(self, setting_type, data=None, suppress_positive_response=False, timeout=None):
         request = services.ControlDTCSetting.make_request(
             setting_type, data=data)
@@ -337,7 +687,7 @@ class Client(object):
         if response is None:
             return
 
-        services.ControlDTCSetting.interpret_response(response)
+        self._interpret(services.ControlDTCSetting, response)
 
         if response.service_data.setting_type_echo != setting_type:
             raise UnexpectedResponseException(response, 'Setting type of response (0x%02x) does not match request control type (0x%02x)' % (
@@ -345,6 +695,7 @@ class Client(object):
 
         return response
 
+    @instrumented
     async def get_dtc_by_status_mask(self, status_mask, timeout=None):
         request = services.ReadDTCInformation.make_request(
             services.ReadDTCInformation.Subfunction.reportDTCByStatusMask, status_mask)
@@ -354,8 +705,7 @@ class Client(object):
         if response is None:
             return
 
-        services.ReadDTCInformation.interpret_response(
-            response, services.ReadDTCInformation.Subfunction.reportDTCByStatusMask)
+        self._interpret(services.ReadDTCInformation, response, services.ReadDTCInformation.Subfunction.reportDTCByStatusMask)
 
         if response.service_data.subfunction_echo != services.ReadDTCInformation.Subfunction.reportDTCByStatusMask:
             raise UnexpectedResponseException(response, 'Echo of ReadDTCInformation subfunction gotten from server(0x%02x) does not match the value in the request subfunction (0x%02x)' % (
@@ -363,6 +713,7 @@ class Client(object):
 
         return response
 
+    @instrumented
     async def get_number_of_dtc_by_status_mask(self, status_mask, timeout=None):
         request = services.ReadDTCInformation.make_request(
             services.ReadDTCInformation.Subfunction.reportNumberOfDTCByStatusMask, status_mask)
@@ -372,8 +723,7 @@ class Client(object):
         if response is None:
             return
 
-        services.ReadDTCInformation.interpret_response(
-            response, services.ReadDTCInformation.Subfunction.reportNumberOfDTCByStatusMask)
+        self._interpret(services.ReadDTCInformation, response, services.ReadDTCInformation.Subfunction.reportNumberOfDTCByStatusMask)
 
         if response.service_data.subfunction_echo != services.ReadDTCInformation.Subfunction.reportNumberOfDTCByStatusMask:
             raise UnexpectedResponseException(response, 'Echo of ReadDTCInformation subfunction gotten from server(0x%02x) does not match the value in the request subfunction (0x%02x)' % (
@@ -381,6 +731,7 @@ class Client(object):
 
         return response
 
+    @instrumented
     async def get_supported_dtc(self, timeout=None):
         request = services.ReadDTCInformation.make_request(
             services.ReadDTCInformation.Subfunction.reportSupportedDTCs)
@@ -390,11 +741,77 @@ class Client(object):
         if response is None:
             return
 
-        services.ReadDTCInformation.interpret_response(
-            response, services.ReadDTCInformation.Subfunction.reportSupportedDTCs)
+        self._interpret(services.ReadDTCInformation, response, services.ReadDTCInformation.Subfunction.reportSupportedDTCs)
 
         if response.service_data.subfunction_echo != services.ReadDTCInformation.Subfunction.reportSupportedDTCs:
             raise UnexpectedResponseException(response, 'Echo of ReadDTCInformation subfunction gotten from server(0x%02x) does not match the value in the request subfunction (0x%02x)' % (
                 response.service_data.subfunction_echo, services.ReadDTCInformation.Subfunction.reportSupportedDTCs))
 
         return response
+
+    @instrumented
+    async def get_dtc_snapshot_identification(self, timeout=None):
+        request = services.ReadDTCInformation.make_request(
+            services.ReadDTCInformation.Subfunction.reportDTCSnapshotIdentification)
+
+        response = await self.send_request(request, False, timeout)
+
+        if response is None:
+            return
+
+        self._interpret(services.ReadDTCInformation, response, services.ReadDTCInformation.Subfunction.reportDTCSnapshotIdentification,
+                        tolerate_zero_padding=self._config['tolerate_zero_padding'],
+                        ignore_all_zero_dtc=self._config['ignore_all_zero_dtc'])
+
+        if response.service_data.subfunction_echo != services.ReadDTCInformation.Subfunction.reportDTCSnapshotIdentification:
+            raise UnexpectedResponseException(response, 'Echo of ReadDTCInformation subfunction gotten from server(0x%02x) does not match the value in the request subfunction (0x%02x)' % (
+                response.service_data.subfunction_echo, services.ReadDTCInformation.Subfunction.reportDTCSnapshotIdentification))
+
+        return response
+
+    @instrumented
+    async def get_dtc_snapshot_by_dtc_number(self, dtc, record_number=0xFF, didconfig=None, timeout=None):
+        # didconfig holds the codecs of the snapshot DIDs, the
+        # data_identifiers of the config by default
+        if didconfig is None:
+            didconfig = self._config.get('data_identifiers')
+
+        request = services.ReadDTCInformation.make_request(
+            services.ReadDTCInformation.Subfunction.reportDTCSnapshotRecordByDTCNumber, dtc=dtc, snapshot_record_number=record_number)
+
+        response = await self.send_request(request, False, timeout)
+
+        if response is None:
+            return
+
+        self._interpret(services.ReadDTCInformation, response, services.ReadDTCInformation.Subfunction.reportDTCSnapshotRecordByDTCNumber,
+                        tolerate_zero_padding=self._config['tolerate_zero_padding'],
+                        ignore_all_zero_dtc=self._config['ignore_all_zero_dtc'],
+                        dtc_snapshot_did_size=self._config['dtc_snapshot_did_size'],
+                        didconfig=didconfig)
+
+        if response.service_data.subfunction_echo != services.ReadDTCInformation.Subfunction.reportDTCSnapshotRecordByDTCNumber:
+            raise UnexpectedResponseException(response, 'Echo of ReadDTCInformation subfunction gotten from server(0x%02x) does not match the value in the request subfunction (0x%02x)' % (
+                response.service_data.subfunction_echo, services.ReadDTCInformation.Subfunction.reportDTCSnapshotRecordByDTCNumber))
+
+        if response.service_data.dtcs[0].id != dtc:
+            raise UnexpectedResponseException(response, 'Server returned snapshots of DTC 0x%06x while client requested for DTC 0x%06x' % (
+                response.service_data.dtcs[0].id, dtc))
+
+        return response
+
+
+@contextlib.asynccontextmanager
+async def open_client(network, rx_id, tx_id, config=default_client_config, metrics=None, **kwargs):
+    # e.g. with a uds.isotp.ISOTPNetwork, the connection is closed on exit
+    reader, writer = await network.open_connection(rx_id, tx_id, **kwargs)
+    async with Client(reader, writer, config, metrics) as client:
+        yield client
+
+
+async def run_routines(routines: dict, **kwargs) -> dict:
+    # {name: response or exception} for {name: (client, routine_id)}, the
+    # routines run at the same time and one failing does not stop the others
+    results = await asyncio.gather(*(client.run_routine(routine_id, **kwargs)
+                                     for client, routine_id in routines.values()), return_exceptions=True)
+    return dict(zip(routines, results))
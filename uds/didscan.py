@@ -0,0 +1,189 @@
+import json
+import struct
+import asyncio
+import logging
+from collections import deque
+
+from udsoncan import Request, DidCodec, services
+from udsoncan.exceptions import NegativeResponseException
+
+
+logger = logging.getLogger(__name__)
+
+# split the batch, some DIDs of it may still be readable
+NRC_INCORRECT_LENGTH = 0x13
+NRC_RESPONSE_TOO_LONG = 0x14
+NRC_REQUEST_OUT_OF_RANGE = 0x31
+
+# 1 + 2 * n request bytes within the ISO-TP limit of 4095
+MAX_BATCH_SIZE = 2047
+
+
+class RawCodec(DidCodec):
+    # the value as it was read, for DIDs found by a scan
+
+    def __init__(self, data_len):
+        self.data_len = data_len
+
+    def encode(self, data_bytes):
+        if len(data_bytes) != self.data_len:
+            raise ValueError('Data must be %d long' % self.data_len)
+        return bytes(data_bytes)
+
+    def decode(self, data_bytes):
+        return bytes(data_bytes)
+
+    def __len__(self):
+        return self.data_len
+
+
+class DidRecord(object):
+
+    def __init__(self, did, data=None, nrc=None):
+        # data is the value read, nrc the answer to a single DID request
+        # for a DID the ECU knows but would not read
+        self.did = did
+        self.data = data
+        self.nrc = nrc
+
+    @property
+    def supported(self) -> bool:
+        return self.data is not None
+
+    @property
+    def length(self):
+        return None if self.data is None else len(self.data)
+
+    def __repr__(self):
+        if self.data is None:
+            return 'DidRecord(0x%04x, nrc=0x%02x)' % (self.did, self.nrc)
+        return 'DidRecord(0x%04x, length=%d)' % (self.did, len(self.data))
+
+
+def single_did_value(data: bytes, batch) -> tuple:
+    # (did, value) when the response data after the SID holds only one of
+    # the requested DIDs. The values have unknown lengths, so a response with
+    # another requested DID in it cannot be split and is bisected instead.
+    if len(data) < 3:
+        return None
+    did = data[0] << 8 | data[1]
+    if did not in batch:
+        return None
+    others = {struct.pack('>H', other) for other in batch if other != did}
+    view = bytes(data)
+    for i in range(3, len(view) - 1):
+        if view[i:i + 2] in others:
+            return None
+    return did, view[2:]
+
+
+class DidScanner(object):
+    # Multi-DID ReadDataByIdentifier sweep. Unsupported DIDs are left out of
+    # a response and NRC 0x31 means that none in the request are supported,
+    # so sparse ranges cost one request per batch. Batches with answers are
+    # bisected down to single DIDs.
+
+    def __init__(self, client, batch_size=32, timeout=None):
+        self.client = client
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.timeout = timeout
+        self.requests = 0
+        # single DIDs that did not answer in time
+        self.timeouts = []
+
+    async def _read(self, batch):
+        # (response data, None) or (None, NRC), None, None on a timeout
+        self.requests += 1
+        request = Request(services.ReadDataByIdentifier,
+                          data=b''.join(struct.pack('>H', did) for did in batch))
+        try:
+            response = await self.client.send_request(request, timeout=self.timeout)
+        except NegativeResponseException as e:
+            return None, e.response.code
+        except asyncio.TimeoutError:
+            return None, None
+        return response.data, None
+
+    async def scan(self, ranges=(range(0x10000), )) -> dict:
+        # {did: DidRecord} of the DIDs that were read or refused one by one
+        records = {}
+        pending = deque()
+        for did_range in ranges:
+            dids = list(did_range)
+            for i in range(0, len(dids), self.batch_size):
+                pending.append(dids[i:i + self.batch_size])
+
+        while pending:
+            batch = pending.popleft()
+            if len(batch) > self.batch_size:
+                # the ECU taught us a lower limit after the batch was queued
+                pending.extendleft(reversed([batch[i:i + self.batch_size]
+                                             for i in range(0, len(batch), self.batch_size)]))
+                continue
+
+            data, nrc = await self._read(batch)
+
+            if data is not None:
+                value = single_did_value(data, batch)
+                if value is not None:
+                    did, value = value
+                    records[did] = DidRecord(did, value)
+                    logger.info('0x%04x: %d bytes', did, len(value))
+                    continue
+                if len(batch) == 1:
+                    logger.warning('0x%04x: response 0x%s does not match the request',
+                                   batch[0], bytes(data).hex())
+                    continue
+            elif nrc == NRC_REQUEST_OUT_OF_RANGE:
+                continue
+            elif len(batch) == 1:
+                if nrc is None:
+                    logger.warning('0x%04x: no response', batch[0])
+                    self.timeouts.append(batch[0])
+                else:
+                    records[batch[0]] = DidRecord(batch[0], nrc=nrc)
+                    logger.info('0x%04x: NRC 0x%02x', batch[0], nrc)
+                continue
+            elif nrc in (NRC_INCORRECT_LENGTH, NRC_RESPONSE_TOO_LONG):
+                # too many DIDs in one request or response for this ECU
+                self.batch_size = max(1, min(self.batch_size, len(batch) // 2))
+                logger.debug('batch size lowered to %d', self.batch_size)
+
+            half = len(batch) // 2
+            pending.extendleft((batch[half:], batch[:half]))
+
+        logger.info('%d DIDs found with %d requests', len(records), self.requests)
+        return records
+
+
+async def scan_dids(client, ranges=(range(0x10000), ), **kwargs) -> dict:
+    return await DidScanner(client, **kwargs).scan(ranges)
+
+
+def didconfig(records: dict) -> dict:
+    # config['data_identifiers'] entries for the supported DIDs
+    return {did: RawCodec(record.length) for did, record in records.items() if record.supported}
+
+
+def save_did_map(path, records: dict):
+    did_map = {}
+    for did, record in sorted(records.items()):
+        if record.supported:
+            did_map['%04X' % did] = {'length': record.length, 'data': record.data.hex()}
+        else:
+            did_map['%04X' % did] = {'nrc': record.nrc}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(did_map, f, indent=4)
+
+
+def load_did_map(path) -> dict:
+    with open(path, encoding='utf-8') as f:
+        did_map = json.load(f)
+    records = {}
+    for key, entry in did_map.items():
+        did = int(key, 16)
+        if 'data' in entry:
+            records[did] = DidRecord(did, bytes.fromhex(entry['data']))
+        else:
+            records[did] = DidRecord(did, nrc=entry['nrc'])
+    return records
@@ -0,0 +1,176 @@
+import json
+import asyncio
+import logging
+
+import can
+from can import BusABC, Message
+
+from uds import isotp
+
+
+logger = logging.getLogger(__name__)
+
+# TesterPresent and its positive or negative response
+TESTER_PRESENT = bytes([0x3E, 0x00])
+# DiagnosticSessionControl default session
+DEFAULT_SESSION = bytes([0x10, 0x01])
+# functional request IDs, every ECU answers a probe on them, OBD 11 and 29 bit
+FUNCTIONAL_IDS = (0x7DF, 0x18DB33F1)
+
+
+def normal_fixed_id(target_address, source_address, priority=6) -> int:
+    # ISO 15765-2 normal fixed addressing, physical N_TAtype
+    return priority << 26 | 0xDA << 16 | target_address << 8 | source_address
+
+
+def is_response(data: bytes, request: bytes) -> bool:
+    if len(data) < 3 or isotp.pci_type(data) != isotp.PCIType.SingleFrame:
+        return False
+    sid = data[1]
+    return sid == request[0] + 0x40 or (sid == 0x7F and data[2] == request[0])
+
+
+class Responder(object):
+
+    def __init__(self, tx_id, rx_id, is_extended_id):
+        self.tx_id = tx_id
+        self.rx_id = rx_id
+        self.is_extended_id = is_extended_id
+
+    @property
+    def name(self):
+        return 'ecu_%x' % self.tx_id
+
+    def __repr__(self):
+        return 'Responder(tx_id=0x%x, rx_id=0x%x)' % (self.tx_id, self.rx_id)
+
+
+class Scanner(object):
+
+    def __init__(self, bus: BusABC, request=TESTER_PRESENT, probes_per_timeout=32, timeout=0.05, padding=0x00,
+                 functional_ids=FUNCTIONAL_IDS):
+        self.bus = bus
+        self.request = request
+        # the probes are spread so that this many are sent per timeout
+        self.probes_per_timeout = probes_per_timeout
+        self.timeout = timeout
+        self.padding = padding
+        # never probed, they would map all ECUs to them
+        self.functional_ids = set(functional_ids)
+
+        self._loop = None
+        self._responses = []
+
+    def _send_probe(self, arb_id, is_extended_id):
+        data = isotp.pad(isotp.encode_single_frame(self.request), 8, self.padding)
+        self.bus.send(Message(arbitration_id=arb_id, dlc=len(data),
+                              is_extended_id=is_extended_id, data=data))
+
+    def _on_message_received(self, msg: Message):
+        # called from the notifier thread, or by a simulated bus
+        self._loop.call_soon_threadsafe(self._message_received, msg)
+
+    def _message_received(self, msg: Message):
+        if not msg.is_error_frame and is_response(bytes(msg.data), self.request):
+            self._responses.append((self._loop.time(), msg.arbitration_id, msg.is_extended_id))
+
+    async def _probe(self, ids, is_extended_id):
+        # a probe waits one timeout for its answer, the answers that arrive
+        # within it are narrowed down by _resolve
+        sent = []
+        interval = self.timeout / self.probes_per_timeout
+        for arb_id in ids:
+            self._send_probe(arb_id, is_extended_id)
+            sent.append((self._loop.time(), arb_id))
+            await asyncio.sleep(interval)
+        await asyncio.sleep(self.timeout)
+        return sent
+
+    async def _resolve(self, rx_id, candidates, is_extended_id):
+        # bisect the probes that were in flight when rx_id answered
+        while len(candidates) > 1:
+            half = candidates[:len(candidates) // 2]
+            self._responses.clear()
+            await self._probe(half, is_extended_id)
+            if any(r[1] == rx_id for r in self._responses):
+                candidates = half
+            else:
+                candidates = candidates[len(candidates) // 2:]
+        return candidates[0] if candidates else None
+
+    async def scan(self, ids=range(0x700, 0x800), extended_ids=()):
+        self._loop = asyncio.get_event_loop()
+        self._responses = []
+        # a simulated bus (uds.sim) calls its listeners itself, no thread
+        simulated = hasattr(self.bus, 'add_listener')
+        if simulated:
+            self.bus.add_listener(self._on_message_received)
+        else:
+            notifier = can.Notifier(self.bus, [self._on_message_received])
+        responders = []
+        try:
+            # 29-bit normal fixed addressing carries both addresses in the ID
+            extended_ids = [arb_id for arb_id in extended_ids if arb_id not in self.functional_ids]
+            if extended_ids:
+                await self._probe(extended_ids, True)
+                for _, rx_id, is_extended_id in self._responses:
+                    if is_extended_id and rx_id >> 16 & 0xFF == 0xDA:
+                        tx_id = rx_id & ~0xFFFF | (rx_id & 0xFF) << 8 | (rx_id >> 8 & 0xFF)
+                        responders.append(Responder(tx_id, rx_id, True))
+
+            ids = [arb_id for arb_id in ids if arb_id not in self.functional_ids]
+            if ids:
+                self._responses.clear()
+                sent = await self._probe(ids, False)
+                responses = [r for r in self._responses if not r[2]]
+                found = set()
+                for t, rx_id, _ in responses:
+                    if rx_id in found:
+                        continue
+                    found.add(rx_id)
+                    candidates = [arb_id for t_sent, arb_id in sent
+                                  if t - self.timeout <= t_sent <= t]
+                    tx_id = await self._resolve(rx_id, candidates, False)
+                    if tx_id is not None:
+                        responders.append(Responder(tx_id, rx_id, False))
+        finally:
+            if simulated:
+                self.bus.remove_listener(self._on_message_received)
+            else:
+                notifier.stop()
+
+        for responder in responders:
+            logger.info('found %r', responder)
+        return responders
+
+
+async def discover(bus: BusABC, ids=range(0x700, 0x800), extended_ids=(), **kwargs):
+    filters = bus.filters
+    # responses can arrive on any ID
+    bus.set_filters(None)
+    try:
+        return await Scanner(bus, **kwargs).scan(ids, extended_ids)
+    finally:
+        bus.set_filters(filters)
+
+
+def save_address_map(path, responders):
+    address_map = {
+        responder.name: {
+            'tx_id': responder.tx_id,
+            'rx_id': responder.rx_id,
+            'is_extended_id': responder.is_extended_id,
+        } for responder in responders
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(address_map, f, indent=4)
+
+
+def load_address_map(path) -> dict:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def address_pairs(address_map: dict) -> dict:
+    # the ecus argument of uds.functional.open_functional_client
+    return {name: (ecu['rx_id'], ecu['tx_id']) for name, ecu in address_map.items()}
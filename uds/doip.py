@@ -0,0 +1,354 @@
+import socket
+import struct
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+PROTOCOL_VERSION = 0x02
+TCP_DATA_PORT = 13400
+UDP_DISCOVERY_PORT = 13400
+HEADER = struct.Struct('>BBHI')
+
+# tester logical address, 0x0E00 - 0x0FFF are external test equipment
+SOURCE_ADDRESS = 0x0E00
+# time to wait for a routing activation response or a diagnostic message ACK
+A_DoIP_Ctrl = 2.0
+A_DoIP_Diagnostic_Message = 2.0
+
+
+class PayloadType(object):
+    GenericNack = 0x0000
+    VehicleIdentificationRequest = 0x0001
+    VehicleIdentificationRequestEID = 0x0002
+    VehicleIdentificationRequestVIN = 0x0003
+    VehicleAnnouncement = 0x0004
+    RoutingActivationRequest = 0x0005
+    RoutingActivationResponse = 0x0006
+    AliveCheckRequest = 0x0007
+    AliveCheckResponse = 0x0008
+    DiagnosticMessage = 0x8001
+    DiagnosticMessageAck = 0x8002
+    DiagnosticMessageNack = 0x8003
+
+
+class ActivationType(object):
+    Default = 0x00
+    WWH_OBD = 0x01
+    CentralSecurity = 0xE0
+
+
+class RoutingActivationCode(object):
+    UnknownSourceAddress = 0x00
+    AllSocketsRegistered = 0x01
+    SourceAddressMismatch = 0x02
+    SourceAddressAlreadyActive = 0x03
+    MissingAuthentication = 0x04
+    RejectedConfirmation = 0x05
+    UnsupportedActivationType = 0x06
+    Success = 0x10
+    ConfirmationRequired = 0x11
+
+
+class DoIPError(ConnectionError):
+    pass
+
+
+def encode_message(payload_type: int, payload: bytes = b'') -> bytes:
+    return HEADER.pack(PROTOCOL_VERSION, PROTOCOL_VERSION ^ 0xFF, payload_type, len(payload)) + payload
+
+
+def decode_header(data: bytes):
+    # (payload_type, payload_length), only the inverse version byte is checked
+    version, inverse, payload_type, length = HEADER.unpack_from(data)
+    if version ^ 0xFF != inverse:
+        raise DoIPError('Invalid DoIP header 0x%s' % bytes(data[:HEADER.size]).hex())
+    return payload_type, length
+
+
+def encode_routing_activation_request(source_address, activation_type=ActivationType.Default) -> bytes:
+    # 4 reserved bytes, the OEM specific part is left out
+    return encode_message(PayloadType.RoutingActivationRequest,
+                          struct.pack('>HBI', source_address, activation_type, 0))
+
+
+def encode_diagnostic_message(source_address, target_address, data: bytes) -> bytes:
+    return encode_message(PayloadType.DiagnosticMessage,
+                          struct.pack('>HH', source_address, target_address) + bytes(data))
+
+
+class VehicleAnnouncement(object):
+
+    def __init__(self, host, vin, logical_address, eid, gid, further_action, sync_status=None):
+        self.host = host
+        self.vin = vin
+        self.logical_address = logical_address
+        self.eid = eid
+        self.gid = gid
+        self.further_action = further_action
+        self.sync_status = sync_status
+
+    @classmethod
+    def from_payload(cls, host, payload: bytes):
+        vin = payload[0:17].decode('ascii', 'replace')
+        logical_address, = struct.unpack_from('>H', payload, 17)
+        sync_status = payload[32] if len(payload) > 32 else None
+        return cls(host, vin, logical_address, payload[19:25], payload[25:31], payload[31], sync_status)
+
+    def __repr__(self):
+        return 'VehicleAnnouncement(host=%r, vin=%r, logical_address=0x%04x)' % (
+            self.host, self.vin, self.logical_address)
+
+
+class DoIPStreamReader(asyncio.StreamReader):
+    # A NACK or a missing ACK ends the read of the response to its request
+    # only. set_exception would end every later read on the connection.
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # resolved with None when the gateway ACKs the last request written,
+        # with the DoIPError that ended it otherwise
+        self._request = None
+
+    def request_written(self, request: asyncio.Future):
+        self._request = request
+
+    def request_failed(self, error: DoIPError):
+        # an unsolicited NACK, for the request that is waiting if any
+        if self._request is not None and not self._request.done():
+            self._request.set_result(error)
+        else:
+            logger.warning('%s', error)
+
+    async def read(self, n=-1):
+        request = self._request
+        if request is None or self._buffer or (request.done() and request.result() is None):
+            return await super().read(n)
+        read = asyncio.ensure_future(super().read(n))
+        try:
+            await asyncio.wait((read, request), return_when=asyncio.FIRST_COMPLETED)
+            if not read.done() and request.result() is not None:
+                self._request = None
+                raise request.result()
+            return await read
+        finally:
+            read.cancel()
+
+
+class DoIPProtocol(asyncio.StreamReaderProtocol):
+    # Frames the TCP stream into DoIP messages. Diagnostic messages from the
+    # target are fed to the StreamReader one UDS response at a time.
+
+    def __init__(self, reader: DoIPStreamReader, source_address=SOURCE_ADDRESS):
+        super().__init__(reader)
+        self._reader = reader
+        self.source_address = source_address
+        self.target_address = None
+
+        self._buffer = bytearray()
+        self._activation = None
+        self._ack = None
+
+    def connection_lost(self, exc):
+        for waiter in (self._activation, self._ack):
+            if waiter is not None and not waiter.done():
+                waiter.set_exception(exc or DoIPError('Connection closed'))
+        super().connection_lost(exc)
+
+    def eof_received(self):
+        return False
+
+    def data_received(self, data):
+        self._buffer += data
+        while len(self._buffer) >= HEADER.size:
+            try:
+                payload_type, length = decode_header(self._buffer)
+            except DoIPError as e:
+                self._reader.set_exception(e)
+                self._transport.close()
+                return
+            end = HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            payload = bytes(self._buffer[HEADER.size:end])
+            del self._buffer[:end]
+            self._message_received(payload_type, payload)
+
+    def _message_received(self, payload_type, payload: bytes):
+        if payload_type == PayloadType.DiagnosticMessage:
+            source_address, target_address = struct.unpack_from('>HH', payload)
+            if target_address == self.source_address:
+                self._reader.feed_data(payload[4:])
+
+        elif payload_type == PayloadType.DiagnosticMessageAck:
+            if self._ack is not None and not self._ack.done():
+                self._ack.set_result(payload)
+
+        elif payload_type == PayloadType.DiagnosticMessageNack:
+            source_address, target_address, code = struct.unpack_from('>HHB', payload)
+            error = DoIPError('Diagnostic message to 0x%04x was rejected with NACK 0x%02x' % (source_address, code))
+            if self._ack is not None and not self._ack.done():
+                self._ack.set_exception(error)
+            else:
+                # no write is waiting, the client reading the response gets it
+                self._reader.request_failed(error)
+
+        elif payload_type == PayloadType.RoutingActivationResponse:
+            if self._activation is not None and not self._activation.done():
+                self._activation.set_result(payload)
+
+        elif payload_type == PayloadType.AliveCheckRequest:
+            self._transport.write(encode_message(PayloadType.AliveCheckResponse,
+                                                 struct.pack('>H', self.source_address)))
+
+        elif payload_type == PayloadType.GenericNack:
+            error = DoIPError('Gateway sent generic NACK 0x%02x' % payload[0])
+            for waiter in (self._activation, self._ack):
+                if waiter is not None and not waiter.done():
+                    waiter.set_exception(error)
+                    break
+            else:
+                self._reader.request_failed(error)
+
+        else:
+            logger.debug('ignored DoIP payload type 0x%04x', payload_type)
+
+    async def activate_routing(self, activation_type=ActivationType.Default, timeout=A_DoIP_Ctrl):
+        self._activation = asyncio.get_event_loop().create_future()
+        self._transport.write(encode_routing_activation_request(self.source_address, activation_type))
+        payload = await asyncio.wait_for(self._activation, timeout)
+        tester_address, gateway_address, code = struct.unpack_from('>HHB', payload)
+        if tester_address != self.source_address:
+            raise DoIPError('Routing activation response for tester 0x%04x, expected 0x%04x' % (
+                tester_address, self.source_address))
+        if code != RoutingActivationCode.Success:
+            raise DoIPError('Routing activation was denied with code 0x%02x' % code)
+        return gateway_address
+
+    async def send_diagnostic_message(self, target_address, data: bytes, timeout=A_DoIP_Diagnostic_Message):
+        self._ack = asyncio.get_event_loop().create_future()
+        self._transport.write(encode_diagnostic_message(self.source_address, target_address, data))
+        try:
+            await asyncio.wait_for(self._ack, timeout)
+        finally:
+            self._ack = None
+
+
+class DoIPTransport(asyncio.Transport):
+    # Diagnostic messages to one target address, written in order, each one
+    # waiting for the gateway's ACK before the next one is sent
+
+    def __init__(self, protocol: DoIPProtocol, target_address, tcp_transport: asyncio.Transport):
+        super().__init__()
+        self._protocol = protocol
+        self._target_address = target_address
+        self._tcp_transport = tcp_transport
+        self._loop = asyncio.get_event_loop()
+        self._tx_queue = asyncio.Queue()
+        self._tx_task = self._loop.create_task(self._tx_loop())
+        self._closing = False
+
+    @property
+    def target_address(self):
+        return self._target_address
+
+    def get_protocol(self):
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def get_extra_info(self, name, default=None):
+        return self._tcp_transport.get_extra_info(name, default)
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._tx_task.cancel()
+        self._tcp_transport.close()
+
+    def abort(self):
+        self._closing = True
+        self._tx_task.cancel()
+        self._tcp_transport.abort()
+
+    def write(self, data):
+        if self._closing:
+            raise RuntimeError('Transport is closing')
+        request = self._loop.create_future()
+        self._protocol._reader.request_written(request)
+        self._tx_queue.put_nowait((bytes(data), request))
+
+    def can_write_eof(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return self._tx_queue.qsize()
+
+    async def _tx_loop(self):
+        while True:
+            data, request = await self._tx_queue.get()
+            error = None
+            try:
+                await self._protocol.send_diagnostic_message(self._target_address, data)
+            except asyncio.TimeoutError:
+                # the request was lost, its read fails instead of waiting for P2
+                error = DoIPError('No diagnostic message ACK from 0x%04x' % self._target_address)
+            except DoIPError as e:
+                error = e
+            # an unsolicited NACK may have ended it already
+            if not request.done():
+                request.set_result(error)
+
+
+async def open_connection(host, target_address, port=TCP_DATA_PORT, source_address=SOURCE_ADDRESS, activation_type=ActivationType.Default):
+    # reader and writer for uds.client.Client, routing is activated before
+    # the connection is returned
+    loop = asyncio.get_event_loop()
+    reader = DoIPStreamReader()
+    protocol = DoIPProtocol(reader, source_address)
+    tcp_transport, _ = await loop.create_connection(lambda: protocol, host, port)
+    try:
+        await protocol.activate_routing(activation_type)
+    except Exception:
+        tcp_transport.close()
+        raise
+    protocol.target_address = target_address
+    transport = DoIPTransport(protocol, target_address, tcp_transport)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.announcements = []
+
+    def datagram_received(self, data, addr):
+        try:
+            payload_type, length = decode_header(data)
+        except (DoIPError, struct.error):
+            return
+        if payload_type == PayloadType.VehicleAnnouncement and length >= 32:
+            self.announcements.append(VehicleAnnouncement.from_payload(
+                addr[0], data[HEADER.size:HEADER.size + length]))
+
+
+async def discover_vehicles(host='255.255.255.255', port=UDP_DISCOVERY_PORT, timeout=0.5) -> list:
+    # vehicle identification request, every DoIP entity answers with its
+    # vehicle announcement within A_DoIP_Ctrl, we only wait timeout
+    loop = asyncio.get_event_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        _DiscoveryProtocol, local_addr=('0.0.0.0', 0), family=socket.AF_INET)
+    try:
+        transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        transport.sendto(encode_message(PayloadType.VehicleIdentificationRequest), (host, port))
+        await asyncio.sleep(timeout)
+    finally:
+        transport.close()
+    return protocol.announcements
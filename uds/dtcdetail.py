@@ -0,0 +1,192 @@
+import asyncio
+import logging
+
+from udsoncan import DidCodec, Dtc, services
+from udsoncan.exceptions import NegativeResponseException, UnexpectedResponseException, InvalidResponseException, ConfigError
+
+
+logger = logging.getLogger(__name__)
+
+# testFailed, pendingDTC and confirmedDTC, the DTCs with stored data
+DEFAULT_STATUS_MASK = 0x0D
+ALL_RECORDS = 0xFF
+# the server has no records of the DTC or does not know the sub-function
+NO_RECORDS_NRCS = (0x12, 0x31)
+
+
+class DtcDetail(object):
+
+    def __init__(self, dtc, status):
+        self.dtc = dtc
+        self.status = status
+        # {record number: {did: value}}
+        self.snapshots = {}
+        # {record number: value}, raw bytes for records without a codec
+        self.extended_data = {}
+        # (what, exception) of the requests that failed
+        self.errors = []
+
+    def __repr__(self):
+        return 'DtcDetail(0x%06x, status=0x%02x, snapshots=%s, extended_data=%s)' % (
+            self.dtc, self.status, sorted(self.snapshots), sorted(self.extended_data))
+
+
+def decode_extended_data(data: bytes, codecs: dict) -> dict:
+    # {record number: value} of the records after the DTCAndStatusRecord,
+    # the length of a record is that of its codec, the records after one
+    # without a codec cannot be told apart and stay in its raw bytes
+    records = {}
+    offset = 0
+    while offset < len(data):
+        record_number = data[offset]
+        if record_number == 0:
+            # zero padding
+            break
+        offset += 1
+        if record_number not in codecs:
+            records[record_number] = bytes(data[offset:])
+            break
+        codec = DidCodec.from_config(codecs[record_number])
+        size = len(codec)
+        if len(data) < offset + size:
+            raise ValueError('Extended data record 0x%02x is %d bytes long, expected %d' % (
+                record_number, len(data) - offset, size))
+        records[record_number] = codec.decode(bytes(data[offset:offset + size]))
+        offset += size
+    return records
+
+
+class DtcDetailReader(object):
+    # Snapshots (0x19 0x04) and extended data (0x19 0x06) of every DTC that
+    # get_dtc_by_status_mask reports. With reportDTCSnapshotIdentification
+    # (0x19 0x03) one request tells which DTCs have snapshots, so the others
+    # cost no snapshot request. A server handles one request at a time, the
+    # DTCs of one ECU are read in turn while several ECUs run side by side.
+
+    def __init__(self, client, status_mask=DEFAULT_STATUS_MASK, snapshot_codecs=None, extended_data_codecs=None,
+                 snapshot_record=ALL_RECORDS, extended_data_record=ALL_RECORDS, snapshots=True, extended_data=True,
+                 use_identification=True, timeout=None):
+        self.client = client
+        self.status_mask = status_mask
+        # {did: codec} of the snapshot DIDs, on top of the data_identifiers of the config
+        self.snapshot_codecs = dict(client._config.get('data_identifiers') or {})
+        self.snapshot_codecs.update(snapshot_codecs or {})
+        # {record number: codec} of the extended data records
+        self.extended_data_codecs = extended_data_codecs or {}
+        self.snapshot_record = snapshot_record
+        self.extended_data_record = extended_data_record
+        self.snapshots = snapshots
+        self.extended_data = extended_data
+        self.use_identification = use_identification
+        self.timeout = timeout
+        self.requests = 0
+
+    async def _snapshot_dtcs(self):
+        # the DTCs with snapshots, None when the server cannot tell
+        self.requests += 1
+        try:
+            response = await self.client.get_dtc_snapshot_identification(timeout=self.timeout)
+        except NegativeResponseException as e:
+            logger.info('No snapshot identification, NRC 0x%02x', e.response.code)
+            return None
+        except (asyncio.TimeoutError, UnexpectedResponseException, InvalidResponseException) as e:
+            logger.warning('Snapshot identification failed: %r', e)
+            return None
+        return {dtc.id for dtc in response.service_data.dtcs}
+
+    async def _read_snapshots(self, detail: DtcDetail):
+        self.requests += 1
+        try:
+            response = await self.client.get_dtc_snapshot_by_dtc_number(
+                detail.dtc, self.snapshot_record, self.snapshot_codecs, self.timeout)
+        except NegativeResponseException as e:
+            if e.response.code not in NO_RECORDS_NRCS:
+                detail.errors.append(('snapshots', e))
+            return
+        except (asyncio.TimeoutError, ConfigError, UnexpectedResponseException, InvalidResponseException) as e:
+            detail.errors.append(('snapshots', e))
+            logger.warning('0x%06x: snapshots failed: %r', detail.dtc, e)
+            return
+        for snapshot in response.service_data.dtcs[0].snapshots:
+            if isinstance(snapshot, Dtc.Snapshot):
+                detail.snapshots.setdefault(snapshot.record_number, {})[snapshot.did] = snapshot.data
+
+    async def _read_extended_data(self, detail: DtcDetail):
+        self.requests += 1
+        request = services.ReadDTCInformation.make_request(
+            services.ReadDTCInformation.Subfunction.reportDTCExtendedDataRecordByDTCNumber,
+            dtc=detail.dtc, extended_data_record_number=self.extended_data_record)
+        try:
+            response = await self.client.send_request(request, timeout=self.timeout)
+            data = response.data
+            if len(data) < 5 or data[0] != request.subfunction or int.from_bytes(data[1:4], 'big') != detail.dtc:
+                raise UnexpectedResponseException(response, 'Response is not the extended data of DTC 0x%06x' % detail.dtc)
+            detail.extended_data = decode_extended_data(data[5:], self.extended_data_codecs)
+        except NegativeResponseException as e:
+            if e.response.code not in NO_RECORDS_NRCS:
+                detail.errors.append(('extended data', e))
+        except (asyncio.TimeoutError, UnexpectedResponseException, ValueError) as e:
+            detail.errors.append(('extended data', e))
+            logger.warning('0x%06x: extended data failed: %r', detail.dtc, e)
+
+    async def details(self):
+        # DtcDetail of each DTC as soon as its records are in
+        self.requests += 1
+        response = await self.client.get_dtc_by_status_mask(self.status_mask, timeout=self.timeout)
+        dtcs = response.service_data.dtcs
+
+        with_snapshots = None
+        if self.snapshots and self.use_identification and dtcs:
+            with_snapshots = await self._snapshot_dtcs()
+
+        for dtc in dtcs:
+            detail = DtcDetail(dtc.id, dtc.status.get_byte_as_int())
+            if self.snapshots and (with_snapshots is None or dtc.id in with_snapshots):
+                await self._read_snapshots(detail)
+            if self.extended_data:
+                await self._read_extended_data(detail)
+            yield detail
+
+        logger.info('%d DTCs read with %d requests', len(dtcs), self.requests)
+
+
+async def read_dtc_details(clients: dict, concurrency=4, **kwargs):
+    # (name, DtcDetail) of the ECUs in clients as they come in, with at most
+    # concurrency ECUs read at a time. An ECU that fails gives (name, exception).
+    # To stop early, await aclose() of the generator before using the clients
+    # again. A generator dropped after a break is closed in the background and
+    # its readers may still be waiting for a response meanwhile.
+    semaphore = asyncio.Semaphore(concurrency)
+    queue = asyncio.Queue()
+    done = object()
+    stopped = False
+
+    async def read(name, client):
+        try:
+            async with semaphore:
+                if stopped:
+                    return
+                async for detail in DtcDetailReader(client, **kwargs).details():
+                    if stopped:
+                        break
+                    queue.put_nowait((name, detail))
+        except Exception as e:
+            logger.error('%s: reading DTC details failed: %r', name, e)
+            queue.put_nowait((name, e))
+        finally:
+            queue.put_nowait(done)
+
+    tasks = [asyncio.ensure_future(read(name, client)) for name, client in clients.items()]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            if item is done:
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        # a request cancelled in flight would leave its response to the
+        # next one on the connection, the readers stop between DTCs instead
+        stopped = True
+        await asyncio.gather(*tasks, return_exceptions=True)
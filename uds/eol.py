@@ -0,0 +1,178 @@
+import struct
+import asyncio
+import logging
+
+from udsoncan import Request, services
+from udsoncan.exceptions import NegativeResponseException, UnexpectedResponseException, InvalidResponseException, ConfigError
+
+
+logger = logging.getLogger(__name__)
+
+# a verify read of one DID at a time instead of the group
+SPLIT_GROUP_NRCS = (0x13, 0x14, 0x31)
+# 1 + sum(2 + n) response bytes within the ISO-TP limit of 4095
+MAX_RESPONSE_LENGTH = 4095
+
+
+class DidWrite(object):
+
+    def __init__(self, did, value):
+        self.did = did
+        self.value = value
+        # the WriteDataByIdentifier request and the value encoded in it
+        self.request = None
+        self.data = None
+        self.written = False
+        # None while not read back
+        self.verified = None
+        self.read_back = None
+        # NRC of the write or the verify read, or the exception of a failure
+        self.nrc = None
+        self.error = None
+
+    @property
+    def ok(self) -> bool:
+        return self.written and self.verified is not False and self.error is None
+
+    def __repr__(self):
+        if self.error is not None:
+            return 'DidWrite(0x%04x, error=%r)' % (self.did, self.error)
+        if self.nrc is not None:
+            return 'DidWrite(0x%04x, nrc=0x%02x)' % (self.did, self.nrc)
+        return 'DidWrite(0x%04x, written=%s, verified=%s)' % (self.did, self.written, self.verified)
+
+
+def verify_groups(writes: list, group_size) -> list:
+    # written DIDs in request order, as many per read as fit into one response
+    groups = []
+    group = []
+    length = 1
+    for write in writes:
+        size = 2 + len(write.data)
+        if group and (len(group) >= group_size or length + size > MAX_RESPONSE_LENGTH):
+            groups.append(group)
+            group = []
+            length = 1
+        group.append(write)
+        length += size
+    if group:
+        groups.append(group)
+    return groups
+
+
+class DidWriter(object):
+    # WriteDataByIdentifier of many DIDs, e.g. at an end-of-line station.
+    # Every value is encoded before the first request, so a bad value does
+    # not leave the ECU half written. The DIDs are then written one after
+    # the other and read back with multi-DID ReadDataByIdentifier, so n DIDs
+    # take n writes and about n / group_size reads.
+
+    def __init__(self, client, unlock=None, verify=True, group_size=16, timeout=None):
+        self.client = client
+        # coroutine function called with the client once before the writes
+        self.unlock = unlock
+        self.verify = verify
+        self.group_size = group_size
+        self.timeout = timeout
+        self.requests = 0
+
+    async def _send(self, request: Request):
+        self.requests += 1
+        return await self.client.send_request(request, timeout=self.timeout)
+
+    def _encode(self, values: dict) -> list:
+        didconfig = self.client._config['data_identifiers']
+        writes = []
+        for did, value in values.items():
+            write = DidWrite(did, value)
+            try:
+                write.request = services.WriteDataByIdentifier.make_request(did, value, didconfig)
+                write.data = write.request.data[2:]
+            except (ConfigError, ValueError, TypeError, struct.error) as e:
+                write.error = e
+                logger.error('0x%04x: cannot encode %r: %s', did, value, e)
+            writes.append(write)
+        return writes
+
+    async def _write(self, write: DidWrite):
+        try:
+            response = await self._send(write.request)
+            services.WriteDataByIdentifier.interpret_response(response)
+            if response.service_data.did_echo != write.did:
+                raise UnexpectedResponseException(response, 'Server returned a response for data identifier 0x%04x while client requested for did 0x%04x' % (
+                    response.service_data.did_echo, write.did))
+        except NegativeResponseException as e:
+            write.nrc = e.response.code
+            logger.error('0x%04x: write refused with NRC 0x%02x', write.did, write.nrc)
+            return
+        except (asyncio.TimeoutError, UnexpectedResponseException, InvalidResponseException) as e:
+            write.error = e
+            logger.error('0x%04x: write failed: %r', write.did, e)
+            return
+        write.written = True
+
+    async def _read_back(self, group: list):
+        request = Request(services.ReadDataByIdentifier,
+                          data=b''.join(struct.pack('>H', write.did) for write in group))
+        try:
+            response = await self._send(request)
+        except NegativeResponseException as e:
+            if len(group) > 1 and e.response.code in SPLIT_GROUP_NRCS:
+                # too much for one request, or one of the DIDs is not readable
+                for write in group:
+                    await self._read_back([write])
+                return
+            for write in group:
+                write.verified = False
+                write.nrc = e.response.code
+            return
+        except asyncio.TimeoutError as e:
+            for write in group:
+                write.error = e
+            return
+
+        # the values come in request order, each as long as written
+        data = response.data
+        offset = 0
+        for i, write in enumerate(group):
+            end = offset + 2 + len(write.data)
+            if data[offset:offset + 2] != struct.pack('>H', write.did) or len(data) < end:
+                if len(group) > 1:
+                    # the rest cannot be told apart, read it one by one
+                    for rest in group[i:]:
+                        await self._read_back([rest])
+                    return
+                write.verified = False
+                logger.error('0x%04x: missing from the verify read', write.did)
+                return
+            write.read_back = bytes(data[offset + 2:end])
+            write.verified = write.read_back == write.data
+            if not write.verified:
+                logger.error('0x%04x: read back 0x%s after writing 0x%s',
+                             write.did, write.read_back.hex(), write.data.hex())
+            offset = end
+
+    async def write(self, values: dict) -> dict:
+        # {did: DidWrite}
+        writes = self._encode(values)
+        results = {write.did: write for write in writes}
+        if any(write.error is not None for write in writes):
+            return results
+
+        if self.unlock is not None:
+            await self.unlock(self.client)
+
+        for write in writes:
+            await self._write(write)
+
+        if self.verify:
+            for group in verify_groups([write for write in writes if write.written], self.group_size):
+                await self._read_back(group)
+
+        logger.info('%d of %d DIDs written with %d requests',
+                    sum(write.ok for write in writes), len(writes), self.requests)
+        return results
+
+
+async def write_dids(client, values: dict, **kwargs) -> dict:
+    return await DidWriter(client, **kwargs).write(values)
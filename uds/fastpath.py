@@ -0,0 +1,152 @@
+import struct
+
+from udsoncan import Response, Request, DidCodec, services
+from udsoncan.exceptions import NegativeResponseException, UnexpectedResponseException, ConfigError
+
+
+# Precompiled requests for Client.execute. Each one holds the request payload
+# and the positive response prefix, responses are checked in one comparison on
+# a memoryview and udsoncan objects are only built on errors or when asked for.
+
+NRC_RESPONSE_PENDING = Response.Code.RequestCorrectlyReceived_ResponsePending
+
+
+def is_pending(payload) -> bool:
+    return len(payload) >= 3 and payload[0] == 0x7F and payload[2] == NRC_RESPONSE_PENDING
+
+
+class EchoDecoder(object):
+
+    def __init__(self, request: Request, echo_length=1):
+        self.request = request
+        self.payload = request.get_payload()
+        # for interpret_response when a full response is asked for
+        self.interpret_args = ()
+        self.interpret_kwargs = {}
+        # positive response SID followed by the echoed request bytes
+        self.echo = bytes([self.payload[0] + 0x40]) + self.payload[1:1 + echo_length]
+
+    def check(self, payload) -> memoryview:
+        view = memoryview(payload)
+        if view[:len(self.echo)] == self.echo:
+            return view[len(self.echo):]
+
+        response = Response.from_payload(bytes(payload))
+        if not response.valid:
+            raise UnexpectedResponseException(response, 'Invalid response: %s' % response.invalid_reason)
+        if not response.positive:
+            raise NegativeResponseException(response)
+        raise UnexpectedResponseException(response, 'Response 0x%s does not echo the request 0x%s' % (
+            bytes(payload[:len(self.echo)]).hex(), self.echo.hex()))
+
+    def decode(self, payload):
+        # the response data following the echo
+        return self.check(payload)
+
+    def interpret(self, payload) -> Response:
+        # full udsoncan response, as returned by the Client service wrappers
+        self.check(payload)
+        response = Response.from_payload(bytes(payload))
+        self.request.service.interpret_response(response, *self.interpret_args, **self.interpret_kwargs)
+        return response
+
+
+class ReadDataByIdentifierDecoder(EchoDecoder):
+
+    def __init__(self, didlist, didconfig, tolerate_zero_padding=True):
+        didlist = services.ReadDataByIdentifier.validate_didlist_input(didlist)
+        super().__init__(services.ReadDataByIdentifier.make_request(didlist, didconfig), 0)
+        self.didlist = didlist
+        self.didconfig = didconfig
+        self.tolerate_zero_padding = tolerate_zero_padding
+        self.interpret_kwargs = {
+            'didlist': didlist,
+            'didconfig': didconfig,
+            'tolerate_zero_padding': tolerate_zero_padding,
+        }
+        self._codecs = {}
+        self._lengths = {}
+        for did in didlist:
+            if did not in didconfig and 'default' not in didconfig:
+                raise ConfigError(did, msg='Actual data identifier configuration contains no definition for data identifier 0x%04x' % did)
+            codec = DidCodec.from_config(didconfig.get(did, didconfig.get('default')))
+            self._codecs[did] = codec
+            self._lengths[did] = len(codec)
+        self._count = len(self._lengths)
+
+    def decode(self, payload, values=False) -> dict:
+        # {did: memoryview} or, with values, {did: codec-decoded value}
+        view = self.check(payload)
+        result = {}
+        offset = 0
+        end = len(view)
+        lengths = self._lengths
+        while offset < end:
+            if end - offset < 2:
+                break
+            did = view[offset] << 8 | view[offset + 1]
+            length = lengths.get(did)
+            if length is None:
+                if self.tolerate_zero_padding and not any(view[offset:]):
+                    break
+                raise UnexpectedResponseException(Response.from_payload(bytes(payload)),
+                                                  'Server returned values for data identifier 0x%04x that was not requested' % did)
+            offset += 2
+            if end - offset < length:
+                raise UnexpectedResponseException(Response.from_payload(bytes(payload)),
+                                                  'Value for data identifier 0x%04x was incomplete' % did)
+            result[did] = view[offset:offset + length]
+            offset += length
+
+        if len(result) != self._count:
+            missing = [did for did in self._lengths if did not in result]
+            raise UnexpectedResponseException(Response.from_payload(bytes(payload)),
+                                              '%d data identifier values are missing from server response. Dids are : %s' % (len(missing), missing))
+
+        if values:
+            return {did: self._codecs[did].decode(bytes(data)) for did, data in result.items()}
+        return result
+
+
+class DTCByStatusMaskDecoder(EchoDecoder):
+
+    def __init__(self, status_mask):
+        subfunction = services.ReadDTCInformation.Subfunction.reportDTCByStatusMask
+        super().__init__(services.ReadDTCInformation.make_request(subfunction, status_mask), 1)
+        self.interpret_args = (subfunction,)
+
+    def decode(self, payload) -> list:
+        # [(dtc_id, status), ...] after the status availability mask
+        view = self.check(payload)[1:]
+        count = len(view) // 4
+        return [(a << 16 | b << 8 | c, status)
+                for a, b, c, status in struct.iter_unpack('>4B', view[:count * 4])]
+
+
+def session_control(session) -> EchoDecoder:
+    return EchoDecoder(services.DiagnosticSessionControl.make_request(session), 1)
+
+
+def tester_present() -> EchoDecoder:
+    return EchoDecoder(services.TesterPresent.make_request(), 1)
+
+
+def ecu_reset(reset_type) -> EchoDecoder:
+    return EchoDecoder(services.ECUReset.make_request(reset_type), 1)
+
+
+def routine_control(routine_id, control_type, data=None) -> EchoDecoder:
+    # control type and routine identifier are echoed
+    return EchoDecoder(services.RoutineControl.make_request(routine_id, control_type, data=data), 3)
+
+
+def write_data_by_identifier(did, value, didconfig) -> EchoDecoder:
+    return EchoDecoder(services.WriteDataByIdentifier.make_request(did, value, didconfig=didconfig), 2)
+
+
+def read_data_by_identifier(didlist, didconfig, tolerate_zero_padding=True) -> ReadDataByIdentifierDecoder:
+    return ReadDataByIdentifierDecoder(didlist, didconfig, tolerate_zero_padding)
+
+
+def dtc_by_status_mask(status_mask) -> DTCByStatusMaskDecoder:
+    return DTCByStatusMaskDecoder(status_mask)
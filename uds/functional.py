@@ -0,0 +1,173 @@
+import asyncio
+
+from udsoncan import Response, Request, services
+from udsoncan.exceptions import UnexpectedResponseException
+from udsoncan.configs import default_client_config
+
+from uds.client import Client
+
+
+class FunctionalClient(object):
+
+    def __init__(self, writer: asyncio.StreamWriter, readers: dict, config=default_client_config, ecu_writers: dict = None):
+        self._writer = writer
+        self._readers = readers
+        self._config = dict(config)
+        # writers of the physical connections opened for this client, only
+        # kept to close them, shared connections are left open
+        self._ecu_writers = ecu_writers or {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    def close(self):
+        for writer in [self._writer, *self._ecu_writers.values()]:
+            writer.close()
+
+    async def aclose(self):
+        self.close()
+        for writer in [self._writer, *self._ecu_writers.values()]:
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    @property
+    def ecus(self):
+        return list(self._readers)
+
+    async def _collect(self, reader: asyncio.StreamReader, timeout):
+        try:
+            payload = await asyncio.wait_for(reader.read(4095), timeout)
+            if not payload:
+                # the connection was closed
+                return None
+            response = Response.from_payload(payload)
+            while not response.positive and response.code == Response.Code.RequestCorrectlyReceived_ResponsePending:
+                payload = await asyncio.wait_for(reader.read(4095), self._config['p2_star_timeout'])
+                response = Response.from_payload(payload)
+        except asyncio.TimeoutError:
+            return None
+        return response
+
+    async def send_request(self, request: Request, suppress_positive_response=False, timeout=None):
+        if timeout is None:
+            timeout = self._config['p2_timeout']
+
+        payload = request.get_payload(suppress_positive_response)
+        self._writer.write(payload)
+
+        # with a suppressed positive response only negative responses can arrive
+        ecus = list(self._readers)
+        results = await asyncio.gather(*[self._collect(self._readers[ecu], timeout) for ecu in ecus])
+
+        return {ecu: response for ecu, response in zip(ecus, results) if response is not None}
+
+    async def _broadcast(self, request, interpret, suppress_positive_response=False, timeout=None):
+        responses = await self.send_request(request, suppress_positive_response, timeout)
+
+        # a misbehaving ECU must not stop a vehicle-wide scan, its error is returned in place of the response
+        for ecu, response in responses.items():
+            if response.positive:
+                try:
+                    interpret(response)
+                except Exception as e:
+                    responses[ecu] = e
+
+        return responses
+
+    async def change_session(self, newsession, suppress_positive_response=False, timeout=None):
+        request = services.DiagnosticSessionControl.make_request(newsession)
+
+        def interpret(response):
+            services.DiagnosticSessionControl.interpret_response(response)
+
+            if newsession != response.service_data.session_echo:
+                raise UnexpectedResponseException(response, 'Response subfunction received from server (0x%02x) does not match the requested subfunction (0x%02x)' % (
+                    response.service_data.session_echo, newsession))
+
+        return await self._broadcast(request, interpret, suppress_positive_response, timeout)
+
+    async def tester_present(self, suppress_positive_response=False, timeout=None):
+        request = services.TesterPresent.make_request()
+
+        def interpret(response):
+            services.TesterPresent.interpret_response(response)
+
+            if request.subfunction != response.service_data.subfunction_echo:
+                raise UnexpectedResponseException(response, 'Response subfunction received from server (0x%02x) does not match the requested subfunction (0x%02x)' % (
+                    response.service_data.subfunction_echo, request.subfunction))
+
+        return await self._broadcast(request, interpret, suppress_positive_response, timeout)
+
+    async def clear_dtc(self, group=0xFFFFFF, timeout=None):
+        request = services.ClearDiagnosticInformation.make_request(group)
+
+        return await self._broadcast(request, services.ClearDiagnosticInformation.interpret_response, False, timeout)
+
+    async def read_data_by_identifier(self, didlist, timeout=None):
+        didlist = services.ReadDataByIdentifier.validate_didlist_input(didlist)
+
+        request = services.ReadDataByIdentifier.make_request(
+            didlist=didlist, didconfig=self._config['data_identifiers'])
+
+        def interpret(response):
+            services.ReadDataByIdentifier.interpret_response(
+                response, didlist=didlist, didconfig=self._config['data_identifiers'],
+                tolerate_zero_padding=self._config['tolerate_zero_padding'])
+
+            extra_did = set(response.service_data.values) - set(didlist)
+            if len(extra_did) > 0:
+                raise UnexpectedResponseException(
+                    response, "Server returned values for %d data identifier that were not requested. Dids are : %s" % (len(extra_did), extra_did))
+
+        return await self._broadcast(request, interpret, False, timeout)
+
+    async def communication_control(self, control_type, communication_type, suppress_positive_response=False, timeout=None):
+        request = services.CommunicationControl.make_request(
+            control_type, communication_type)
+
+        def interpret(response):
+            services.CommunicationControl.interpret_response(response)
+
+            if control_type != response.service_data.control_type_echo:
+                raise UnexpectedResponseException(response, 'Control type of response (0x%02x) does not match request control type (0x%02x)' % (
+                    response.service_data.control_type_echo, control_type))
+
+        return await self._broadcast(request, interpret, suppress_positive_response, timeout)
+
+    async def control_dtc_setting(self, setting_type, data=None, suppress_positive_response=False, timeout=None):
+        request = services.ControlDTCSetting.make_request(
+            setting_type, data=data)
+
+        def interpret(response):
+            services.ControlDTCSetting.interpret_response(response)
+
+            if response.service_data.setting_type_echo != setting_type:
+                raise UnexpectedResponseException(response, 'Setting type of response (0x%02x) does not match request control type (0x%02x)' % (
+                    response.service_data.setting_type_echo, setting_type))
+
+        return await self._broadcast(request, interpret, suppress_positive_response, timeout)
+
+
+async def open_functional_client(network, functional_id, ecus: dict, config=default_client_config) -> FunctionalClient:
+    # ecus maps a name to the (rx_id, tx_id) of the ECU's physical addresses,
+    # the tx_id is needed to send flow controls for segmented responses.
+    # Two connections on the same rx_id would both send flow controls and
+    # both buffer the responses, so an ECU that already has a physical
+    # Client is given by that Client instead. The responses are then read
+    # from its connection, which must not be used for requests of its own
+    # while a functional request is waiting.
+    _, writer = await network.open_connection(None, functional_id)
+    readers = {}
+    writers = {}
+    for ecu, address in ecus.items():
+        if isinstance(address, Client):
+            readers[ecu] = address._reader
+        else:
+            rx_id, tx_id = address
+            readers[ecu], writers[ecu] = await network.open_connection(rx_id, tx_id)
+    return FunctionalClient(writer, readers, config, writers)
@@ -0,0 +1,517 @@
+import time
+import asyncio
+import logging
+import contextlib
+
+import can
+from can import BusABC, Message
+
+
+logger = logging.getLogger(__name__)
+
+
+class PCIType(object):
+    SingleFrame = 0
+    FirstFrame = 1
+    ConsecutiveFrame = 2
+    FlowControl = 3
+
+
+class FlowStatus(object):
+    ContinueToSend = 0
+    Wait = 1
+    Overflow = 2
+
+
+class AddressingMode(object):
+    Normal = 0
+    Extended = 1
+    Mixed = 2
+
+
+# ISO 15765-2 timing parameters in seconds
+N_As = 1.0
+N_Bs = 1.0
+N_Cr = 1.0
+
+# maximum number of FC.WAIT accepted in a row before the transfer is aborted
+N_WFTmax = 10
+
+# valid CAN FD data lengths indexed by DLC
+CAN_FD_DATA_LENGTHS = (0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 20, 24, 32, 48, 64)
+
+
+def dlc_to_len(dlc: int) -> int:
+    return CAN_FD_DATA_LENGTHS[min(dlc, 15)]
+
+
+def len_to_dlc(length: int) -> int:
+    for dlc, data_length in enumerate(CAN_FD_DATA_LENGTHS):
+        if length <= data_length:
+            return dlc
+    raise ValueError('%d bytes do not fit in a CAN FD frame' % length)
+
+
+def frame_length(length: int) -> int:
+    return CAN_FD_DATA_LENGTHS[len_to_dlc(length)]
+
+
+def stmin_to_seconds(stmin: int) -> float:
+    if 0x00 <= stmin <= 0x7F:
+        return stmin / 1000
+    if 0xF1 <= stmin <= 0xF9:
+        return (stmin - 0xF0) / 10000
+    # reserved values are interpreted as the longest STmin (0x7F)
+    return 0x7F / 1000
+
+
+def seconds_to_stmin(seconds: float) -> int:
+    if seconds <= 0:
+        return 0x00
+    if seconds < 0.001:
+        return 0xF0 + max(1, min(9, round(seconds * 10000)))
+    return min(0x7F, round(seconds * 1000))
+
+
+def encode_single_frame(data: bytes, escape=False) -> bytes:
+    if escape:
+        return bytes([0x00, len(data)]) + bytes(data)
+    return bytes([PCIType.SingleFrame << 4 | len(data)]) + bytes(data)
+
+
+def encode_first_frame(length: int, data: bytes = b'') -> bytes:
+    if length > 0xFFF:
+        return bytes([PCIType.FirstFrame << 4, 0x00]) + length.to_bytes(4, 'big') + bytes(data)
+    return bytes([PCIType.FirstFrame << 4 | length >> 8, length & 0xFF]) + bytes(data)
+
+
+def encode_consecutive_frame(sequence_number: int, data: bytes = b'') -> bytes:
+    return bytes([PCIType.ConsecutiveFrame << 4 | sequence_number & 0xF]) + bytes(data)
+
+
+def encode_flow_control(flow_status: int, block_size=0, stmin=0) -> bytes:
+    return bytes([PCIType.FlowControl << 4 | flow_status & 0xF, block_size, stmin])
+
+
+def pad(frame: bytes, length=8, padding=0x00) -> bytes:
+    if padding is None or len(frame) >= length:
+        return bytes(frame)
+    return bytes(frame) + bytes([padding]) * (length - len(frame))
+
+
+def pci_type(frame: bytes) -> int:
+    return frame[0] >> 4
+
+
+def single_frame_length(frame: bytes) -> int:
+    length = frame[0] & 0xF
+    if length == 0 and len(frame) > 8:
+        length = frame[1]
+    return length
+
+
+def first_frame_length(frame: bytes) -> int:
+    length = (frame[0] & 0xF) << 8 | frame[1]
+    if length == 0:
+        length = int.from_bytes(frame[2:6], 'big')
+    return length
+
+
+def first_frame_capacity(length: int, tx_dl=8, prefix_len=0) -> int:
+    pci_len = 6 if length > 0xFFF else 2
+    return tx_dl - prefix_len - pci_len
+
+
+def single_frame_capacity(tx_dl=8, prefix_len=0) -> int:
+    if tx_dl > 8:
+        return tx_dl - prefix_len - 2
+    return tx_dl - prefix_len - 1
+
+
+def consecutive_frame_count(length: int, tx_dl=8, prefix_len=0) -> int:
+    remaining = length - first_frame_capacity(length, tx_dl, prefix_len)
+    size = tx_dl - prefix_len - 1
+    return (remaining + size - 1) // size
+
+
+class Address(object):
+
+    def __init__(self, rx_id, tx_id, mode=AddressingMode.Normal, target_address=None, source_address=None, address_extension=None, is_extended_id=None):
+        if mode == AddressingMode.Extended and (target_address is None or source_address is None):
+            raise ValueError(
+                'Extended addressing requires a target_address and a source_address')
+
+        if mode == AddressingMode.Mixed and address_extension is None:
+            raise ValueError('Mixed addressing requires an address_extension')
+
+        if is_extended_id is None:
+            is_extended_id = (rx_id or 0) > 0x7FF or tx_id > 0x7FF
+
+        self.rx_id = rx_id
+        self.tx_id = tx_id
+        self.mode = mode
+        self.is_extended_id = is_extended_id
+
+        if mode == AddressingMode.Extended:
+            self.tx_prefix = bytes([target_address])
+            self.rx_prefix = bytes([source_address])
+        elif mode == AddressingMode.Mixed:
+            self.tx_prefix = bytes([address_extension])
+            self.rx_prefix = bytes([address_extension])
+        else:
+            self.tx_prefix = b''
+            self.rx_prefix = b''
+
+
+class ISOTPTransport(asyncio.Transport):
+
+    def __init__(self, network, address: Address, protocol: asyncio.Protocol, block_size=0, st_min=0, tx_dl=8, tx_padding=None, max_rx_length=4095, is_fd=None, bitrate_switch=False):
+        super().__init__()
+        if tx_dl not in CAN_FD_DATA_LENGTHS[8:]:
+            raise ValueError('tx_dl must be one of %s' %
+                             (CAN_FD_DATA_LENGTHS[8:], ))
+        if is_fd is None:
+            is_fd = tx_dl > 8
+
+        self._network = network
+        self._address = address
+        self._protocol = protocol
+        self._loop = asyncio.get_event_loop()
+        # perf_counter for exact STmin, simulated time on a uds.sim loop
+        self._virtual_time = getattr(self._loop, 'virtual_time', False)
+        self._time = self._loop.time if self._virtual_time else time.perf_counter
+
+        self.block_size = block_size
+        self.st_min = st_min
+        self.tx_dl = tx_dl
+        self.tx_padding = tx_padding
+        self.max_rx_length = max_rx_length
+        self.is_fd = is_fd
+        self.bitrate_switch = bitrate_switch
+
+        self._rx_buffer = None
+        self._rx_index = 0
+        self._rx_sn = 0
+        # the sender's TX_DL, given by the length of its First frame
+        self._rx_dl = 8
+        self._rx_block_count = 0
+        self._rx_timer = None
+
+        self._fc_waiter = None
+        self._tx_queue = asyncio.Queue()
+        self._tx_task = self._loop.create_task(self._tx_loop())
+        self._closing = False
+
+    @property
+    def address(self) -> Address:
+        return self._address
+
+    def get_protocol(self):
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._tx_task.cancel()
+        if self._fc_waiter is not None and not self._fc_waiter.done():
+            self._fc_waiter.cancel()
+        # payloads that were never sent
+        while not self._tx_queue.empty():
+            self._tx_queue.get_nowait()
+        self._stop_rx()
+        self._network._remove_transport(self)
+        self._loop.call_soon(self._protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+    def write(self, data):
+        if self._closing:
+            raise RuntimeError('Transport is closing')
+        self._tx_queue.put_nowait(bytes(data))
+
+    def can_write_eof(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return self._tx_queue.qsize()
+
+    def _send_frame(self, frame: bytes):
+        data = self._address.tx_prefix + frame
+        if self.tx_padding is not None:
+            # FF and CF fill tx_dl, SF and FC only the frame their data needs,
+            # a classic SF_DL must not be sent in a frame longer than 8 bytes
+            if pci_type(frame) in (PCIType.FirstFrame, PCIType.ConsecutiveFrame):
+                data = pad(data, self.tx_dl, self.tx_padding)
+            else:
+                data = pad(data, max(8, frame_length(len(data))), self.tx_padding)
+        elif len(data) > 8:
+            # CAN FD frames longer than 8 bytes must be padded up to the next valid DLC
+            data = pad(data, frame_length(len(data)), 0xCC)
+        msg = Message(arbitration_id=self._address.tx_id, dlc=len(data), data=data,
+                      is_extended_id=self._address.is_extended_id, is_fd=self.is_fd, bitrate_switch=self.bitrate_switch)
+        self._network.bus.send(msg)
+
+    async def _sleep_until(self, deadline):
+        remaining = deadline - self._time()
+        if self._virtual_time:
+            # simulated time only moves while the loop is waiting
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            return
+        # asyncio timers are only millisecond accurate,
+        # spin for the last part so that STmin is honoured exactly
+        if remaining > 0.002:
+            await asyncio.sleep(remaining - 0.001)
+        while self._time() < deadline:
+            pass
+
+    async def _wait_flow_control(self):
+        for _ in range(N_WFTmax + 1):
+            self._fc_waiter = self._loop.create_future()
+            try:
+                flow_status, block_size, stmin = await asyncio.wait_for(self._fc_waiter, N_Bs)
+            finally:
+                self._fc_waiter = None
+            if flow_status == FlowStatus.ContinueToSend:
+                return block_size, stmin_to_seconds(stmin)
+            if flow_status == FlowStatus.Overflow:
+                raise OverflowError('Receiver reported buffer overflow')
+            if flow_status != FlowStatus.Wait:
+                raise ValueError('Invalid flow status 0x%x' % flow_status)
+        raise TimeoutError('Too many FC.WAIT received')
+
+    async def _tx_loop(self):
+        while True:
+            payload = await self._tx_queue.get()
+            try:
+                await self._send(payload)
+            except Exception as e:
+                logger.error('Transmission of %d bytes to 0x%x aborted: %r',
+                             len(payload), self._address.tx_id, e)
+
+    async def _send(self, payload: bytes):
+        prefix_len = len(self._address.tx_prefix)
+        sf_capacity = single_frame_capacity(self.tx_dl, prefix_len)
+
+        if len(payload) <= sf_capacity:
+            self._send_frame(encode_single_frame(
+                payload, escape=len(payload) > 7 - prefix_len))
+            return
+
+        view = memoryview(payload)
+        index = first_frame_capacity(len(payload), self.tx_dl, prefix_len)
+        cf_size = self.tx_dl - prefix_len - 1
+        self._send_frame(encode_first_frame(len(payload), view[:index]))
+
+        sn = 1
+        while index < len(payload):
+            block_size, stmin = await self._wait_flow_control()
+            deadline = self._time()
+            count = 0
+            while index < len(payload) and (block_size == 0 or count < block_size):
+                await self._sleep_until(deadline)
+                self._send_frame(encode_consecutive_frame(
+                    sn, view[index:index + cf_size]))
+                deadline = self._time() + stmin
+                index += cf_size
+                sn = (sn + 1) & 0xF
+                count += 1
+
+    def _send_flow_control(self, flow_status):
+        self._send_frame(encode_flow_control(
+            flow_status, self.block_size, self.st_min))
+
+    def _stop_rx(self):
+        if self._rx_timer is not None:
+            self._rx_timer.cancel()
+            self._rx_timer = None
+        self._rx_buffer = None
+
+    def _rx_timeout(self):
+        logger.warning('Reception from 0x%x timed out after %d of %d bytes',
+                       self._address.rx_id, self._rx_index, len(self._rx_buffer))
+        self._rx_timer = None
+        self._rx_buffer = None
+
+    def _restart_rx_timer(self):
+        if self._rx_timer is not None:
+            self._rx_timer.cancel()
+        self._rx_timer = self._loop.call_later(N_Cr, self._rx_timeout)
+
+    def _frame_received(self, data: bytes):
+        prefix = self._address.rx_prefix
+        if prefix:
+            if data[:len(prefix)] != prefix:
+                return
+            data = data[len(prefix):]
+
+        if len(data) == 0:
+            return
+
+        frame_type = pci_type(data)
+
+        if frame_type == PCIType.SingleFrame:
+            length = single_frame_length(data)
+            offset = 2 if data[0] == 0 else 1
+            if length == 0 or length > len(data) - offset:
+                return
+            # frames longer than 8 bytes must use the escape sequence
+            if offset == 1 and len(data) + len(prefix) > 8:
+                return
+            # a new single frame terminates any reception in progress
+            self._stop_rx()
+            self._protocol.data_received(bytes(data[offset:offset + length]))
+
+        elif frame_type == PCIType.FirstFrame:
+            if len(data) + len(prefix) < 8:
+                return
+            length = first_frame_length(data)
+            escape = data[1] == 0 and data[0] & 0xF == 0
+            offset = 6 if escape else 2
+            if length <= single_frame_capacity(len(data) + len(prefix), len(prefix)):
+                return
+            # the escape sequence is only valid for lengths above 4095
+            if escape and length <= 0xFFF:
+                return
+            self._stop_rx()
+            if length > self.max_rx_length:
+                self._send_flow_control(FlowStatus.Overflow)
+                return
+            self._rx_buffer = bytearray(length)
+            chunk = data[offset:]
+            self._rx_buffer[:len(chunk)] = chunk
+            self._rx_index = len(chunk)
+            self._rx_sn = 1
+            self._rx_dl = len(data) + len(prefix)
+            self._rx_block_count = 0
+            self._send_flow_control(FlowStatus.ContinueToSend)
+            self._restart_rx_timer()
+
+        elif frame_type == PCIType.ConsecutiveFrame:
+            if self._rx_buffer is None:
+                return
+            if data[0] & 0xF != self._rx_sn:
+                logger.warning('Wrong sequence number from 0x%x, expected %d got %d',
+                               self._address.rx_id, self._rx_sn, data[0] & 0xF)
+                self._stop_rx()
+                return
+            # every CF but the last fills RX_DL, the last holds the rest
+            remaining = len(self._rx_buffer) - self._rx_index
+            if len(data) - 1 < min(remaining, self._rx_dl - len(prefix) - 1):
+                logger.warning('Consecutive frame from 0x%x too short, %d bytes of %d',
+                               self._address.rx_id, len(data) + len(prefix), self._rx_dl)
+                self._stop_rx()
+                return
+            chunk = data[1:1 + remaining]
+            self._rx_buffer[self._rx_index:self._rx_index + len(chunk)] = chunk
+            self._rx_index += len(chunk)
+            self._rx_sn = (self._rx_sn + 1) & 0xF
+
+            if self._rx_index >= len(self._rx_buffer):
+                payload = bytes(self._rx_buffer)
+                self._stop_rx()
+                self._protocol.data_received(payload)
+                return
+
+            self._rx_block_count += 1
+            if self.block_size and self._rx_block_count >= self.block_size:
+                self._rx_block_count = 0
+                self._send_flow_control(FlowStatus.ContinueToSend)
+            self._restart_rx_timer()
+
+        elif frame_type == PCIType.FlowControl:
+            if len(data) < 3:
+                return
+            if self._fc_waiter is not None and not self._fc_waiter.done():
+                self._fc_waiter.set_result((data[0] & 0xF, data[1], data[2]))
+
+
+class ISOTPNetwork(object):
+
+    def __init__(self, bus: BusABC, block_size=0, st_min=0, tx_dl=8, tx_padding=None, max_rx_length=4095, is_fd=None, bitrate_switch=False):
+        self.bus = bus
+        self.block_size = block_size
+        self.st_min = st_min
+        self.tx_dl = tx_dl
+        self.tx_padding = tx_padding
+        self.max_rx_length = max_rx_length
+        self.is_fd = is_fd
+        self.bitrate_switch = bitrate_switch
+
+        self._transports = {}
+        self._loop = None
+        self._notifier = None
+
+    @contextlib.contextmanager
+    def open(self):
+        self._loop = asyncio.get_event_loop()
+        # a simulated bus (uds.sim) calls its listeners itself, no thread
+        simulated = hasattr(self.bus, 'add_listener')
+        if simulated:
+            self.bus.add_listener(self._on_message_received)
+        else:
+            self._notifier = can.Notifier(self.bus, [self._on_message_received])
+        try:
+            yield self
+        finally:
+            if simulated:
+                self.bus.remove_listener(self._on_message_received)
+            else:
+                self._notifier.stop()
+                self._notifier = None
+            for transports in list(self._transports.values()):
+                for transport in list(transports):
+                    transport.close()
+
+    def _on_message_received(self, msg: Message):
+        # called from the notifier thread, or by a simulated bus
+        if msg.arbitration_id in self._transports and not msg.is_error_frame:
+            self._loop.call_soon_threadsafe(
+                self._dispatch, msg.arbitration_id, bytes(msg.data))
+
+    def _dispatch(self, arbitration_id, data):
+        for transport in self._transports.get(arbitration_id, ()):
+            transport._frame_received(data)
+
+    def _remove_transport(self, transport: ISOTPTransport):
+        transports = self._transports.get(transport.address.rx_id, [])
+        if transport in transports:
+            transports.remove(transport)
+        if not transports:
+            self._transports.pop(transport.address.rx_id, None)
+
+    def create_transport(self, protocol: asyncio.Protocol, address: Address, **kwargs) -> ISOTPTransport:
+        params = {
+            'block_size': self.block_size,
+            'st_min': self.st_min,
+            'tx_dl': self.tx_dl,
+            'tx_padding': self.tx_padding,
+            'max_rx_length': self.max_rx_length,
+            'is_fd': self.is_fd,
+            'bitrate_switch': self.bitrate_switch,
+        }
+        params.update(kwargs)
+        transport = ISOTPTransport(self, address, protocol, **params)
+        # a transport without rx_id only sends, e.g. functional requests
+        if address.rx_id is not None:
+            self._transports.setdefault(address.rx_id, []).append(transport)
+        protocol.connection_made(transport)
+        return transport
+
+    async def open_connection(self, rx_id, tx_id, mode=AddressingMode.Normal, target_address=None, source_address=None, address_extension=None, **kwargs):
+        loop = asyncio.get_event_loop()
+        address = Address(rx_id, tx_id, mode, target_address,
+                          source_address, address_extension)
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport = self.create_transport(protocol, address, **kwargs)
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        return reader, writer
@@ -0,0 +1,98 @@
+import os
+import time
+import contextlib
+
+
+# upper bounds in seconds, from CAN frame times up to P2* server
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+def _labels(labels: tuple, extra='') -> str:
+    items = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels]
+    if extra:
+        items.append(extra)
+    return '{%s}' % ','.join(items) if items else ''
+
+
+class Metrics(object):
+    # Histograms and counters keyed by name and labels. Hooks are called
+    # with (name, value, labels) for every observation and increment.
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.counters = {}
+        self.hooks = []
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.observe(value)
+        for hook in self.hooks:
+            hook(name, value, labels)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+        for hook in self.hooks:
+            hook(name, value, labels)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t1, **labels)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        seen = set()
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in seen:
+                lines.append('# TYPE %s histogram' % name)
+                seen.add(name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _labels(labels, 'le="%g"' % bound), cumulative))
+            lines.append('%s_bucket%s %d' % (name, _labels(labels, 'le="+Inf"'), histogram.count))
+            lines.append('%s_sum%s %.9f' % (name, _labels(labels), histogram.sum))
+            lines.append('%s_count%s %d' % (name, _labels(labels), histogram.count))
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in seen:
+                lines.append('# TYPE %s counter' % name)
+                seen.add(name)
+            lines.append('%s%s %d' % (name, _labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # e.g. for the node_exporter textfile collector, which must never
+        # see a partially written file
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp, path)
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import contextlib
+from typing import TYPE_CHECKING
+
+from udsoncan.exceptions import NegativeResponseException
+from udsoncan.configs import default_client_config
+
+from uds.client import Client
+from uds.bus import open_bus, wait_bus_ready
+
+if TYPE_CHECKING:
+    from can import BusABC
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Connection(object):
+
+    def __init__(self, reader=None, writer=None, client=None):
+        # None until connected
+        self.reader = reader
+        self.writer = writer
+        self.client = client
+        self.lock = asyncio.Lock()
+        self.last_used = 0
+
+
+class ClientPool(object):
+
+    def __init__(self, bus_config=None, bus: 'BusABC' = None, config=default_client_config, health_check_interval=5.0, health_check_timeout=0.1, metrics=None, **network_kwargs):
+        if bus is None and bus_config is None:
+            raise ValueError('Either a bus or a bus_config must be given')
+
+        self.bus_config = bus_config
+        self.config = dict(config)
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        # shared by every client of the pool
+        self.metrics = metrics
+        self.network_kwargs = network_kwargs
+
+        self._bus = bus
+        self._owns_bus = bus is None
+        self._network = None
+        self._stack = None
+        self._connections = {}
+
+    @property
+    def bus(self) -> 'BusABC':
+        if self._bus is None:
+            self._bus = open_bus(**self.bus_config)
+            wait_bus_ready(self._bus)
+        return self._bus
+
+    def _open_network(self):
+        if self._network is None:
+            from uds.isotp import ISOTPNetwork
+            self._network = ISOTPNetwork(self.bus, **self.network_kwargs)
+            self._stack = contextlib.ExitStack()
+            self._stack.enter_context(self._network.open())
+        return self._network
+
+    def _close_network(self):
+        if self._stack is not None:
+            self._stack.close()
+        self._stack = None
+        self._network = None
+        self._connections.clear()
+
+    async def __aenter__(self):
+        self._open_network()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._close_network()
+        if self._owns_bus and self._bus is not None:
+            self._bus.shutdown()
+            self._bus = None
+
+    def reset(self):
+        # drop every connection and, when the pool created it, the bus as well
+        self._close_network()
+        if self._owns_bus and self._bus is not None:
+            self._bus.shutdown()
+            self._bus = None
+        self._open_network()
+
+    async def _connect(self, connection: _Connection, rx_id, tx_id, config=None, **kwargs):
+        reader, writer = await self._open_network().open_connection(rx_id, tx_id, **kwargs)
+        connection.reader, connection.writer = reader, writer
+        connection.client = Client(reader, writer, self.config if config is None else config, self.metrics)
+
+    async def _healthy(self, connection: _Connection) -> bool:
+        try:
+            await connection.client.tester_present(timeout=self.health_check_timeout)
+        except (asyncio.TimeoutError, ConnectionError, NegativeResponseException):
+            return False
+        return True
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, rx_id, tx_id, config=None, **kwargs):
+        key = (rx_id, tx_id, tuple(sorted(kwargs.items())))
+        connection = self._connections.get(key)
+        if connection is None:
+            # registered before connecting, concurrent acquires of the same
+            # key wait on its lock instead of opening a second transport
+            connection = self._connections[key] = _Connection()
+
+        async with connection.lock:
+            loop = asyncio.get_event_loop()
+            if connection.client is None:
+                # stays unconnected when this fails, the next acquire retries
+                await self._connect(connection, rx_id, tx_id, config, **kwargs)
+            elif connection.last_used and loop.time() - connection.last_used > self.health_check_interval:
+                if not await self._healthy(connection):
+                    logger.warning('Connection 0x%x/0x%x failed its health check, reconnecting',
+                                   tx_id, rx_id)
+                    connection.writer.close()
+                    await self._connect(connection, rx_id, tx_id, config, **kwargs)
+                    if not await self._healthy(connection):
+                        raise ConnectionError(
+                            'Server at 0x%x does not answer' % tx_id)
+            try:
+                yield connection.client
+            finally:
+                connection.last_used = loop.time()
+
+    @contextlib.asynccontextmanager
+    async def raw_bus(self):
+        # suites that drive the bus directly (isotp_test) must not race the
+        # ISO-TP network for received frames, the interface stays initialized
+        self._close_network()
+        try:
+            yield self.bus
+        finally:
+            self._open_network()
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+
+from udsoncan import services
+
+
+logger = logging.getLogger(__name__)
+
+# suppressPosRspMsgIndicationBit, the functional requests of the quiet bus
+# get no positive responses
+SUPPRESS = 0x80
+# CommunicationControl
+ENABLE_RX_AND_TX = 0x00
+DISABLE_RX_AND_TX = 0x03
+NORMAL_COMMUNICATION = 0x01
+# ControlDTCSetting
+DTC_SETTING_ON = 0x01
+DTC_SETTING_OFF = 0x02
+
+
+class QuietBus(object):
+    # Functionally switches the ECUs to a session with DTC setting off and
+    # normal communication disabled, e.g. around a flash, upload or DID scan,
+    # and keeps their sessions alive with TesterPresent until the bus is
+    # restored. The requests are sent with a suppressed positive response on
+    # a send-only connection. That suppresses the positive responses only,
+    # an ECU still answers e.g. 0x13, 0x22 or 0x78 on its physical response
+    # ID, into the buffer of any physical connection open to it meanwhile.
+    # Open those inside the block, as below, or call discard_buffered() on
+    # their clients after entering and after restoring.
+    #
+    #   async with QuietBus(network, 0x7df):
+    #       async with open_client(network, rx_id, tx_id) as client:
+    #           await client.write_memory(address, data)
+    #
+    # Connections opened inside get the flow control of a quiet bus,
+    # block_size and st_min are restored on exit.
+
+    def __init__(self, network, functional_id, session=3, communication_type=NORMAL_COMMUNICATION,
+                 tester_present_interval=2.0, request_gap=0.05, block_size=0, st_min=0, restore_session=None):
+        self.network = network
+        self.functional_id = functional_id
+        self.session = session
+        self.communication_type = communication_type
+        # below S3 server, 5 sec
+        self.tester_present_interval = tester_present_interval
+        # time for the ECUs to handle a request before the next one
+        self.request_gap = request_gap
+        self.block_size = block_size
+        self.st_min = st_min
+        # e.g. 1 to also leave the session on exit, the ECUs stay in it otherwise
+        self.restore_session = restore_session
+
+        self._writer = None
+        self._keepalive = None
+        self._flow_control = None
+
+    @property
+    def active(self) -> bool:
+        return self._writer is not None
+
+    async def __aenter__(self):
+        await self.enter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # finish the restore even if the task is cancelled again meanwhile
+        await asyncio.shield(asyncio.ensure_future(self.restore()))
+
+    async def _send(self, *requests):
+        for request in requests:
+            self._writer.write(bytes(request))
+            await asyncio.sleep(self.request_gap)
+
+    async def _tester_present(self):
+        while True:
+            await asyncio.sleep(self.tester_present_interval)
+            self._writer.write(bytes([services.TesterPresent.request_id(), SUPPRESS]))
+
+    async def enter(self):
+        if self.active:
+            raise RuntimeError('The bus is already quiet')
+        _, self._writer = await self.network.open_connection(None, self.functional_id)
+        try:
+            await self._send(
+                [services.DiagnosticSessionControl.request_id(), self.session | SUPPRESS],
+                [services.ControlDTCSetting.request_id(), DTC_SETTING_OFF | SUPPRESS],
+                [services.CommunicationControl.request_id(), DISABLE_RX_AND_TX | SUPPRESS, self.communication_type])
+        except BaseException:
+            await self.restore()
+            raise
+
+        self._keepalive = asyncio.ensure_future(self._tester_present())
+        if hasattr(self.network, 'st_min'):
+            self._flow_control = self.network.block_size, self.network.st_min
+            self.network.block_size, self.network.st_min = self.block_size, self.st_min
+        logger.info('Bus quiet on 0x%x', self.functional_id)
+
+    async def restore(self):
+        if not self.active:
+            return
+        if self._flow_control is not None:
+            self.network.block_size, self.network.st_min = self._flow_control
+            self._flow_control = None
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+            self._keepalive = None
+
+        try:
+            requests = [
+                [services.CommunicationControl.request_id(), ENABLE_RX_AND_TX | SUPPRESS, self.communication_type],
+                [services.ControlDTCSetting.request_id(), DTC_SETTING_ON | SUPPRESS]]
+            if self.restore_session is not None:
+                requests.append([services.DiagnosticSessionControl.request_id(), self.restore_session | SUPPRESS])
+            await self._send(*requests)
+        finally:
+            self._writer.close()
+            self._writer = None
+        logger.info('Bus restored on 0x%x', self.functional_id)
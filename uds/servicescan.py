@@ -0,0 +1,192 @@
+import asyncio
+import logging
+
+from udsoncan import services
+
+
+logger = logging.getLogger(__name__)
+
+# what a probe tells about a service or sub-function
+SUPPORTED = 'supported'
+NOT_SUPPORTED = 'not supported'
+NOT_IN_SESSION = 'not in session'
+SECURITY = 'security access denied'
+NO_RESPONSE = 'no response'
+
+# NRC to classification, any other NRC means the request was understood
+NRC_CLASSES = {
+    0x11: NOT_SUPPORTED,   # serviceNotSupported
+    0x12: NOT_SUPPORTED,   # subFunctionNotSupported
+    0x7F: NOT_IN_SESSION,  # serviceNotSupportedInActiveSession
+    0x7E: NOT_IN_SESSION,  # subFunctionNotSupportedInActiveSession
+    0x33: SECURITY,        # securityAccessDenied
+}
+
+DEFAULT_SESSIONS = (1, 3, 2)
+SESSION_NAMES = {1: 'Default Session', 2: 'Program Session', 3: 'Extended Session'}
+# sessions entered from the default session, programming through extended
+SESSION_PATHS = {1: (1, ), 2: (3, 2), 3: (3, )}
+
+
+def classify(payload: bytes, sid) -> tuple:
+    # (classification, NRC or None)
+    if payload is None:
+        return NO_RESPONSE, None
+    if len(payload) >= 3 and payload[0] == 0x7F and payload[1] == sid:
+        return NRC_CLASSES.get(payload[2], SUPPORTED), payload[2]
+    if payload[0] == sid + 0x40:
+        return SUPPORTED, None
+    return NO_RESPONSE, None
+
+
+def has_subfunction(sid) -> bool:
+    service = services.cls_from_request_id(sid)
+    return service is not None and service.use_subfunction()
+
+
+def service_name(sid) -> str:
+    service = services.cls_from_request_id(sid)
+    return service.get_name() if service is not None else ''
+
+
+class ServiceSweep(object):
+    # Probes every SID with a bare request and the sub-functions of the
+    # services found, session by session. NRCs are checked in the order of
+    # ISO 14229-1, so [SID, sub-function] is refused with 0x12/0x7E before
+    # its missing parameters give 0x13. A probe is answered within P2,
+    # the next one is sent as soon as the answer is in.
+
+    def __init__(self, client, sessions=DEFAULT_SESSIONS, sids=range(0x100), subfunctions=range(0x80),
+                 timeout=0.1, session_paths=SESSION_PATHS, reset_timeout=5, pending_timeout=None):
+        self.client = client
+        self.sessions = sessions
+        self.sids = sids
+        self.subfunctions = subfunctions
+        self.timeout = timeout
+        # the wait after an NRC 0x78, the client's p2_star_timeout when None
+        self.pending_timeout = pending_timeout
+        self.session_paths = session_paths
+        self.reset_timeout = reset_timeout
+
+        self.session = None
+        self.session_changes = 0
+        self.probes = 0
+        # {(session, sid, subfunction or None): (classification, NRC)}
+        self.results = {}
+
+    async def _probe(self, request: bytes):
+        self.probes += 1
+        try:
+            return await self.client.send_raw(request, self.timeout, skip_pending=True,
+                                              pending_timeout=self.pending_timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def _change_session(self, session) -> bool:
+        self.session_changes += 1
+        payload = await self._probe(bytes([0x10, session]))
+        if classify(payload, 0x10)[0] != SUPPORTED:
+            return False
+        self.session = session
+        return True
+
+    async def enter_session(self, session):
+        if self.session == session:
+            return
+        # directly if the ECU allows it, else along the path from default
+        if self.session is not None and await self._change_session(session):
+            return
+        for step in (1, ) + self.session_paths.get(session, (session, )):
+            if self.session != step and not await self._change_session(step):
+                raise RuntimeError('Could not enter session 0x%02x' % step)
+
+    async def _restore(self, session, sid, subfunction):
+        # undo what a positive response changed
+        if sid == 0x11:
+            self.session = None
+            await self.client.wait_until_ready(timeout=self.reset_timeout)
+            self.session = 1
+        elif sid == 0x10:
+            self.session = subfunction
+        elif sid == 0x28 and subfunction != 0x00:
+            # enableRxAndTx, normal communication messages
+            await self._probe(bytes([0x28, 0x00, 0x01]))
+        elif sid == 0x85 and subfunction != 0x01:
+            await self._probe(bytes([0x85, 0x01]))
+        await self.enter_session(session)
+
+    async def _sweep_session(self, session):
+        await self.enter_session(session)
+
+        found = []
+        for sid in self.sids:
+            if sid == 0x10:
+                # DiagnosticSessionControl is probed last, it leaves the session
+                continue
+            payload = await self._probe(bytes([sid]))
+            result = classify(payload, sid)
+            self.results[(session, sid, None)] = result
+            if result[0] == SUPPORTED and payload[0] != 0x7F:
+                await self._restore(session, sid, None)
+            if result[0] not in (NOT_SUPPORTED, NO_RESPONSE) and has_subfunction(sid):
+                found.append(sid)
+
+        if 0x10 in self.sids:
+            self.results[(session, 0x10, None)] = classify(await self._probe(bytes([0x10])), 0x10)
+            found.append(0x10)
+
+        for sid in found:
+            for subfunction in self.subfunctions:
+                payload = await self._probe(bytes([sid, subfunction]))
+                result = classify(payload, sid)
+                self.results[(session, sid, subfunction)] = result
+                if result[0] == SUPPORTED and payload[0] != 0x7F:
+                    await self._restore(session, sid, subfunction)
+
+    async def sweep(self) -> dict:
+        for session in self.sessions:
+            await self._sweep_session(session)
+        await self.enter_session(1)
+        logger.info('%d probes, %d session changes', self.probes, self.session_changes)
+        return self.results
+
+
+async def sweep_ecus(clients: dict, **kwargs) -> dict:
+    # {name: results}, one sweep per ECU, all at the same time
+    sweeps = {name: ServiceSweep(client, **kwargs) for name, client in clients.items()}
+    results = await asyncio.gather(*(sweep.sweep() for sweep in sweeps.values()))
+    return dict(zip(sweeps, results))
+
+
+def support_matrix(results: dict) -> dict:
+    # {sid: {'subfunctions': [...], 'sessions': [...], 'security': bool}}
+    matrix = {}
+    for (session, sid, subfunction), (classification, _) in sorted(
+            results.items(), key=lambda item: (item[0][1], -1 if item[0][2] is None else item[0][2], item[0][0])):
+        if classification not in (SUPPORTED, SECURITY):
+            continue
+        if subfunction is None and has_subfunction(sid):
+            # the bare request only says the SID is known
+            continue
+        entry = matrix.setdefault(sid, {'subfunctions': [], 'sessions': [], 'security': False})
+        if subfunction is not None and subfunction not in entry['subfunctions']:
+            entry['subfunctions'].append(subfunction)
+        if session not in entry['sessions']:
+            entry['sessions'].append(session)
+        if classification == SECURITY:
+            entry['security'] = True
+    return matrix
+
+
+def format_table(matrix: dict, sessions=(1, 2, 3)) -> str:
+    # markdown in the layout of the README table
+    header = ['SID(hex)', 'Service', 'Sub-function(hex)', 'Security Access'] + \
+        [SESSION_NAMES.get(session, 'Session %02X' % session) for session in sessions]
+    lines = ['| ' + ' | '.join(header) + ' |', '|' + '|'.join(' --- ' for _ in header) + '|']
+    for sid, entry in sorted(matrix.items()):
+        row = ['%02X' % sid, service_name(sid),
+               '/'.join('%02X' % subfunction for subfunction in entry['subfunctions']) or '/',
+               '√' if entry['security'] else '/']
+        row += ['√' if session in entry['sessions'] else '/' for session in sessions]
+        lines.append('| ' + ' | '.join(row) + ' |')
+    return '\n'.join(lines) + '\n'
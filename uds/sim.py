@@ -0,0 +1,830 @@
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+import selectors
+from collections import deque
+
+from can import Message
+from uds import isotp
+from uds.isotp import PCIType, FlowStatus
+
+
+logger = logging.getLogger(__name__)
+
+# Simulation of a CAN channel with one ECU, driven by a virtual clock. Time
+# only advances when nothing is left to do at the current instant, so
+# timeouts of seconds pass in microseconds of wall time while every frame
+# still carries the time it would have been received at.
+
+DIDS = {
+    0xF180: b'BOOT'.ljust(32),
+    0xF187: b'PART0000001'.ljust(13),
+    0xF188: b'SWNR0000001'.ljust(13),
+    0xF18A: b'SUP',
+    0xF191: b'HWNR000001',
+    0xF199: bytes([0x20, 0x20, 0x01, 0x01]),
+}
+
+# DTC number and status byte
+DTCS = [
+    (0xC07388, 0x09),
+    (0xC10087, 0x08),
+    (0xC12187, 0x00),
+    (0xC14087, 0x09),
+    (0xC15187, 0x00),
+    (0xC16987, 0x00),
+    (0x910013, 0x08),
+    (0x910117, 0x00),
+    (0x910216, 0x00),
+    (0x930017, 0x01),
+]
+
+ROUTINES = {0x1830}
+
+# snapshot record 0x01 of a confirmed DTC, odometer (3 bytes) and battery voltage
+SNAPSHOT_DIDS = (0xDD00, 0xDD01)
+# extended data records, occurrence and aging counter (1 byte each)
+EXTENDED_DATA_RECORDS = (0x01, 0x02)
+
+# services with a sub-function, bit 7 suppresses the positive response
+SUBFUNCTION_SERVICES = {0x10, 0x11, 0x19, 0x27, 0x28, 0x31, 0x3E, 0x85}
+# negative responses an ECU keeps to itself for functional requests
+FUNCTIONAL_SUPPRESSED_NRCS = {0x11, 0x12, 0x31, 0x7E, 0x7F}
+
+
+class SimTimer(object):
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class SimClock(object):
+    # Discrete event scheduler, the only source of time in a simulation
+
+    def __init__(self, start=0.0):
+        self.now = start
+        self._events = []
+        self._sequence = itertools.count()
+
+    def time(self) -> float:
+        return self.now
+
+    def call_at(self, when, callback, *args) -> SimTimer:
+        timer = SimTimer(max(when, self.now), callback, args)
+        heapq.heappush(self._events, (timer.when, next(self._sequence), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args) -> SimTimer:
+        return self.call_at(self.now + delay, callback, *args)
+
+    def next_time(self):
+        # time of the next pending event, None when there is none
+        while self._events and self._events[0][2].cancelled:
+            heapq.heappop(self._events)
+        return self._events[0][0] if self._events else None
+
+    def run_next(self):
+        when, _, timer = heapq.heappop(self._events)
+        self.now = max(self.now, when)
+        if not timer.cancelled:
+            timer.callback(*timer.args)
+
+    def advance(self, when):
+        self.now = max(self.now, when)
+
+    def run_until(self, deadline, stop=None) -> bool:
+        # run events up to deadline, or until stop() is true
+        while True:
+            when = self.next_time()
+            if when is None or when > deadline:
+                self.advance(deadline)
+                return False
+            self.run_next()
+            if stop is not None and stop():
+                return True
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    # Polls the real file descriptors without blocking and, instead of
+    # sleeping, runs simulated events up to the end of the timeout
+
+    def __init__(self, clock: SimClock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout is not None and timeout <= 0:
+            return events
+
+        deadline = None if timeout is None else self.clock.now + timeout
+        while True:
+            when = self.clock.next_time()
+            if when is None or deadline is not None and when > deadline:
+                break
+            self.clock.run_next()
+            # e.g. call_soon_threadsafe from a bus listener
+            events = super().select(0)
+            if events:
+                return events
+
+        if deadline is not None:
+            self.clock.advance(deadline)
+            return []
+        # nothing is simulated any more, only real I/O can wake the loop
+        return super().select(None)
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    # asyncio.sleep, wait_for and call_later all run on the simulated clock
+
+    virtual_time = True
+
+    def __init__(self, clock: SimClock = None):
+        self.clock = clock if clock is not None else SimClock()
+        super().__init__(VirtualSelector(self.clock))
+
+    def time(self):
+        return self.clock.now
+
+
+def run(main, clock: SimClock = None):
+    # asyncio.run on a VirtualTimeLoop
+    loop = VirtualTimeLoop(clock)
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(main)
+    finally:
+        try:
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+def frame_time(msg: Message, bitrate=500000, data_bitrate=2000000) -> float:
+    # nominal frame length without stuff bits, including the interframe space
+    length = len(msg.data)
+    header = 64 if msg.is_extended_id else 44
+    if msg.is_fd and msg.bitrate_switch:
+        arbitration = header - 15
+        crc = 28 if length <= 16 else 32
+        return (arbitration + 3) / bitrate + (8 * length + crc) / data_bitrate
+    if msg.is_fd:
+        header += 13 if length > 16 else 9
+    return (header + 8 * length + 3) / bitrate
+
+
+class SimNetwork(object):
+    # One CAN channel. Frames are sent one after another in the order they
+    # were queued, there is no arbitration between nodes.
+
+    def __init__(self, clock: SimClock = None, bitrate=500000, data_bitrate=2000000):
+        self.clock = clock if clock is not None else SimClock()
+        self.bitrate = bitrate
+        self.data_bitrate = data_bitrate
+        self.buses = []
+        self._idle_at = 0.0
+
+    def transmit(self, sender, msg: Message) -> float:
+        # the time the frame has been received by every node
+        start = max(self.clock.now, self._idle_at)
+        end = start + frame_time(msg, self.bitrate, self.data_bitrate)
+        self._idle_at = end
+        self.clock.call_at(end, self._deliver, sender, msg)
+        return end
+
+    def _deliver(self, sender, msg: Message):
+        for bus in list(self.buses):
+            if bus is not sender or bus.receive_own_messages:
+                bus._frame_received(Message(
+                    timestamp=self.clock.now, arbitration_id=msg.arbitration_id,
+                    is_extended_id=msg.is_extended_id, is_fd=msg.is_fd,
+                    bitrate_switch=msg.bitrate_switch, dlc=msg.dlc, data=bytes(msg.data),
+                    channel=bus.channel_info))
+
+
+class VirtualBus(object):
+    # Node on a SimNetwork with the parts of can.BusABC used here. Without
+    # listeners frames are queued for recv, which runs the simulation.
+
+    def __init__(self, network: SimNetwork, can_filters=None, receive_own_messages=False, channel_info='sim'):
+        self.network = network
+        self.clock = network.clock
+        self.receive_own_messages = receive_own_messages
+        self.channel_info = channel_info
+        self.filters = None
+        self.set_filters(can_filters)
+        self._queue = deque()
+        self._listeners = []
+        network.buses.append(self)
+
+    def set_filters(self, filters=None):
+        self.filters = filters or None
+
+    def _matches(self, msg: Message) -> bool:
+        if self.filters is None:
+            return True
+        for can_filter in self.filters:
+            mask = can_filter['can_mask']
+            if 'extended' in can_filter and can_filter['extended'] != msg.is_extended_id:
+                continue
+            if msg.arbitration_id & mask == can_filter['can_id'] & mask:
+                return True
+        return False
+
+    def add_listener(self, listener):
+        # listener(msg) is called in simulated time, e.g. by ISOTPNetwork
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _frame_received(self, msg: Message):
+        if not self._matches(msg):
+            return
+        if self._listeners:
+            for listener in list(self._listeners):
+                listener(msg)
+        else:
+            self._queue.append(msg)
+
+    def send(self, msg: Message, timeout=None):
+        self.network.transmit(self, msg)
+
+    def recv(self, timeout=None):
+        if not self._queue:
+            if timeout is None:
+                # waits as long as anything is scheduled
+                deadline = float('inf')
+            else:
+                deadline = self.clock.now + timeout
+            self.clock.run_until(deadline, lambda: bool(self._queue))
+            if not self._queue:
+                return None
+        return self._queue.popleft()
+
+    def shutdown(self):
+        if self in self.network.buses:
+            self.network.buses.remove(self)
+        self._queue.clear()
+
+
+def negative_response(sid, nrc) -> bytes:
+    return bytes([0x7F, sid, nrc])
+
+
+class UdsServer(object):
+    # The services and session rules of the README table, enough for
+    # diag_test. Security access accepts any key without key_function.
+
+    def __init__(self, time, key_function=None, reset_time=0.05, dids=DIDS, dtcs=DTCS, routines=ROUTINES, seed=0, max_dids=None,
+                 memory_size=0x10000, max_memory_length=None, routine_time=0.0, s3_time=None):
+        self.time = time
+        self.key_function = key_function
+        self.reset_time = reset_time
+        self.dids = dict(dids)
+        self.dtcs = list(dtcs)
+        self.routines = set(routines)
+        # DIDs per ReadDataByIdentifier request, more are answered with NRC 0x13
+        self.max_dids = max_dids
+        # memory from address 0 for Read/WriteMemoryByAddress, longer
+        # transfers than max_memory_length are refused
+        self.memory = bytearray(memory_size)
+        self.max_memory_length = max_memory_length
+        # how long a started routine runs, {routine_id: end time} of those started
+        self.routine_time = routine_time
+        self.started_routines = {}
+        # S3 server, a non-default session without requests for longer ends
+        self.s3_time = s3_time
+        self.session = 1
+        self.unlocked = False
+        self.ready_at = 0.0
+        self.last_request = 0.0
+        self.communication_disabled = False
+        self.dtc_setting_off = False
+        self._seed = None
+        self._random = random.Random(seed)
+        self._handlers = {
+            0x10: self._session_control,
+            0x11: self._ecu_reset,
+            0x14: self._clear_dtc,
+            0x19: self._read_dtc,
+            0x22: self._read_data,
+            0x23: self._read_memory,
+            0x27: self._security_access,
+            0x28: self._communication_control,
+            0x2E: self._write_data,
+            0x31: self._routine_control,
+            0x3D: self._write_memory,
+            0x3E: self._tester_present,
+            0x85: self._control_dtc_setting,
+        }
+
+    @property
+    def ready(self) -> bool:
+        return self.time() >= self.ready_at
+
+    def handle(self, request: bytes, functional=False):
+        # the response, None when there is none
+        if not request:
+            return None
+        now = self.time()
+        if self.s3_time is not None and self.session != 1 and now - self.last_request > self.s3_time:
+            self._default_session()
+        self.last_request = now
+        sid = request[0]
+        handler = self._handlers.get(sid)
+        if handler is None:
+            response = negative_response(sid, 0x11)
+        elif sid in SUBFUNCTION_SERVICES and len(request) < 2:
+            response = negative_response(sid, 0x13)
+        else:
+            suppress = False
+            if sid in SUBFUNCTION_SERVICES:
+                suppress = bool(request[1] & 0x80)
+                request = bytes([sid, request[1] & 0x7F]) + request[2:]
+            response = handler(request)
+            if suppress and response[0] != 0x7F:
+                return None
+        if functional and response[0] == 0x7F and response[2] in FUNCTIONAL_SUPPRESSED_NRCS:
+            return None
+        return response
+
+    def _default_session(self):
+        # communication and DTC setting are back to normal in the default session
+        self.session = 1
+        self.communication_disabled = False
+        self.dtc_setting_off = False
+        self._lock()
+
+    def _lock(self):
+        self.unlocked = False
+        self._seed = None
+        self.started_routines.clear()
+
+    def _session_control(self, request):
+        if len(request) != 2:
+            return negative_response(0x10, 0x13)
+        if request[1] not in (1, 2, 3):
+            return negative_response(0x10, 0x12)
+        if request[1] == 1:
+            self._default_session()
+        else:
+            self.session = request[1]
+            self._lock()
+        # P2 server 50ms, P2* server 5000ms
+        return bytes([0x50, request[1], 0x00, 0x32, 0x01, 0xF4])
+
+    def _ecu_reset(self, request):
+        if len(request) != 2:
+            return negative_response(0x11, 0x13)
+        if request[1] not in (1, 3):
+            return negative_response(0x11, 0x12)
+        self._default_session()
+        # no answers until the restart is over
+        self.ready_at = self.time() + self.reset_time
+        return bytes([0x51, request[1]])
+
+    def _clear_dtc(self, request):
+        if len(request) != 4:
+            return negative_response(0x14, 0x13)
+        self.dtcs = [(dtc, 0x00) for dtc, _ in self.dtcs]
+        return bytes([0x54])
+
+    def _read_dtc(self, request):
+        if len(request) < 2:
+            return negative_response(0x19, 0x13)
+        if request[1] == 0x02:
+            if len(request) != 3:
+                return negative_response(0x19, 0x13)
+            dtcs = [(dtc, status) for dtc, status in self.dtcs if status & request[2]]
+        elif request[1] == 0x0A:
+            if len(request) != 2:
+                return negative_response(0x19, 0x13)
+            dtcs = self.dtcs
+        elif request[1] == 0x03:
+            if len(request) != 2:
+                return negative_response(0x19, 0x13)
+            response = bytearray([0x59, 0x03])
+            for dtc, status in self.dtcs:
+                if status & 0x08:
+                    response += dtc.to_bytes(3, 'big') + bytes([0x01])
+            return bytes(response)
+        elif request[1] in (0x04, 0x06):
+            return self._read_dtc_records(request)
+        else:
+            return negative_response(0x19, 0x12)
+        response = bytearray([0x59, request[1], 0xFF])
+        for dtc, status in dtcs:
+            response += dtc.to_bytes(3, 'big') + bytes([status])
+        return bytes(response)
+
+    def _read_dtc_records(self, request):
+        # snapshots (0x04) and extended data (0x06) of one DTC, made up from
+        # the DTC number
+        if len(request) != 6:
+            return negative_response(0x19, 0x13)
+        dtc = int.from_bytes(request[2:5], 'big')
+        status = dict(self.dtcs).get(dtc)
+        if status is None:
+            return negative_response(0x19, 0x31)
+        record_number = request[5]
+        response = bytearray([0x59, request[1]]) + request[2:5] + bytes([status])
+        if request[1] == 0x04:
+            if record_number not in (0x01, 0xFF):
+                return negative_response(0x19, 0x31)
+            if status & 0x08:
+                response += bytes([0x01, len(SNAPSHOT_DIDS)])
+                response += SNAPSHOT_DIDS[0].to_bytes(2, 'big') + (dtc & 0xFFFFF).to_bytes(3, 'big')
+                response += SNAPSHOT_DIDS[1].to_bytes(2, 'big') + bytes([120 + dtc % 30])
+        else:
+            if record_number not in EXTENDED_DATA_RECORDS + (0xFF, ):
+                return negative_response(0x19, 0x31)
+            counters = {0x01: status and 1 + dtc % 5, 0x02: dtc % 40}
+            for record in EXTENDED_DATA_RECORDS:
+                if record_number in (record, 0xFF):
+                    response += bytes([record, counters[record]])
+        return bytes(response)
+
+    def _read_data(self, request):
+        if len(request) < 3 or len(request) % 2 == 0:
+            return negative_response(0x22, 0x13)
+        if self.max_dids is not None and len(request) // 2 > self.max_dids:
+            return negative_response(0x22, 0x13)
+        # unsupported DIDs are left out, NRC 0x31 only if none is supported
+        response = bytearray([0x62])
+        for i in range(1, len(request), 2):
+            did = request[i] << 8 | request[i + 1]
+            if did in self.dids:
+                response += request[i:i + 2] + self.dids[did]
+        if len(response) == 1:
+            return negative_response(0x22, 0x31)
+        return bytes(response)
+
+    def _memory_range(self, request):
+        # (address, size, data offset) or an NRC
+        if len(request) < 2:
+            return 0x13
+        address_len = request[1] & 0xF
+        size_len = request[1] >> 4
+        if not 1 <= address_len <= 5 or not 1 <= size_len <= 4:
+            return 0x31
+        offset = 2 + address_len + size_len
+        if len(request) < offset:
+            return 0x13
+        address = int.from_bytes(request[2:2 + address_len], 'big')
+        size = int.from_bytes(request[2 + address_len:offset], 'big')
+        if size == 0 or address + size > len(self.memory):
+            return 0x31
+        return address, size, offset
+
+    def _read_memory(self, request):
+        memory_range = self._memory_range(request)
+        if isinstance(memory_range, int):
+            return negative_response(0x23, memory_range)
+        address, size, offset = memory_range
+        if len(request) != offset:
+            return negative_response(0x23, 0x13)
+        if self.max_memory_length is not None and size > self.max_memory_length:
+            return negative_response(0x23, 0x14)
+        return bytes([0x63]) + self.memory[address:address + size]
+
+    def _write_memory(self, request):
+        if self.session == 1:
+            return negative_response(0x3D, 0x7F)
+        memory_range = self._memory_range(request)
+        if isinstance(memory_range, int):
+            return negative_response(0x3D, memory_range)
+        address, size, offset = memory_range
+        if len(request) - offset != size:
+            return negative_response(0x3D, 0x13)
+        if self.max_memory_length is not None and size > self.max_memory_length:
+            return negative_response(0x3D, 0x13)
+        self.memory[address:address + size] = request[offset:]
+        return bytes([0x7D]) + request[1:offset]
+
+    def _security_access(self, request):
+        if self.session not in (2, 3):
+            return negative_response(0x27, 0x7F)
+        if request[1] == 0x03:
+            if len(request) != 2:
+                return negative_response(0x27, 0x13)
+            if self.unlocked:
+                # already unlocked, the seed is all zeros
+                return bytes([0x67, 0x03, 0x00, 0x00, 0x00, 0x00])
+            self._seed = self._random.randint(1, 0xFFFFFFFE)
+            return bytes([0x67, 0x03]) + self._seed.to_bytes(4, 'big')
+        if request[1] == 0x04:
+            if len(request) != 6:
+                return negative_response(0x27, 0x13)
+            if self._seed is None:
+                return negative_response(0x27, 0x24)
+            key = int.from_bytes(request[2:6], 'big')
+            seed, self._seed = self._seed, None
+            if self.key_function is not None and key != self.key_function(seed):
+                return negative_response(0x27, 0x35)
+            self.unlocked = True
+            return bytes([0x67, 0x04])
+        return negative_response(0x27, 0x12)
+
+    def _communication_control(self, request):
+        if self.session not in (2, 3):
+            return negative_response(0x28, 0x7F)
+        if request[1] not in (0, 1, 2, 3):
+            return negative_response(0x28, 0x12)
+        if len(request) != 3:
+            return negative_response(0x28, 0x13)
+        self.communication_disabled = request[1] != 0
+        return bytes([0x68, request[1]])
+
+    def _write_data(self, request):
+        if self.session != 3:
+            return negative_response(0x2E, 0x7F)
+        if len(request) < 4:
+            return negative_response(0x2E, 0x13)
+        did = request[1] << 8 | request[2]
+        if did not in self.dids:
+            return negative_response(0x2E, 0x31)
+        if len(request) - 3 != len(self.dids[did]):
+            return negative_response(0x2E, 0x13)
+        if not self.unlocked:
+            return negative_response(0x2E, 0x33)
+        self.dids[did] = bytes(request[3:])
+        return bytes([0x6E]) + request[1:3]
+
+    def _routine_control(self, request):
+        if self.session not in (2, 3):
+            return negative_response(0x31, 0x7F)
+        if request[1] not in (1, 2, 3):
+            return negative_response(0x31, 0x12)
+        if len(request) < 4:
+            return negative_response(0x31, 0x13)
+        routine_id = request[2] << 8 | request[3]
+        if routine_id not in self.routines:
+            return negative_response(0x31, 0x31)
+        if not self.unlocked:
+            return negative_response(0x31, 0x33)
+        now = self.time()
+        if request[1] == 1:
+            if self.started_routines.get(routine_id, now) > now:
+                return negative_response(0x31, 0x24)
+            self.started_routines[routine_id] = end = now + self.routine_time
+        elif routine_id not in self.started_routines:
+            # stopped or results asked for before the start
+            return negative_response(0x31, 0x24)
+        elif request[1] == 2:
+            end = self.started_routines.pop(routine_id)
+            now = max(now, end)
+        else:
+            end = self.started_routines[routine_id]
+        # routineStatusRecord, 0x01 running and 0x00 completed
+        return bytes([0x71]) + request[1:4] + bytes([0x01 if end > now else 0x00])
+
+    def _tester_present(self, request):
+        if len(request) != 2:
+            return negative_response(0x3E, 0x13)
+        if request[1] != 0x00:
+            return negative_response(0x3E, 0x12)
+        return bytes([0x7E, 0x00])
+
+    def _control_dtc_setting(self, request):
+        if self.session != 3:
+            return negative_response(0x85, 0x7F)
+        if len(request) < 2:
+            return negative_response(0x85, 0x13)
+        if request[1] not in (1, 2):
+            return negative_response(0x85, 0x12)
+        self.dtc_setting_off = request[1] == 2
+        return bytes([0xC5, request[1]])
+
+
+class SimECU(object):
+    # ISO-TP server with the ECU side timeouts of isotp_test, frames must be
+    # padded to 8 bytes. Half duplex, nothing but flow control is accepted
+    # while a response is being sent.
+
+    def __init__(self, bus: VirtualBus, rx_id, tx_id, fn_id=None, server: UdsServer = None, n_bs=0.075, n_cr=0.15,
+                 block_size=0, st_min=0, tx_dl=8, padding=0xAA, response_time=0.002, max_rx_length=4095):
+        self.bus = bus
+        self.clock = bus.clock
+        self.rx_id = rx_id
+        self.tx_id = tx_id
+        self.fn_id = fn_id
+        self.server = server if server is not None else UdsServer(self.clock.time)
+        self.n_bs = n_bs
+        self.n_cr = n_cr
+        self.block_size = block_size
+        self.st_min = st_min
+        self.tx_dl = tx_dl
+        self.padding = padding
+        self.response_time = response_time
+        self.max_rx_length = max_rx_length
+
+        self._rx_buffer = None
+        self._rx_index = 0
+        self._rx_sn = 0
+        self._rx_block_count = 0
+        self._rx_timer = None
+
+        self._tx_payload = None
+        self._tx_index = 0
+        self._tx_sn = 0
+        self._tx_block_size = 0
+        self._tx_st_min = 0
+        self._tx_block_count = 0
+        self._tx_timer = None
+        self._waiting_fc = False
+
+        bus.add_listener(self._on_message)
+
+    def _send_frame(self, frame: bytes) -> float:
+        data = isotp.pad(frame, max(8, isotp.frame_length(len(frame))), self.padding)
+        msg = Message(arbitration_id=self.tx_id, is_extended_id=self.tx_id > 0x7FF, dlc=len(data), data=data,
+                      is_fd=len(data) > 8, bitrate_switch=len(data) > 8)
+        return self.bus.network.transmit(self.bus, msg)
+
+    def _on_message(self, msg: Message):
+        if msg.arbitration_id == self.rx_id:
+            functional = False
+        elif self.fn_id is not None and msg.arbitration_id == self.fn_id:
+            functional = True
+        else:
+            return
+        if not self.server.ready:
+            return
+
+        data = bytes(msg.data)
+        if not data:
+            return
+        frame_type = isotp.pci_type(data)
+
+        if self._tx_payload is not None:
+            if frame_type == PCIType.FlowControl and not functional and self._waiting_fc:
+                self._flow_control_received(data)
+            return
+
+        if frame_type == PCIType.SingleFrame:
+            if len(data) == 8:
+                length = data[0] & 0xF
+                valid = 1 <= length <= 7
+                offset = 1
+            else:
+                length = data[1] if len(data) > 8 else 0
+                valid = len(data) > 8 and data[0] == 0 and 1 <= length <= len(data) - 2
+                offset = 2
+            if not valid:
+                return
+            # a new single frame terminates any reception in progress
+            self._stop_rx()
+            self._request_received(data[offset:offset + length], functional)
+
+        elif frame_type == PCIType.FirstFrame:
+            if functional or len(data) < 8:
+                return
+            length = isotp.first_frame_length(data)
+            offset = 6 if data[0] & 0xF == 0 and data[1] == 0 else 2
+            if length <= isotp.single_frame_capacity(len(data)):
+                return
+            self._stop_rx()
+            if length > self.max_rx_length:
+                self._send_frame(isotp.encode_flow_control(FlowStatus.Overflow))
+                return
+            self._rx_buffer = bytearray(data[offset:offset + length])
+            self._rx_index = len(self._rx_buffer)
+            self._rx_buffer.extend(bytes(length - self._rx_index))
+            self._rx_sn = 1
+            self._rx_block_count = 0
+            self._send_frame(isotp.encode_flow_control(FlowStatus.ContinueToSend, self.block_size, self.st_min))
+            self._restart_rx_timer()
+
+        elif frame_type == PCIType.ConsecutiveFrame:
+            if self._rx_buffer is None or functional:
+                return
+            if len(data) < 8 or data[0] & 0xF != self._rx_sn:
+                self._stop_rx()
+                return
+            chunk = data[1:1 + len(self._rx_buffer) - self._rx_index]
+            self._rx_buffer[self._rx_index:self._rx_index + len(chunk)] = chunk
+            self._rx_index += len(chunk)
+            self._rx_sn = (self._rx_sn + 1) & 0xF
+            if self._rx_index >= len(self._rx_buffer):
+                payload = bytes(self._rx_buffer)
+                self._stop_rx()
+                self._request_received(payload, False)
+                return
+            self._rx_block_count += 1
+            if self.block_size and self._rx_block_count >= self.block_size:
+                self._rx_block_count = 0
+                self._send_frame(isotp.encode_flow_control(FlowStatus.ContinueToSend, self.block_size, self.st_min))
+            self._restart_rx_timer()
+
+    def _stop_rx(self):
+        if self._rx_timer is not None:
+            self._rx_timer.cancel()
+            self._rx_timer = None
+        self._rx_buffer = None
+
+    def _restart_rx_timer(self):
+        if self._rx_timer is not None:
+            self._rx_timer.cancel()
+        self._rx_timer = self.clock.call_later(self.n_cr, self._rx_timeout)
+
+    def _rx_timeout(self):
+        logger.debug('N_Cr timeout after %d of %d bytes', self._rx_index, len(self._rx_buffer))
+        self._rx_timer = None
+        self._rx_buffer = None
+
+    def _request_received(self, request: bytes, functional):
+        response = self.server.handle(request, functional)
+        if response is not None:
+            self.clock.call_later(self.response_time, self._send_response, response)
+
+    def _send_response(self, payload: bytes):
+        if self._tx_payload is not None:
+            return
+        if len(payload) <= isotp.single_frame_capacity(self.tx_dl):
+            self._send_frame(isotp.encode_single_frame(payload, escape=len(payload) > 7))
+            return
+        index = isotp.first_frame_capacity(len(payload), self.tx_dl)
+        end = self._send_frame(isotp.encode_first_frame(len(payload), payload[:index]))
+        self._tx_payload = payload
+        self._tx_index = index
+        self._tx_sn = 1
+        self._wait_flow_control(end)
+
+    def _wait_flow_control(self, since):
+        self._waiting_fc = True
+        self._cancel_tx_timer()
+        self._tx_timer = self.clock.call_at(since + self.n_bs, self._abort_tx, 'N_Bs timeout')
+
+    def _cancel_tx_timer(self):
+        if self._tx_timer is not None:
+            self._tx_timer.cancel()
+            self._tx_timer = None
+
+    def _abort_tx(self, reason):
+        logger.debug('Transmission aborted after %d of %d bytes: %s',
+                     self._tx_index, len(self._tx_payload), reason)
+        self._cancel_tx_timer()
+        self._tx_payload = None
+        self._waiting_fc = False
+
+    def _flow_control_received(self, data: bytes):
+        if len(data) < 8:
+            self._abort_tx('short flow control')
+            return
+        flow_status = data[0] & 0xF
+        if flow_status == FlowStatus.ContinueToSend:
+            self._waiting_fc = False
+            self._cancel_tx_timer()
+            self._tx_block_size = data[1]
+            self._tx_st_min = isotp.stmin_to_seconds(data[2])
+            self._tx_block_count = 0
+            self._tx_timer = self.clock.call_later(0, self._send_consecutive_frame)
+        elif flow_status == FlowStatus.Wait:
+            self._wait_flow_control(self.clock.now)
+        elif flow_status == FlowStatus.Overflow:
+            self._abort_tx('overflow')
+        else:
+            self._abort_tx('invalid flow status 0x%x' % flow_status)
+
+    def _send_consecutive_frame(self):
+        self._tx_timer = None
+        size = self.tx_dl - 1
+        chunk = self._tx_payload[self._tx_index:self._tx_index + size]
+        end = self._send_frame(isotp.encode_consecutive_frame(self._tx_sn, chunk))
+        self._tx_index += len(chunk)
+        self._tx_sn = (self._tx_sn + 1) & 0xF
+        if self._tx_index >= len(self._tx_payload):
+            self._tx_payload = None
+            return
+        self._tx_block_count += 1
+        if self._tx_block_size and self._tx_block_count >= self._tx_block_size:
+            self._wait_flow_control(end)
+        else:
+            # STmin counts from the end of the previous consecutive frame
+            self._tx_timer = self.clock.call_at(end + self._tx_st_min, self._send_consecutive_frame)
+
+
+def open_sim_bus(tx_id, rx_id, fn_id=None, clock: SimClock = None, bitrate=500000, data_bitrate=2000000,
+                 can_filters=None, key_function=None, **ecu_kwargs) -> VirtualBus:
+    # tester side bus of a new simulated channel with one SimECU, which
+    # listens on the tester's tx_id and fn_id and answers on its rx_id
+    network = SimNetwork(clock, bitrate, data_bitrate)
+    server = UdsServer(network.clock.time, key_function)
+    ecu_bus = VirtualBus(network, channel_info='sim ECU')
+    SimECU(ecu_bus, tx_id, rx_id, fn_id, server, **ecu_kwargs)
+    return VirtualBus(network, can_filters)
@@ -0,0 +1,203 @@
+import errno
+import socket
+import asyncio
+import logging
+
+from uds.isotp import Address, AddressingMode, N_WFTmax
+
+
+logger = logging.getLogger(__name__)
+
+# largest PDU the kernel delivers in one datagram
+RECV_SIZE = 65536
+# struct canfd_frame, selects CAN FD frames
+CANFD_MTU = 72
+CANFD_BRS = 0x01
+
+
+def create_socket(interface, address: Address, block_size=0, st_min=0, tx_dl=8, tx_padding=None, wft_max=N_WFTmax, is_fd=None, bitrate_switch=False) -> socket.socket:
+    # a non-blocking CAN_ISOTP socket, segmentation, flow control and STmin
+    # are handled by the kernel
+    import isotp
+
+    if is_fd is None:
+        is_fd = tx_dl > 8
+    if address.rx_id is None:
+        raise ValueError('A CAN_ISOTP socket needs an rx_id to bind to')
+
+    tp = isotp.socket(timeout=None)
+    try:
+        flags = 0
+        opts = {}
+        if tx_padding is not None:
+            flags |= tp.flags.TX_PADDING | tp.flags.RX_PADDING
+            opts['txpad'] = tx_padding
+            opts['rxpad'] = tx_padding
+        if address.tx_prefix:
+            flags |= tp.flags.EXTEND_ADDR | tp.flags.RX_EXT_ADDR
+            opts['ext_address'] = address.tx_prefix[0]
+            opts['rx_ext_address'] = address.rx_prefix[0]
+        tp.set_opts(optflag=flags, **opts)
+        tp.set_fc_opts(bs=block_size, stmin=st_min, wftmax=wft_max)
+        if is_fd:
+            tp.set_ll_opts(mtu=CANFD_MTU, tx_dl=tx_dl, tx_flags=CANFD_BRS if bitrate_switch else 0)
+
+        # the prefixes are added by the kernel, only the IDs go into the binding
+        mode = isotp.AddressingMode.Normal_29bits if address.is_extended_id else isotp.AddressingMode.Normal_11bits
+        tp.bind(interface, isotp.Address(mode, rxid=address.rx_id, txid=address.tx_id))
+
+        # a plain socket on the same file description for the event loop
+        sock = socket.fromfd(tp.fileno(), socket.AF_CAN, socket.SOCK_DGRAM, socket.CAN_ISOTP)
+    finally:
+        tp.close()
+
+    sock.setblocking(False)
+    return sock
+
+
+class SocketCANStreamReader(asyncio.StreamReader):
+    # A PDU the kernel refused ends the read of the response to it, once.
+    # set_exception would end every later read on the socket as well.
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._error = None
+
+    def error_received(self, exc: OSError):
+        self._error = exc
+        self._wakeup_waiter()
+
+    async def read(self, n=-1):
+        while self._error is None or self._buffer:
+            if self._buffer or self._eof or self._exception is not None:
+                return await super().read(n)
+            await self._wait_for_data('read')
+        error, self._error = self._error, None
+        raise error
+
+
+class SocketCANProtocol(asyncio.StreamReaderProtocol):
+
+    def __init__(self, reader: SocketCANStreamReader):
+        super().__init__(reader)
+        self._reader = reader
+
+    def error_received(self, exc: OSError):
+        # a PDU that was not sent, the read of its response fails instead
+        # of waiting for P2
+        self._reader.error_received(exc)
+
+
+class SocketCANTransport(asyncio.Transport):
+
+    def __init__(self, sock: socket.socket, address: Address, protocol: asyncio.Protocol):
+        super().__init__()
+        self._sock = sock
+        self._address = address
+        self._protocol = protocol
+        self._loop = asyncio.get_event_loop()
+        self._tx_buffer = []
+        self._closing = False
+
+        self._loop.add_reader(self._sock.fileno(), self._read_ready)
+
+    @property
+    def address(self) -> Address:
+        return self._address
+
+    def get_protocol(self):
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def get_extra_info(self, name, default=None):
+        if name == 'socket':
+            return self._sock
+        return default
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        self._close(None)
+
+    def _close(self, exc):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._sock.fileno())
+        if self._tx_buffer:
+            self._loop.remove_writer(self._sock.fileno())
+        self._tx_buffer.clear()
+        self._sock.close()
+        self._loop.call_soon(self._protocol.connection_lost, exc)
+
+    def abort(self):
+        self.close()
+
+    def write(self, data):
+        if self._closing:
+            raise RuntimeError('Transport is closing')
+        if self._tx_buffer:
+            # the kernel is still busy with an earlier PDU
+            self._tx_buffer.append(bytes(data))
+            return
+        if not self._try_send(bytes(data)):
+            self._tx_buffer.append(bytes(data))
+            self._loop.add_writer(self._sock.fileno(), self._write_ready)
+
+    def can_write_eof(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return len(self._tx_buffer)
+
+    def _try_send(self, data: bytes) -> bool:
+        try:
+            self._sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError as e:
+            # e.g. ECOMM when the receiver's flow control timed out (N_Bs),
+            # the PDU is dropped and the protocol told
+            logger.error('Transmission to 0x%x failed: %s', self._address.tx_id, e)
+            self._protocol.error_received(e)
+        return True
+
+    def _write_ready(self):
+        while self._tx_buffer:
+            if not self._try_send(self._tx_buffer[0]):
+                return
+            self._tx_buffer.pop(0)
+        self._loop.remove_writer(self._sock.fileno())
+
+    def _read_ready(self):
+        while True:
+            try:
+                data = self._sock.recv(RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # reception errors (N_Cr timeout, wrong SN) are reported on
+                # the socket and the PDU is dropped, as in uds.isotp
+                if e.errno in (errno.ECOMM, errno.EILSEQ, errno.EBADMSG, errno.ETIMEDOUT, errno.EMSGSIZE):
+                    logger.warning('Reception from 0x%x failed: %s', self._address.rx_id, e)
+                    continue
+                self._close(e)
+                return
+            self._protocol.data_received(data)
+
+
+async def open_connection(interface, rx_id, tx_id, mode=AddressingMode.Normal, target_address=None, source_address=None, address_extension=None, **kwargs):
+    # same as uds.isotp.ISOTPNetwork.open_connection, e.g. on 'vcan0'
+    loop = asyncio.get_event_loop()
+    address = Address(rx_id, tx_id, mode, target_address,
+                      source_address, address_extension)
+    sock = create_socket(interface, address, **kwargs)
+    reader = SocketCANStreamReader()
+    protocol = SocketCANProtocol(reader)
+    transport = SocketCANTransport(sock, address, protocol)
+    protocol.connection_made(transport)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer